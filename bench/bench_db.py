@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Микро-бенчмарк слоя БД: ops/sec для get_user / ensure_user
+- legacy:  как раньше — новое соединение на каждый вызов, commit, close (journal_mode=DELETE),
+           ensure_user через SELECT + UPDATE/INSERT, get_user без кэша
+- current: текущие main.get_user / main.ensure_user
+
+Запуск: python bench/bench_db.py [кол-во операций] [потоков]
+"""
+import os
+import sys
+import sqlite3
+import tempfile
+import threading
+import time
+
+TMP_DIR = tempfile.mkdtemp(prefix="bench_db_")
+os.environ["DB_PATH"] = os.path.join(TMP_DIR, "pool.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+LEGACY_PATH = os.path.join(TMP_DIR, "legacy.db")
+USERS = 1000
+
+
+def legacy_db_execute(query, params=(), fetchone=False, fetchall=False, return_id=False):
+    # копия старой реализации: connect/commit/close на каждый запрос под общим lock
+    with main._db_lock:
+        conn = sqlite3.connect(LEGACY_PATH, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+        try:
+            cur.execute(query, params)
+            conn.commit()
+            if return_id:
+                return cur.lastrowid
+            if fetchone:
+                row = cur.fetchone()
+                return dict(row) if row else None
+            if fetchall:
+                rows = cur.fetchall()
+                return [dict(r) for r in rows] if rows else []
+            return cur.rowcount
+        finally:
+            conn.close()
+
+
+def legacy_get_user(user_id):
+    return legacy_db_execute("SELECT * FROM users WHERE user_id = ?", (user_id,), fetchone=True)
+
+
+def legacy_ensure_user(user_id, username, first_name, last_name=""):
+    existing = legacy_db_execute("SELECT * FROM users WHERE user_id = ?", (user_id,), fetchone=True)
+    if existing:
+        legacy_db_execute("""
+            UPDATE users SET username = ?, first_name = ?, last_name = ?, last_activity = CURRENT_TIMESTAMP
+            WHERE user_id = ?
+        """, (username, first_name, last_name, user_id))
+    else:
+        legacy_db_execute("""
+            INSERT INTO users (user_id, username, first_name, last_name, status)
+            VALUES (?, ?, ?, ?, 'pending')
+        """, (user_id, username, first_name, last_name))
+
+
+IMPLEMENTATIONS = {
+    "legacy": (legacy_get_user, legacy_ensure_user),
+    "current": (main.get_user, main.ensure_user),
+}
+
+
+def prepare():
+    # legacy-БД с той же схемой, но в старом режиме журнала
+    src = sqlite3.connect(main.DB_PATH)
+    schema = [r[0] for r in src.execute("SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'")]
+    src.close()
+    dst = sqlite3.connect(LEGACY_PATH)
+    dst.execute("PRAGMA journal_mode = DELETE")
+    for sql in schema:
+        dst.execute(sql)
+    dst.commit()
+    dst.close()
+    # новых пользователей не уведомляем — сеть в бенчмарке не нужна
+    main.notify_admins_new_user = lambda *a, **kw: None
+    for _, ensure_user in IMPLEMENTATIONS.values():
+        for uid in range(USERS):
+            ensure_user(uid, f"user{uid}", "Имя", "Фамилия")
+
+
+def run(label, fn, ops, threads):
+    per_thread = ops // threads
+
+    def worker(offset):
+        for i in range(per_thread):
+            fn((offset + i) % USERS)
+
+    pool = [threading.Thread(target=worker, args=(t * per_thread,)) for t in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+    total = per_thread * threads
+    print(f"{label:<28} {total:>7} ops  {elapsed:8.3f}s  {total / elapsed:10.0f} ops/sec")
+    return total / elapsed
+
+
+def main_bench():
+    ops = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    prepare()
+    print(f"SQLite {sqlite3.sqlite_version}, потоков: {threads}, БД: {TMP_DIR}")
+    results = {}
+    for label, (get_user, ensure_user) in IMPLEMENTATIONS.items():
+        results[(label, "get_user")] = run(f"{label}: get_user", get_user, ops, threads)
+        results[(label, "ensure_user")] = run(
+            f"{label}: ensure_user",
+            lambda uid: ensure_user(uid, f"user{uid}", "Имя", "Фамилия"),
+            ops, threads)
+    for name in ("get_user", "ensure_user"):
+        speedup = results[("current", name)] / results[("legacy", name)]
+        print(f"{name}: x{speedup:.1f}")
+    main.close_db()
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Микро-бенчмарк сериализации клавиатур на пути отправки: мкс на сообщение
+- legacy:  как раньше — InlineKeyboardMarkup собирается заново и to_json() на каждую отправку
+- current: main.kb_* — готовая JSON-строка (статичные) или шаблон + LRU (с id анкеты)
+Меряется ровно то, что делает telebot перед запросом: apihelper._convert_markup(reply_markup).
+
+Запуск: python bench/bench_keyboards.py [сообщений]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench_kb_"), "kb.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from telebot import apihelper  # noqa: E402
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton  # noqa: E402
+
+# «живых» анкет, по которым ходят кнопки (id повторяются, как в реальном трафике)
+ACTIVE_APPS = 200
+
+
+def legacy_kb_start_pending():
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton("📝 Создать анкету", callback_data="create_app"))
+    kb.add(InlineKeyboardButton("ℹ️ Статус", callback_data="show_status"))
+    return kb
+
+
+def legacy_section_kb():
+    kb = InlineKeyboardMarkup(row_width=1)
+    kb.add(
+        InlineKeyboardButton("Пары", callback_data="sec_пары"),
+        InlineKeyboardButton("Будуар", callback_data="sec_будуар"),
+        InlineKeyboardButton("Гараж", callback_data="sec_гараж")
+    )
+    return kb
+
+
+def legacy_kb_media_actions(application_id):
+    kb = InlineKeyboardMarkup(row_width=2)
+    kb.add(
+        InlineKeyboardButton("➕ Добавить обычное", callback_data=f"add_normal_{application_id}"),
+        InlineKeyboardButton("➕ Добавить интимное", callback_data=f"add_intimate_{application_id}")
+    )
+    kb.add(
+        InlineKeyboardButton("✅ Готово (отправить на модерацию)", callback_data=f"submit_app_{application_id}"),
+        InlineKeyboardButton("🔄 Сбросить анкету", callback_data=f"reset_app_{application_id}")
+    )
+    return kb
+
+
+def legacy_kb_moderation(app_id):
+    kb = InlineKeyboardMarkup(row_width=2)
+    kb.add(
+        InlineKeyboardButton("✅ Одобрить", callback_data=f"mod_app_appr_{app_id}"),
+        InlineKeyboardButton("❌ Отклонить", callback_data=f"mod_app_rej_{app_id}"),
+    )
+    kb.add(
+        InlineKeyboardButton("✏️ Запросить правки", callback_data=f"mod_app_fix_{app_id}"),
+        InlineKeyboardButton("👁️ Просмотреть", callback_data=f"mod_app_view_{app_id}")
+    )
+    return kb
+
+
+def legacy_kb_admin_main():
+    kb = InlineKeyboardMarkup(row_width=2)
+    kb.add(
+        InlineKeyboardButton("⏳ Ожидают", callback_data="admin_pending"),
+        InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
+    )
+    kb.add(InlineKeyboardButton("👥 Пользователи", callback_data="admin_users"))
+    return kb
+
+
+KEYBOARDS = {
+    "kb_start_pending": (lambda i: legacy_kb_start_pending(), lambda i: main.kb_start_pending()),
+    "section_kb": (lambda i: legacy_section_kb(), lambda i: main.section_kb()),
+    "kb_admin_main": (lambda i: legacy_kb_admin_main(), lambda i: main.kb_admin_main()),
+    "kb_media_actions": (legacy_kb_media_actions, main.kb_media_actions),
+    "kb_moderation": (legacy_kb_moderation, main.kb_moderation),
+}
+
+
+def check_equal():
+    # та же разметка, что раньше — иначе сравнение не имеет смысла
+    for name, (legacy, current) in KEYBOARDS.items():
+        old = json.loads(apihelper._convert_markup(legacy(42)))
+        new = json.loads(apihelper._convert_markup(current(42)))
+        assert old == new, (name, old, new)
+
+
+def run(fn, messages):
+    started = time.perf_counter()
+    for i in range(messages):
+        apihelper._convert_markup(fn(1000 + i % ACTIVE_APPS))
+    return (time.perf_counter() - started) / messages * 1e6
+
+
+def main_bench():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    check_equal()
+    print(f"{'клавиатура':<18} {'legacy, мкс':>12} {'current, мкс':>13} {'ускорение':>10}")
+    for name, (legacy, current) in KEYBOARDS.items():
+        old = run(legacy, messages)
+        new = run(current, messages)
+        print(f"{name:<18} {old:12.2f} {new:13.3f} {old / new:9.0f}x")
+    main.close_db()
+
+
+if __name__ == "__main__":
+    main_bench()
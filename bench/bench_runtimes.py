@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Сравнение рантаймов: синхронный (main.py, пул потоков) vs асинхронный (main_async.py)
+- Каждый рантайм — в отдельном процессе со своей временной БД
+- Bot API подменяется фейковым сервером (bench/fake_api.py) с заданной задержкой
+- Реплей одинаковых синтетических апдейтов: /start, создание анкеты, выбор раздела, /status, /my, фото
+
+Запуск: python bench/bench_runtimes.py [пользователей] [задержка API, сек]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from updates import message, callback
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RUNTIMES = ("sync", "async")
+
+
+def build_updates(users: int):
+    from telebot import types
+
+    steps = [
+        lambda uid, n: message(uid, n, text="/start"),
+        lambda uid, n: callback(uid, n, "create_app"),
+        lambda uid, n: callback(uid, n, "sec_пары"),
+        lambda uid, n: message(uid, n, text="/status"),
+        lambda uid, n: message(uid, n, text="/my"),
+        lambda uid, n: message(uid, n, photo=f"photo{uid}"),
+    ]
+    raw = []
+    update_id = 1
+    # шаги пользователей вперемешку — как в реальном потоке апдейтов
+    for step in steps:
+        for uid in range(1_000_000, 1_000_000 + users):
+            raw.append(step(uid, update_id))
+            update_id += 1
+    return [types.Update.de_json(json.dumps(u)) for u in raw]
+
+
+def child(runtime: str, users: int, latency: float):
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, BENCH_DIR)
+    import logging
+    import fake_api
+    from telebot import apihelper, asyncio_helper
+
+    server = fake_api.start(latency)
+    apihelper.API_URL = server.api_url
+    asyncio_helper.API_URL = server.api_url
+    updates = build_updates(users)
+
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    # уведомления в один админский чат упираются в лимит 1 msg/s на чат — меряем рантайм, а не лимитер
+    main.ADMIN_IDS.clear()
+    if runtime == "sync":
+        started = time.perf_counter()
+        main.dispatcher.submit(updates)
+        main.dispatcher.join()
+        main.outbound.join(timeout=300)
+        elapsed = time.perf_counter() - started
+    else:
+        import asyncio
+        import main_async
+
+        async def replay():
+            started = time.perf_counter()
+            await main_async.dispatcher.submit(updates)
+            await main_async.dispatcher.join()
+            await main_async.sender.drain()
+            elapsed = time.perf_counter() - started
+            await main_async.abot.close_session()
+            return elapsed
+
+        elapsed = asyncio.run(replay())
+    main.activity.flush()
+    print(json.dumps({"updates": len(updates), "elapsed": elapsed, "api_calls": server.total_calls()}))
+
+
+def run_child(runtime: str, users: int, latency: float) -> dict:
+    env = dict(os.environ, DB_PATH=os.path.join(tempfile.mkdtemp(prefix=f"bench_{runtime}_"), "bot.db"))
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", runtime, str(users), str(latency)],
+                         env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main_bench():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    print(f"Пользователей: {users}, задержка Bot API: {latency * 1000:.0f} мс")
+    results = {}
+    for runtime in RUNTIMES:
+        r = results[runtime] = run_child(runtime, users, latency)
+        rate = r["updates"] / r["elapsed"]
+        print(f"{runtime:<6} {r['updates']:>6} апдейтов  {r['api_calls']:>6} вызовов API  "
+              f"{r['elapsed']:8.2f}s  {rate:8.0f} апдейтов/сек")
+    speedup = results["sync"]["elapsed"] / results["async"]["elapsed"]
+    print(f"async / sync: x{speedup:.1f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        child(sys.argv[2], int(sys.argv[3]), float(sys.argv[4]))
+    else:
+        main_bench()
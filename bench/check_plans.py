@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Проверка планов горячих запросов (EXPLAIN QUERY PLAN) на схеме после миграций
+- Запросы берутся из реальных вызовов функций main.py (trace соединений), а не из копий SQL
+- FAIL, если запрос читает таблицу целиком (SCAN) или сортирует во временном B-дереве там, где это не разрешено
+- Код выхода 1 при регрессии — годится для CI / перед деплоем
+
+Запуск: python bench/check_plans.py
+"""
+import os
+import sys
+import tempfile
+
+TMP_DIR = tempfile.mkdtemp(prefix="check_plans_")
+os.environ["DB_PATH"] = os.path.join(TMP_DIR, "plans.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+# Планы снимаются с запросов, которые функции main.py реально выполнили (trace соединений пула,
+# параметры уже подставлены) — копий SQL здесь нет, изменённый запрос проверяется как есть.
+# (название, вызов, что разрешено в плане: "TEMP B-TREE" — досортировка, "SCAN <таблица>" — скан)
+HOT_CALLS = [
+    ("get_user", lambda: main.get_user(1), ()),
+    ("upsert_user: новый", lambda: main.upsert_user(100, "new", "New"), ()),
+    ("upsert_user: смена профиля", lambda: main.upsert_user(1, "renamed", "Renamed"), ()),
+    ("get_active_application_for_user", lambda: main.get_active_application_for_user(1), ()),
+    ("get_user_applications (/my)", lambda: main.get_user_applications(1), ()),
+    ("get_pending_page: первая страница", lambda: main.get_pending_page(), ()),
+    ("get_pending_page: раздел, старше курсора", lambda: main.get_pending_page("пары", (1700000000, 1)), ()),
+    ("get_pending_page: новее курсора", lambda: main.get_pending_page(None, (1700000000, 1), "p"), ()),
+    # stats_counters — десятки строк (метрика x ключ), читается целиком
+    ("get_stats", lambda: main.get_stats(), ("SCAN stats_counters",)),
+    ("get_application / get_media_counts", lambda: main.get_application(1), ()),
+    # медиа одной анкеты — единицы строк, досортировка по id дешёвая
+    ("get_application_media", lambda: main.get_application_media(1), ("TEMP B-TREE",)),
+    ("delete_application", lambda: main.delete_application(seeded["deleted"], 5), ()),
+    ("outbox: забрать созревшие", lambda: main.outbox._claim(), ()),
+    ("outbox: недоставленные", lambda: main.outbox.pending(), ()),
+    # раз в сутки, пачкой до ARCHIVE_BATCH — досортировка по id допустима
+    ("archive_resolved_applications", lambda: main.archive_resolved_applications(), ("TEMP B-TREE",)),
+    # user_state — только живые сессии (строки старше STATE_TTL_HOURS удаляются), поиск сирот — скан с поиском по PK
+    ("expire_user_states", lambda: main.expire_user_states(), ("SCAN s",)),
+    ("expire_drafts", lambda: main.expire_drafts(notify=False), ()),
+]
+
+# id анкет, созданных seed()
+seeded = {}
+# выполненные запросы текущего вызова
+_traced = []
+_DML = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+
+
+def _trace(statement: str):
+    if statement.lstrip()[:7].upper().startswith(_DML):
+        _traced.append(statement)
+
+
+def install_trace():
+    """Каждое новое соединение пула пишет выполненные запросы в _traced"""
+    main.close_db()
+    open_conn = main._pool._open
+
+    def traced_open():
+        conn = open_conn()
+        conn.set_trace_callback(_trace)
+        return conn
+
+    main._pool._open = traced_open
+
+
+def seed():
+    """Строки, на которых функции проходят все ветки (включая запросы после непустой выборки)"""
+    old = "datetime('now', '-400 days')"
+    for uid in range(1, 6):
+        main.upsert_user(uid, f"u{uid}", "Plan")
+    active = main.create_application(1, "пары")
+    main.add_media(active, "normal", "photo", "n1")
+    resolved = main.create_application(2, "гараж")
+    main.set_application_status(resolved, 1, 0)
+    main.db_execute(f"UPDATE applications SET created_at = {old}, moderated_at = {old} WHERE id = ?", (resolved,))
+    draft = main.create_application(3, "будуар")
+    main.db_execute(f"UPDATE applications SET created_at = {old} WHERE id = ?", (draft,))
+    main.db_execute(f"UPDATE user_state SET updated_at = {old} WHERE user_id IN (3, 4)")
+    seeded["deleted"] = main.create_application(5, "пары")
+    for cache in (main._user_cache, main._state_cache, main._app_cache):
+        cache.clear()
+
+
+def plan(conn, sql):
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+
+
+def problems(details, allowed):
+    # json_each — список id из параметра, а не таблица
+    found = [d for d in details if d.startswith("SCAN ") and not d.startswith("SCAN json_each")]
+    found += [d for d in details if "TEMP B-TREE" in d]
+    return [d for d in found if not any(d.startswith(a) or a in d for a in allowed)]
+
+
+def main_check() -> int:
+    install_trace()
+    seed()
+    calls = []
+    for name, call, allowed in HOT_CALLS:
+        _traced.clear()
+        call()
+        # один и тот же запрос в цикле пачек — проверяем один раз
+        calls.append((name, list(dict.fromkeys(_traced)), allowed))
+    conn = main._pool.acquire()
+    failed = 0
+    try:
+        conn.set_trace_callback(None)
+        # запросы архивации ссылаются на схему archive
+        conn.execute("ATTACH DATABASE ? AS archive", (main.ARCHIVE_DB_PATH,))
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        print(f"SQLite {main.sqlite3.sqlite_version}, схема v{version}")
+        for name, statements, allowed in calls:
+            if not statements:
+                print(f"FAIL  {name}: не выполнил ни одного запроса")
+                failed += 1
+                continue
+            for sql in statements:
+                details = plan(conn, sql)
+                bad = problems(details, allowed)
+                print(f"{'FAIL' if bad else 'ok':<4}  {name}: {' '.join(sql.split())[:90]}")
+                for d in details:
+                    print(f"        {d}")
+                failed += bool(bad)
+        conn.execute("DETACH DATABASE archive")
+    finally:
+        main._pool.release(conn)
+        main.close_db()
+    print(f"Регрессий: {failed}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main_check())
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Фейковый Bot API для бенчмарков: отвечает правдоподобными результатами,
+считает вызовы по методам, умеет имитировать задержку сети
+
+Запуск отдельно: python bench/fake_api.py [порт] [задержка, сек]
+В коде: server = start(latency); apihelper.API_URL = server.api_url
+"""
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeBotAPI(ThreadingHTTPServer):
+    daemon_threads = True
+    # по умолчанию backlog 5: при всплеске соединений клиенты ловят повтор SYN (1–3 с) и портят замеры
+    request_queue_size = 1024
+
+    def __init__(self, port: int = 0, latency: float = 0.0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.latency = latency
+        self.calls = Counter()
+        self.rejected = Counter()  # вызовы, на которые настоящий Bot API ответил бы 400
+        self._lock = threading.Lock()
+        self._message_id = 0
+
+    @property
+    def api_url(self) -> str:
+        # формат telebot: API_URL.format(token, method)
+        return f"http://127.0.0.1:{self.server_address[1]}/bot{{0}}/{{1}}"
+
+    def next_message_id(self) -> int:
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def record(self, method: str):
+        with self._lock:
+            self.calls[method] += 1
+
+    def reject(self, method: str):
+        with self._lock:
+            self.rejected[method] += 1
+
+    def total_calls(self) -> int:
+        with self._lock:
+            return sum(self.calls.values())
+
+
+class BadRequest(Exception):
+    """Ответ 400, как у Bot API на некорректный вызов"""
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _params(self) -> dict:
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        ctype = self.headers.get("Content-Type", "")
+        if body and "json" in ctype:
+            params.update(json.loads(body))
+        elif body and "x-www-form-urlencoded" in ctype:
+            params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+        return params
+
+    def _message(self, params: dict) -> dict:
+        try:
+            chat_id = int(params.get("chat_id", 0))
+        except (TypeError, ValueError):
+            chat_id = 0
+        return {"message_id": self.server.next_message_id(), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+
+    def _result(self, method: str, params: dict):
+        if method in ("answerCallbackQuery", "deleteWebhook", "setWebhook", "deleteMessage"):
+            return True
+        if method == "getUpdates":
+            return []
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            if not 2 <= len(media) <= 10:
+                raise BadRequest("Bad Request: wrong number of media in the album (must be 2-10)")
+            return [self._message(params) for _ in media]
+        return self._message(params)
+
+    def _reply(self):
+        method = urlparse(self.path).path.rsplit("/", 1)[-1]
+        params = self._params()
+        self.server.record(method)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        try:
+            status, reply = 200, {"ok": True, "result": self._result(method, params)}
+        except BadRequest as e:
+            self.server.reject(method)
+            status, reply = 400, {"ok": False, "error_code": 400, "description": str(e)}
+        body = json.dumps(reply).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _reply
+    do_POST = _reply
+
+
+def start(latency: float = 0.0, port: int = 0) -> FakeBotAPI:
+    server = FakeBotAPI(port, latency)
+    threading.Thread(target=server.serve_forever, name="fake-bot-api", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    server = start(latency, port)
+    print(f"Fake Bot API: {server.api_url} (задержка {latency}s)")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print(dict(server.calls), "отклонено:", dict(server.rejected))
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Нагрузочный прогон хендлеров main.py на фейковом Bot API (офлайн, годится для CI)
+- Сценарии: start — шторм /start (новые и вернувшиеся пользователи),
+  albums — загрузка альбомов в media_receive, moderation — всплеск решений админа
+- Каждый сценарий — в отдельном процессе со своей временной БД; подготовка данных
+  идёт через функции модели и в замеры не попадает
+- Отчёт: апдейтов/сек, p50/p95/p99 по хендлерам, ожидание блокировки записи SQLite,
+  вызовы Bot API на апдейт (включая доставку outbox)
+- Перцентили — по бакетам гистограмм из main.metrics (как histogram_quantile в Prometheus)
+- Код выхода 1, если превышен порог (--max-p99-ms, --max-lock-wait-ms, --max-calls-per-update)
+
+Запуск: python bench/loadtest.py [--scenario all|start|albums|moderation] [--users 200] [--latency 0.01] [--json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from updates import user, message, callback
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ("start", "albums", "moderation")
+ADMIN_ID = 1
+ALBUM_SIZE = 10
+# столько секунд без вызовов Bot API считаем, что всё доставлено
+SETTLE_QUIET = 0.3
+# у фейкового API нет лимитов Telegram — меряем хендлеры, а не SendQueue; окно альбома короче
+CHILD_ENV = {
+    "SEND_GLOBAL_RATE": "100000",
+    "SEND_CHAT_RATE": "100000",
+    "SEND_CHAT_BURST": "100000",
+    "ALBUM_WINDOW_SECONDS": "0.2",
+    "OUTBOX_POLL_SECONDS": "0.2",
+}
+
+
+def scenario_start(main, users: int):
+    uids = range(1_000_000, 1_000_000 + users)
+    # первый проход — новые пользователи (upsert + уведомление админу), второй — вернувшиеся (кэш)
+    return [message(uid, 0, text="/start") for _ in range(2) for uid in uids]
+
+def scenario_albums(main, users: int):
+    uids = list(range(2_000_000, 2_000_000 + users))
+    for uid in uids:
+        main.upsert_user(uid, user(uid)["username"], user(uid)["first_name"])
+        app_id = main.create_application(uid, main.SECTIONS[uid % len(main.SECTIONS)])
+        main.set_user_state(uid, app_id, "normal", "awaiting_normal")
+    # файлы разных альбомов вперемешку — как при одновременной загрузке
+    return [message(uid, 0, photo=f"p{uid}_{i}", media_group_id=f"g{uid}")
+            for i in range(ALBUM_SIZE) for uid in uids]
+
+def scenario_moderation(main, users: int):
+    app_ids = []
+    for uid in range(3_000_000, 3_000_000 + users):
+        main.upsert_user(uid, user(uid)["username"], user(uid)["first_name"])
+        app_id = main.create_application(uid, main.SECTIONS[uid % len(main.SECTIONS)])
+        main.add_media_batch(app_id, "normal", [("photo", f"n{uid}")])
+        main.add_media_batch(app_id, "intimate", [("photo", f"i{uid}")])
+        if app_id < 0:
+            # DRAFT_STORE=1: в очередь модерации попадают только отправленные анкеты
+            app_id = main.persist_draft(app_id)
+        app_ids.append(app_id)
+    decisions = ("mod_app_appr", "mod_app_rej", "mod_app_fix")
+    updates = [callback(ADMIN_ID, 0, "admin_pending")]
+    for n, app_id in enumerate(app_ids):
+        updates.append(callback(ADMIN_ID, 0, f"{decisions[n % len(decisions)]}_{app_id}"))
+        if n % 20 == 0:
+            updates.append(callback(ADMIN_ID, 0, "admin_pending"))
+    return updates
+
+
+# ---------- Метрики ----------
+def snapshot(histogram) -> dict:
+    with histogram._lock:
+        return {labels: (list(counts), count) for labels, (counts, _, count) in histogram._series.items()}
+
+def delta(before: dict, after: dict) -> dict:
+    result = {}
+    for labels, (counts, count) in after.items():
+        old_counts, old_count = before.get(labels, ([0] * len(counts), 0))
+        if count > old_count:
+            result[labels] = ([c - o for c, o in zip(counts, old_counts)], count - old_count)
+    return result
+
+def quantile(buckets, counts, count: int, q: float) -> float:
+    """Линейная интерполяция внутри бакета; в +Inf — верхняя конечная граница"""
+    target = q * count
+    cumulative = 0
+    for i, n in enumerate(counts):
+        if n and cumulative + n >= target:
+            if i == len(buckets):
+                return buckets[-1]
+            lower = buckets[i - 1] if i else 0.0
+            return lower + (buckets[i] - lower) * (target - cumulative) / n
+        cumulative += n
+    return 0.0
+
+def summary(buckets, counts, count: int) -> dict:
+    return {"count": count, **{f"p{int(q * 100)}_ms": round(quantile(buckets, counts, count, q) * 1000, 3)
+                               for q in (0.5, 0.95, 0.99)}}
+
+
+def settle(main, server, quiet: float = SETTLE_QUIET, timeout: float = 120):
+    """
+    Дождаться, пока обработаны апдейты, сохранены альбомы и доставлен outbox.
+    Альбом уходит из albums.pending() до ответа пользователю — поэтому ещё ждём тишины в Bot API.
+    """
+    main.dispatcher.join()
+    deadline = time.monotonic() + timeout
+    calls, quiet_since = -1, time.monotonic()
+    while time.monotonic() < deadline:
+        busy = main.albums.pending() or main.outbox.pending() or main.outbound.depth()
+        total = server.total_calls()
+        if busy or total != calls:
+            calls, quiet_since = total, time.monotonic()
+        elif time.monotonic() - quiet_since >= quiet:
+            break
+        time.sleep(0.05)
+    main.outbox.flush()
+
+
+def child(scenario: str, users: int, latency: float):
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, BENCH_DIR)
+    import logging
+    import fake_api
+    from telebot import apihelper, types
+
+    server = fake_api.start(latency)
+    apihelper.API_URL = server.api_url
+
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    main.ADMIN_IDS[:] = [ADMIN_ID]
+    raw = globals()[f"scenario_{scenario}"](main, users)
+    settle(main, server)
+    for update_id, update in enumerate(raw, start=1):
+        update["update_id"] = update_id
+        if "callback_query" in update:
+            update["callback_query"]["id"] = str(update_id)
+        for key in ("message", "callback_query"):
+            if key in update and "message_id" in update[key]:
+                update[key]["message_id"] = update_id
+    updates = [types.Update.de_json(json.dumps(u)) for u in raw]
+
+    handlers_before, lock_before = snapshot(main.HANDLER_LATENCY), snapshot(main.DB_LOCK_WAIT)
+    calls_before, rejected_before = dict(server.calls), dict(server.rejected)
+    started = time.perf_counter()
+    main.dispatcher.submit(updates)
+    main.dispatcher.join()
+    handled = time.perf_counter() - started
+    settle(main, server)
+    # минус тишина, которой settle убеждается, что всё закончилось
+    elapsed = time.perf_counter() - started - SETTLE_QUIET
+
+    buckets = main.HANDLER_LATENCY.buckets
+    handlers = {labels[0]: summary(buckets, counts, count)
+                for labels, (counts, count) in sorted(delta(handlers_before, snapshot(main.HANDLER_LATENCY)).items())}
+    lock = delta(lock_before, snapshot(main.DB_LOCK_WAIT)).get((), ([0] * (len(buckets) + 1), 0))
+    calls = {m: n - calls_before.get(m, 0) for m, n in server.calls.items() if n > calls_before.get(m, 0)}
+    rejected = {m: n - rejected_before.get(m, 0) for m, n in server.rejected.items() if n > rejected_before.get(m, 0)}
+    main.close_db()
+    print(json.dumps({
+        "scenario": scenario, "updates": len(updates), "handled_s": handled, "elapsed_s": elapsed,
+        "updates_per_s": len(updates) / handled, "handlers": handlers,
+        "lock_wait": summary(main.DB_LOCK_WAIT.buckets, *lock),
+        "api_calls": calls, "api_rejected": rejected, "calls_per_update": sum(calls.values()) / len(updates),
+    }))
+
+
+def run_child(scenario: str, users: int, latency: float) -> dict:
+    env = dict(os.environ, **CHILD_ENV, DB_PATH=os.path.join(tempfile.mkdtemp(prefix=f"loadtest_{scenario}_"), "bot.db"))
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", scenario, str(users), str(latency)],
+                         env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def check(report: dict, args) -> list:
+    problems = []
+    # некорректный вызов (например, sendMediaGroup из одного файла) — ошибка при любых порогах
+    for method, n in report["api_rejected"].items():
+        problems.append(f"{report['scenario']}: Bot API отклонил {method} {n} раз(а)")
+    for name, h in report["handlers"].items():
+        if args.max_p99_ms and h["p99_ms"] > args.max_p99_ms:
+            problems.append(f"{report['scenario']}: {name} p99 {h['p99_ms']} мс > {args.max_p99_ms}")
+    if args.max_lock_wait_ms and report["lock_wait"]["p99_ms"] > args.max_lock_wait_ms:
+        problems.append(f"{report['scenario']}: ожидание блокировки p99 {report['lock_wait']['p99_ms']} мс "
+                        f"> {args.max_lock_wait_ms}")
+    if args.max_calls_per_update and report["calls_per_update"] > args.max_calls_per_update:
+        problems.append(f"{report['scenario']}: вызовов API на апдейт {report['calls_per_update']:.2f} "
+                        f"> {args.max_calls_per_update}")
+    return problems
+
+
+def print_report(r: dict):
+    print(f"\n== {r['scenario']}: {r['updates']} апдейтов, {r['updates_per_s']:.0f} апдейтов/сек "
+          f"(обработка {r['handled_s']:.2f}s, с доставкой {r['elapsed_s']:.2f}s)")
+    print(f"   {'хендлер':<24} {'вызовов':>8} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+    for name, h in r["handlers"].items():
+        print(f"   {name:<24} {h['count']:>8} {h['p50_ms']:>9.2f} {h['p95_ms']:>9.2f} {h['p99_ms']:>9.2f}")
+    lw = r["lock_wait"]
+    print(f"   ожидание _db_lock: {lw['count']} раз, p50 {lw['p50_ms']:.2f} / p95 {lw['p95_ms']:.2f} / p99 {lw['p99_ms']:.2f} мс")
+    calls = ", ".join(f"{m} {n}" for m, n in sorted(r["api_calls"].items()))
+    print(f"   Bot API: {r['calls_per_update']:.2f} вызовов на апдейт ({calls})")
+    if r["api_rejected"]:
+        print(f"   отклонено Bot API: {r['api_rejected']}")
+
+
+def main_loadtest() -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон хендлеров на фейковом Bot API")
+    parser.add_argument("--scenario", choices=("all",) + SCENARIOS, default="all")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.01, help="задержка фейкового Bot API, сек")
+    parser.add_argument("--json", action="store_true", help="вывести отчёт JSON (для CI)")
+    parser.add_argument("--max-p99-ms", type=float, default=0, help="порог p99 любого хендлера")
+    parser.add_argument("--max-lock-wait-ms", type=float, default=0, help="порог p99 ожидания блокировки записи")
+    parser.add_argument("--max-calls-per-update", type=float, default=0, help="порог вызовов Bot API на апдейт")
+    args = parser.parse_args()
+    scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    reports = [run_child(s, args.users, args.latency) for s in scenarios]
+    problems = [p for r in reports for p in check(r, args)]
+    if args.json:
+        print(json.dumps({"reports": reports, "problems": problems}, ensure_ascii=False, indent=2))
+    else:
+        print(f"Пользователей: {args.users}, задержка Bot API: {args.latency * 1000:.0f} мс")
+        for r in reports:
+            print_report(r)
+        print(f"\nПревышений порогов: {len(problems)}")
+        for p in problems:
+            print(f"FAIL  {p}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        child(sys.argv[2], int(sys.argv[3]), float(sys.argv[4]))
+    else:
+        sys.exit(main_loadtest())
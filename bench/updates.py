@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Синтетические апдейты Telegram для бенчмарков (общие для bench_runtimes.py и loadtest.py)
+- Словари в формате Bot API: из них делается types.Update.de_json или они отдаются в process_new_updates
+- user(uid) — отправитель; подготовка данных в бенчмарках регистрирует пользователя с теми же
+  username/first_name, чтобы апдейт не считался сменой профиля
+
+В коде: from updates import message, callback
+"""
+import time
+
+
+def user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": "Bench", "username": f"bench{uid}"}
+
+def message(uid: int, update_id: int, text=None, photo=None, media_group_id=None) -> dict:
+    msg = {"message_id": update_id, "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "from": user(uid)}
+    if text:
+        msg["text"] = text
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    if photo:
+        msg["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 1, "height": 1}]
+    if media_group_id:
+        msg["media_group_id"] = media_group_id
+    return {"update_id": update_id, "message": msg}
+
+def callback(uid: int, update_id: int, data: str) -> dict:
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": "bench", "data": data, "from": user(uid),
+        "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": uid, "type": "private"}}}}
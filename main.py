@@ -18,15 +18,26 @@ import logging
 import threading
 import sqlite3
 from datetime import datetime, timedelta
-from typing import Optional, Tuple, Dict, Any
+from typing import Optional, Tuple, Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request
 import signal
+import atexit
 import time
 import json
+import hmac
+import queue
+import functools
+import heapq
+import itertools
+import bisect
+from contextlib import contextmanager
+from collections import OrderedDict
 
 import telebot
 from telebot import apihelper
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputMediaVideo
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout as RequestsTimeout
 
 # ---------- ЛОГИРОВАНИЕ ----------
 logging.basicConfig(
@@ -44,31 +55,300 @@ BOT_TOKEN = "8485486677:AAHqx7YjGMn5pn2pDTADwllNDjJmYAK-KFI"
 # ID администраторов (список чисел)
 ADMIN_IDS = [5064426902]  # можешь добавить через запятую несколько ID
 
-# Лимит частоты (минуты). Если не используешь — оставляй как есть.
+# Лимит частоты создания анкет (минуты). Остальные лимиты — RATE_LIMITS ниже.
 RATE_LIMIT_MINUTES = 5
 
 # Ключ для внутреннего API админов (можешь оставить любое значение)
 ADMIN_API_KEY = "secret"
 
-# Инициализация бота
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="Markdown")
+# Разделы анкет (значение callback sec_{раздел} и фильтр очереди модерации)
+SECTIONS = ("пары", "будуар", "гараж")
+# Анкет на одной странице очереди модерации
+PENDING_PAGE_SIZE = int(os.getenv("PENDING_PAGE_SIZE", "10"))
+
+# Режим получения апдейтов: polling (по умолчанию) или webhook.
+# В webhook-режиме Telegram шлёт апдейты POST-запросом в Flask (WEBHOOK_PATH).
+# Зарегистрировать вебхук: BOT_MODE=webhook WEBHOOK_URL=https://host python3 main.py set-webhook
+# Под gunicorn — только один воркер: gunicorn -w 1 'main:create_app()' (второй процесс не запустится).
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram-webhook")
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token (задаётся при set_webhook);
+# без него webhook-режим не запускается, а маршрут отвечает 403
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+ALLOWED_UPDATES = ['message', 'callback_query']
+
+# Сколько потоков обрабатывают апдейты (апдейты одного пользователя — строго по порядку)
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+
+# Инициализация бота (threaded=False: апдейты раздаёт UpdateDispatcher)
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="Markdown", threaded=False)
+
+# ---------- Метрики (формат Prometheus) ----------
+# Границы бакетов гистограмм задержек (секунды)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra: str = "") -> str:
+    parts = [f'{n}="{_label_value(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    """Монотонный счётчик с метками"""
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, values)} {value}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма с фиксированными бакетами и метками (p99 считает Prometheus по бакетам)"""
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label_values -> [счётчики по бакетам (+Inf последним), сумма, количество]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((values, list(counts), total, count) for values, (counts, total, count) in self._series.items())
+        for values, counts, total, count in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, values)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, values)} {count}")
+        return lines
+
+
+class Gauge:
+    """Снимаемое в момент запроса значение: fn() -> число или {значения меток: число}"""
+
+    def __init__(self, name: str, help_text: str, fn, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+        self.labels = tuple(labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.fn()
+        except Exception as e:
+            logger.debug("Метрика %s недоступна: %s", self.name, e)
+            return lines
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for values, v in items:
+            values = values if isinstance(values, tuple) else (values,)
+            lines.append(f"{self.name}{_format_labels(self.labels, values)} {v}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels=()) -> Counter:
+        return self.register(Counter(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name: str, help_text: str, fn, labels=()) -> Gauge:
+        return self.register(Gauge(name, help_text, fn, labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.histogram("bot_handler_duration_seconds", "Время работы хендлера", ("handler",))
+HANDLER_ERRORS = metrics.counter("bot_handler_errors_total", "Исключения в хендлерах", ("handler",))
+DB_QUERY_LATENCY = metrics.histogram("bot_db_query_duration_seconds", "Время запроса db_execute", ("query",))
+DB_QUERY_ERRORS = metrics.counter("bot_db_query_errors_total", "Ошибки запросов db_execute", ("query",))
+DB_LOCK_WAIT = metrics.histogram("bot_db_lock_wait_seconds", "Ожидание блокировки записи _db_lock")
+API_LATENCY = metrics.histogram("bot_api_request_duration_seconds", "Время вызова Bot API", ("method",),
+                                buckets=LATENCY_BUCKETS + (30.0, 60.0, 120.0))
+API_ERRORS = metrics.counter("bot_api_errors_total", "Неуспешные вызовы Bot API", ("method", "code"))
+
+@functools.lru_cache(maxsize=1024)
+def _query_label(query: str) -> str:
+    """Метка запроса: SQL в одну строку, без параметров (кардинальность = число разных запросов в коде)"""
+    return " ".join(query.split())[:120]
+
+def _api_error_code(e: Exception) -> str:
+    """Метка ошибки Bot API: код Telegram, HTTP-статус или имя исключения сети"""
+    code = getattr(e, "error_code", None) or getattr(getattr(e, "result", None), "status_code", None)
+    return str(code) if code else type(e).__name__
+
+def _timed(make_request):
+    """Замер вокруг apihelper._make_request: сам запрос (сессия, прокси, RETRY_ON_ERROR) делает telebot"""
+    @functools.wraps(make_request)
+    def wrapper(token, method_name, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return make_request(token, method_name, *args, **kwargs)
+        except Exception as e:
+            API_ERRORS.inc(method_name, _api_error_code(e))
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - started, method_name)
+    return wrapper
+
+# _make_request — единая точка всех синхронных вызовов в apihelper (сигнатура сверена с
+# pyTelegramBotAPI==4.15.0 из requirements.txt; при обновлении telebot проверить)
+apihelper._make_request = _timed(apihelper._make_request)
 
 # ---------- БАЗА ДАННЫХ (потокобезопасно) ----------
 DB_PATH = os.getenv("DB_PATH", "moderation_bot.db")
-_db_lock = threading.Lock()
+# Пул долгоживущих соединений: сколько держим открытыми одновременно
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+# Кэш страниц SQLite на соединение (КиБ) и окно mmap (байт)
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "8192"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+# Сколько ждать, если файл занят другим процессом (секунды)
+DB_BUSY_TIMEOUT = 5.0
 
-def _conn():
-    # отдельное соединение на вызов
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Блокировка только для записи: в режиме WAL читатели не ждут писателя
+_db_lock = threading.Lock()
+# Соединение открытой транзакции текущего потока (см. db_transaction)
+_db_local = threading.local()
 
-def init_db():
+@contextmanager
+def _write_lock():
+    """_db_lock с замером ожидания (метрика bot_db_lock_wait_seconds)"""
+    started = time.perf_counter()
     with _db_lock:
-        conn = _conn()
-        cur = conn.cursor()
+        DB_LOCK_WAIT.observe(time.perf_counter() - started)
+        yield
+
+
+def _rollback_quietly(conn: sqlite3.Connection):
+    """ROLLBACK без исключений: транзакции может уже не быть (SQLite сам откатывает её при части ошибок)"""
+    try:
+        conn.execute("ROLLBACK")
+    except sqlite3.Error:
+        pass
+
+
+class ConnectionPool:
+    """Небольшой пул соединений SQLite, переиспользуемых между вызовами"""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self._idle = []
+        self._created = 0
+        self._cond = threading.Condition()
+
+    def _open(self) -> sqlite3.Connection:
+        # isolation_level=None: автокоммит, транзакции открываем явно
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None,
+                               timeout=DB_BUSY_TIMEOUT)
+        conn.row_factory = sqlite3.Row
+        # pragma уровня соединения — один раз при открытии
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        with self._cond:
+            while not self._idle and self._created >= self.size:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+        try:
+            return self._open()
+        except Exception:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn: sqlite3.Connection):
+        """Вернуть соединение; с незавершённой транзакцией — откатить, а не вышло — закрыть"""
+        if conn.in_transaction:
+            _rollback_quietly(conn)
+        if conn.in_transaction:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            for conn in self._idle:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._created -= len(self._idle)
+            self._idle = []
+
+
+_pool = ConnectionPool(DB_PATH, DB_POOL_SIZE)
+
+def _is_read_query(query: str) -> bool:
+    return query.lstrip()[:6].upper() == "SELECT"
+
+# Миграции схемы: (версия, описание, SQL). Применённая версия хранится в PRAGMA user_version.
+# Новые изменения схемы — только новой записью в конец списка, старые не редактировать.
+MIGRATIONS = [
+    (1, "базовая схема", [
         # users: статус pending/approved/banned
-        cur.execute("""
+        """
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -78,9 +358,9 @@ def init_db():
             last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-        """)
+        """,
         # applications: одна заявка/пользователь (можно создавать новые, но только одна активная pending)
-        cur.execute("""
+        """
         CREATE TABLE IF NOT EXISTS applications (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
@@ -91,9 +371,9 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
         )
-        """)
+        """,
         # media: прикреплённые файлы к application
-        cur.execute("""
+        """
         CREATE TABLE IF NOT EXISTS media (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             application_id INTEGER NOT NULL,
@@ -103,9 +383,9 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (application_id) REFERENCES applications(id) ON DELETE CASCADE
         )
-        """)
+        """,
         # user_state: временное состояние для загрузки медиа и выбора действий
-        cur.execute("""
+        """
         CREATE TABLE IF NOT EXISTS user_state (
             user_id INTEGER PRIMARY KEY,
             current_app_id INTEGER,
@@ -113,220 +393,2224 @@ def init_db():
             last_action TEXT, -- for debug
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-        """)
-        # indexes
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_app_user ON applications(user_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_media_app ON media(application_id)")
-        conn.commit()
-        conn.close()
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_app_user ON applications(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_media_app ON media(application_id)",
+    ]),
+    (2, "составные индексы под горячие запросы", [
+        # активная анкета пользователя: WHERE user_id, status ORDER BY created_at
+        "CREATE INDEX IF NOT EXISTS idx_app_user_status_created ON applications(user_id, status, created_at)",
+        # rate limit и /my: WHERE user_id ORDER BY created_at
+        "CREATE INDEX IF NOT EXISTS idx_app_user_created ON applications(user_id, created_at)",
+        # очередь модерации и счётчики по статусу
+        "CREATE INDEX IF NOT EXISTS idx_app_status_created ON applications(status, created_at)",
+        # подсчёт медиа по типам — покрывающий индекс, таблица не читается
+        "CREATE INDEX IF NOT EXISTS idx_media_app_type ON media(application_id, media_type)",
+        # старые одноколоночные индексы — префиксы новых
+        "DROP INDEX IF EXISTS idx_app_user",
+        "DROP INDEX IF EXISTS idx_media_app",
+    ]),
+    (3, "счётчики медиа в applications", [
+        "ALTER TABLE applications ADD COLUMN normal_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE applications ADD COLUMN intimate_count INTEGER NOT NULL DEFAULT 0",
+        """
+        UPDATE applications SET
+            normal_count = (SELECT COUNT(*) FROM media m WHERE m.application_id = applications.id AND m.media_type = 'normal'),
+            intimate_count = (SELECT COUNT(*) FROM media m WHERE m.application_id = applications.id AND m.media_type = 'intimate')
+        """,
+        # счётчики ведёт сама БД — любой INSERT/DELETE в media их поправит
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_media_count_ins AFTER INSERT ON media BEGIN
+            UPDATE applications SET
+                normal_count = normal_count + (NEW.media_type = 'normal'),
+                intimate_count = intimate_count + (NEW.media_type = 'intimate')
+            WHERE id = NEW.application_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_media_count_del AFTER DELETE ON media BEGIN
+            UPDATE applications SET
+                normal_count = normal_count - (OLD.media_type = 'normal'),
+                intimate_count = intimate_count - (OLD.media_type = 'intimate')
+            WHERE id = OLD.application_id;
+        END
+        """,
+    ]),
+    (4, "очередь модерации по разделу", [
+        "CREATE INDEX IF NOT EXISTS idx_app_status_section_created ON applications(status, section, created_at)",
+    ]),
+    (5, "предагрегированная статистика", [
+        # текущие значения: users/статус, apps/статус:раздел, media/тип
+        """
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            metric TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (metric, key)
+        ) WITHOUT ROWID
+        """,
+        # по дням (UTC): users_new, apps_new/раздел, media_new/тип, decisions/модератор:статус
+        """
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, metric, key)
+        ) WITHOUT ROWID
+        """,
+        # заполнить по существующим данным
+        "INSERT INTO stats_counters (metric, key, value) SELECT 'users', status, COUNT(*) FROM users GROUP BY status",
+        """
+        INSERT INTO stats_counters (metric, key, value)
+        SELECT 'apps', status || ':' || section, COUNT(*) FROM applications GROUP BY status, section
+        """,
+        "INSERT INTO stats_counters (metric, key, value) SELECT 'media', media_type, COUNT(*) FROM media GROUP BY media_type",
+        """
+        INSERT INTO stats_daily (day, metric, key, value)
+        SELECT date(created_at), 'users_new', '', COUNT(*) FROM users GROUP BY date(created_at)
+        """,
+        """
+        INSERT INTO stats_daily (day, metric, key, value)
+        SELECT date(created_at), 'apps_new', section, COUNT(*) FROM applications GROUP BY date(created_at), section
+        """,
+        """
+        INSERT INTO stats_daily (day, metric, key, value)
+        SELECT date(created_at), 'media_new', media_type, COUNT(*) FROM media GROUP BY date(created_at), media_type
+        """,
+        """
+        INSERT INTO stats_daily (day, metric, key, value)
+        SELECT date(moderated_at), 'decisions', moderator_id || ':' || status, COUNT(*) FROM applications
+        WHERE moderator_id IS NOT NULL AND status != 0 GROUP BY date(moderated_at), moderator_id, status
+        """,
+        # дальше счётчики ведут триггеры на каждом переходе состояния
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_ins AFTER INSERT ON users BEGIN
+            INSERT INTO stats_counters (metric, key, value) VALUES ('users', NEW.status, 1)
+                ON CONFLICT (metric, key) DO UPDATE SET value = value + 1;
+            INSERT INTO stats_daily (day, metric, key, value) VALUES (date('now'), 'users_new', '', 1)
+                ON CONFLICT (day, metric, key) DO UPDATE SET value = value + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_upd AFTER UPDATE OF status ON users
+        WHEN OLD.status IS NOT NEW.status BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE metric = 'users' AND key = OLD.status;
+            INSERT INTO stats_counters (metric, key, value) VALUES ('users', NEW.status, 1)
+                ON CONFLICT (metric, key) DO UPDATE SET value = value + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_del AFTER DELETE ON users BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE metric = 'users' AND key = OLD.status;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stats_apps_ins AFTER INSERT ON applications BEGIN
+            INSERT INTO stats_counters (metric, key, value) VALUES ('apps', NEW.status || ':' || NEW.section, 1)
+                ON CONFLICT (metric, key) DO UPDATE SET value = value + 1;
+            INSERT INTO stats_daily (day, metric, key, value) VALUES (date('now'), 'apps_new', NEW.section, 1)
+                ON CONFLICT (day, metric, key) DO UPDATE SET value = value + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stats_apps_upd AFTER UPDATE OF status, section ON applications
+        WHEN OLD.status IS NOT NEW.status OR OLD.section IS NOT NEW.section BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE metric = 'apps' AND key = OLD.status || ':' || OLD.section;
+            INSERT INTO stats_counters (metric, key, value) VALUES ('apps', NEW.status || ':' || NEW.section, 1)
+                ON CONFLICT (metric, key) DO UPDATE SET value = value + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stats_decisions AFTER UPDATE OF status ON applications
+        WHEN NEW.moderator_id IS NOT NULL AND NEW.status != 0 AND OLD.status IS NOT NEW.status BEGIN
+            INSERT INTO stats_daily (day, metric, key, value)
+                VALUES (date('now'), 'decisions', NEW.moderator_id || ':' || NEW.status, 1)
+                ON CONFLICT (day, metric, key) DO UPDATE SET value = value + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stats_apps_del AFTER DELETE ON applications BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE metric = 'apps' AND key = OLD.status || ':' || OLD.section;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stats_media_ins AFTER INSERT ON media BEGIN
+            INSERT INTO stats_counters (metric, key, value) VALUES ('media', NEW.media_type, 1)
+                ON CONFLICT (metric, key) DO UPDATE SET value = value + 1;
+            INSERT INTO stats_daily (day, metric, key, value) VALUES (date('now'), 'media_new', NEW.media_type, 1)
+                ON CONFLICT (day, metric, key) DO UPDATE SET value = value + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_stats_media_del AFTER DELETE ON media BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE metric = 'media' AND key = OLD.media_type;
+        END
+        """,
+    ]),
+    (6, "outbox уведомлений", [
+        # status: 0 ждёт отправки, 1 отправляется, 2 доставлено, -1 не доставлено
+        # idem_key — повторная постановка того же уведомления игнорируется
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idem_key TEXT UNIQUE,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            reply_markup TEXT,
+            batch TEXT,
+            status INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)",
+    ]),
+    (7, "срок жизни user_state", [
+        # сборщик устаревших состояний: WHERE updated_at < ?
+        "CREATE INDEX IF NOT EXISTS idx_user_state_updated ON user_state(updated_at)",
+    ]),
+    (8, "created_at пользователей с точностью до секунды", [
+        # прежний upsert писал новым пользователям created_at с миллисекундами
+        "UPDATE users SET created_at = substr(created_at, 1, 19) WHERE length(created_at) > 19",
+    ]),
+]
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Применить недостающие миграции; каждая — отдельной транзакцией вместе с user_version"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, description, statements in MIGRATIONS:
+        if target <= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        logger.info("Миграция БД %s применена: %s", target, description)
+        version = target
+    return version
+
+def init_db():
+    conn = _pool.acquire()
+    try:
+        with _db_lock:
+            # на новой БД действует сразу (до создания таблиц); старую переведёт vacuum_and_analyze
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            # WAL сохраняется в файле БД — достаточно включить один раз
+            conn.execute("PRAGMA journal_mode = WAL")
+            migrate(conn)
+    finally:
+        _pool.release(conn)
+
+def close_db():
+    """Закрыть все соединения пула (при завершении процесса)"""
+    _pool.close()
 
 init_db()
 
 # ---------- Утилиты работы с БД ----------
+def _fetch_result(cur, rows, fetchone: bool, fetchall: bool, return_id: bool):
+    if return_id:
+        return cur.lastrowid
+    if fetchone:
+        return dict(rows[0]) if rows else None
+    if fetchall:
+        return [dict(r) for r in rows] if rows else []
+    return cur.rowcount
+
 def db_execute(query: str, params: Tuple = (), fetchone: bool = False, fetchall: bool = False, return_id: bool = False):
-    with _db_lock:
-        conn = _conn()
-        cur = conn.cursor()
+    started = time.perf_counter()
+    try:
+        return _db_execute(query, params, fetchone, fetchall, return_id)
+    finally:
+        DB_QUERY_LATENCY.observe(time.perf_counter() - started, _query_label(query))
+
+def _db_execute(query: str, params: Tuple, fetchone: bool, fetchall: bool, return_id: bool):
+    tx_conn = getattr(_db_local, "tx_conn", None)
+    if tx_conn is not None:
+        # внутри db_transaction(): то же соединение, коммит — в конце блока
         try:
-            cur.execute(query, params)
-            conn.commit()
-            if return_id:
-                return cur.lastrowid
+            cur = tx_conn.execute(query, params)
+            try:
+                rows = cur.fetchall() if (fetchone or fetchall) else None
+                return _fetch_result(cur, rows, fetchone, fetchall, return_id)
+            finally:
+                cur.close()
+        except Exception as e:
+            # ошибку отдаём наверх, чтобы откатить всю транзакцию
+            logger.error("DB error: %s | Q: %s | P: %s", e, query, params)
+            DB_QUERY_ERRORS.inc(_query_label(query))
+            raise
+    conn = _pool.acquire()
+    cur = None
+    try:
+        if _is_read_query(query):
+            # чтение идёт без блокировки: WAL отдаёт согласованный снимок
+            cur = conn.execute(query, params)
             if fetchone:
                 row = cur.fetchone()
                 return dict(row) if row else None
+            rows = cur.fetchall()
             if fetchall:
-                rows = cur.fetchall()
                 return [dict(r) for r in rows] if rows else []
             return cur.rowcount
-        except Exception as e:
-            logger.error("DB error: %s | Q: %s | P: %s", e, query, params)
-            return None
+        with _write_lock():
+            cur = conn.execute(query, params)
+            # выбираем всё под блокировкой, чтобы запись завершилась (RETURNING)
+            rows = cur.fetchall() if (fetchone or fetchall) else None
+        return _fetch_result(cur, rows, fetchone, fetchall, return_id)
+    except Exception as e:
+        logger.error("DB error: %s | Q: %s | P: %s", e, query, params)
+        DB_QUERY_ERRORS.inc(_query_label(query))
+        return None
+    finally:
+        if cur is not None:
+            cur.close()
+        _pool.release(conn)
+
+@contextmanager
+def db_transaction():
+    """
+    Единица работы: все db_execute внутри блока идут одной транзакцией
+    (одна блокировка, один коммит). Вложенные блоки присоединяются к внешнему.
+    При исключении (в том числе в COMMIT) всё откатывается.
+    """
+    conn = getattr(_db_local, "tx_conn", None)
+    if conn is not None:
+        yield conn
+        return
+    conn = _pool.acquire()
+    started = time.perf_counter()
+    _db_lock.acquire()
+    DB_LOCK_WAIT.observe(time.perf_counter() - started)
+    try:
+        # IMMEDIATE: сразу берём блокировку записи, без апгрейда посреди транзакции
+        conn.execute("BEGIN IMMEDIATE")
+        _db_local.tx_conn = conn
+        _db_local.tx_after_commit = []
+        try:
+            yield conn
+        except BaseException:
+            _rollback_quietly(conn)
+            raise
+        else:
+            try:
+                conn.execute("COMMIT")
+            except BaseException:
+                # COMMIT не прошёл (SQLITE_BUSY, IOERR) — транзакция ещё открыта, в пул её не отдаём
+                _rollback_quietly(conn)
+                raise
         finally:
-            conn.close()
+            _db_local.tx_conn = None
+    finally:
+        _db_lock.release()
+        _pool.release(conn)
+    for fn in _db_local.tx_after_commit:
+        fn()
+    _db_local.tx_after_commit = []
 
-# ---------- Основные функции модели ----------
-def ensure_user(user_id: int, username: Optional[str], first_name: Optional[str], last_name: Optional[str] = ""):
-    """Создать пользователя или обновить поля"""
-    existing = db_execute("SELECT * FROM users WHERE user_id = ?", (user_id,), fetchone=True)
-    if existing:
-        db_execute("""
-            UPDATE users SET username = ?, first_name = ?, last_name = ?, last_activity = CURRENT_TIMESTAMP
-            WHERE user_id = ?
-        """, (username, first_name, last_name, user_id))
+def in_transaction() -> bool:
+    return getattr(_db_local, "tx_conn", None) is not None
+
+def on_commit(fn):
+    """Выполнить fn после коммита текущей транзакции (или сразу, если её нет)"""
+    if in_transaction():
+        _db_local.tx_after_commit.append(fn)
     else:
-        db_execute("""
+        fn()
+
+def db_executemany(query: str, seq_of_params) -> Optional[int]:
+    """Пачка однотипных запросов одной транзакцией (executemany)"""
+    seq_of_params = list(seq_of_params)
+    nested = in_transaction()
+    try:
+        with db_transaction() as conn:
+            return conn.executemany(query, seq_of_params).rowcount
+    except Exception as e:
+        logger.error("DB error: %s | Q: %s | rows: %d", e, query, len(seq_of_params))
+        if nested:
+            raise
+        return None
+
+# ---------- Кэш (LRU + TTL) ----------
+# Лимит записей на каждый кэш и время жизни записи (секунды)
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "300"))
+
+_MISS = object()
+
+
+class LRUCache:
+    """Ограниченный по числу записей LRU-кэш с TTL и счётчиками попаданий"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        # растёт при каждой инвалидации: не кладём в кэш то, что прочитали до неё
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return _MISS
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, generation: Optional[int] = None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+_user_cache = LRUCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+_state_cache = LRUCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+_app_cache = LRUCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+
+def _cached_row(cache: LRUCache, key, query: str, params: Tuple) -> Optional[Dict[str, Any]]:
+    value = cache.get(key)
+    if value is not _MISS:
+        return dict(value)
+    generation = cache.generation
+    row = db_execute(query, params, fetchone=True)
+    # незакоммиченные данные и ошибки/пустые ответы не кэшируем
+    if row is not None and not in_transaction():
+        cache.set(key, dict(row), generation)
+    return row
+
+def _invalidate(cache: LRUCache, key):
+    # сразу и ещё раз после коммита: читатели до коммита видят старые данные
+    cache.invalidate(key)
+    if in_transaction():
+        on_commit(lambda: cache.invalidate(key))
+
+def cache_stats() -> Dict[str, Any]:
+    return {
+        "users": _user_cache.stats(),
+        "user_state": _state_cache.stats(),
+        "applications": _app_cache.stats(),
+    }
+
+# ---------- Учёт активности (пакетная запись last_activity) ----------
+# Сбрасываем накопленное раз в N секунд или как только набралось M пользователей
+ACTIVITY_FLUSH_SECONDS = float(os.getenv("ACTIVITY_FLUSH_SECONDS", "10"))
+ACTIVITY_FLUSH_MAX = int(os.getenv("ACTIVITY_FLUSH_MAX", "500"))
+
+
+class ActivityRecorder:
+    """Копит user_id в памяти и пишет last_activity пачкой в фоне"""
+
+    def __init__(self, interval: float, max_pending: int):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}  # user_id -> время активности (UTC, как CURRENT_TIMESTAMP)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def touch(self, user_id: int):
+        with self._lock:
+            self._pending[user_id] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+            full = len(self._pending) >= self.max_pending
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="activity-recorder", daemon=True)
+                self._thread.start()
+        if full:
+            self._wake.set()
+
+    def flush(self) -> int:
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+        db_executemany("UPDATE users SET last_activity = ? WHERE user_id = ?",
+                       [(ts, uid) for uid, ts in batch.items()])
+        return len(batch)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Ошибка записи активности: %s", e)
+
+
+activity = ActivityRecorder(ACTIVITY_FLUSH_SECONDS, ACTIVITY_FLUSH_MAX)
+
+# ---------- Черновики анкет в памяти (опционально) ----------
+# DRAFT_STORE=1: незавершённая анкета (раздел, файлы, ожидаемый тип) живёт в памяти и попадает
+# в applications/media одной транзакцией при отправке; брошенный черновик не пишет в SQLite ничего.
+DRAFT_STORE = os.getenv("DRAFT_STORE", "0") == "1"
+# Снимок черновиков на диск (восстановление после падения) — раз в N секунд, если были изменения
+DRAFT_SNAPSHOT_PATH = os.getenv("DRAFT_SNAPSHOT_PATH", os.path.splitext(DB_PATH)[0] + "_drafts.json")
+DRAFT_SNAPSHOT_SECONDS = float(os.getenv("DRAFT_SNAPSHOT_SECONDS", "30"))
+
+
+def _utc_timestamp(ts: float) -> str:
+    """epoch -> строка в формате CURRENT_TIMESTAMP"""
+    return datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class DraftStore:
+    """
+    Черновики по пользователям: не больше одного на пользователя.
+    Id черновика отрицательный — не пересекается с applications.id, по знаку модель
+    выбирает, где искать анкету. Счётчик id сохраняется в снимке.
+    """
+
+    def __init__(self, path: str, interval: float):
+        self.path = path
+        self.interval = interval
+        self._drafts = {}  # draft_id -> черновик
+        self._by_user = {}  # user_id -> draft_id
+        self._next_id = 1
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()  # снимки пишутся по одному, в порядке изменений
+        self._thread = None
+
+    def load(self) -> int:
+        """Черновики из снимка прошлого запуска; сколько восстановлено"""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            logger.error("Снимок черновиков %s не прочитан: %s", self.path, e)
+            return 0
+        with self._lock:
+            self._next_id = max(self._next_id, data.get("next_id", 1))
+            for draft in data.get("drafts", []):
+                draft["media"] = [tuple(m) for m in draft["media"]]
+                self._drafts[draft["id"]] = draft
+                self._by_user[draft["user_id"]] = draft["id"]
+            return len(self._drafts)
+
+    def _changed(self):
+        # вызывается под self._lock
+        self._dirty = True
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="draft-snapshot", daemon=True)
+            self._thread.start()
+
+    def create(self, user_id: int, section: str) -> int:
+        now = time.time()
+        with self._lock:
+            self._drafts.pop(self._by_user.get(user_id), None)
+            draft_id = -self._next_id
+            self._next_id += 1
+            self._drafts[draft_id] = {
+                "id": draft_id, "user_id": user_id, "section": section, "media": [],
+                "awaiting": None, "last_action": "created_app", "created_ts": now, "updated_ts": now,
+            }
+            self._by_user[user_id] = draft_id
+            self._changed()
+        return draft_id
+
+    def for_user(self, user_id: int) -> Optional[int]:
+        return self._by_user.get(user_id)
+
+    def application(self, draft_id: int) -> Optional[Dict[str, Any]]:
+        """Черновик в виде строки applications (со счётчиками файлов)"""
+        with self._lock:
+            draft = self._drafts.get(draft_id)
+            if draft is None:
+                return None
+            normal = sum(1 for media_type, _, _ in draft["media"] if media_type == "normal")
+            return {
+                "id": draft_id, "user_id": draft["user_id"], "section": draft["section"], "status": 0,
+                "moderator_id": None, "moderated_at": None, "created_at": _utc_timestamp(draft["created_ts"]),
+                "normal_count": normal, "intimate_count": len(draft["media"]) - normal,
+            }
+
+    def state(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Черновик пользователя в виде строки user_state"""
+        with self._lock:
+            draft = self._drafts.get(self._by_user.get(user_id))
+            if draft is None:
+                return None
+            return {
+                "user_id": user_id, "current_app_id": draft["id"], "awaiting_media_type": draft["awaiting"],
+                "last_action": draft["last_action"], "updated_at": _utc_timestamp(draft["updated_ts"]),
+            }
+
+    def set_awaiting(self, draft_id: int, media_type: Optional[str], last_action: str) -> bool:
+        with self._lock:
+            draft = self._drafts.get(draft_id)
+            if draft is None:
+                return False
+            draft.update(awaiting=media_type, last_action=last_action, updated_ts=time.time())
+            self._changed()
+            return True
+
+    def add_media(self, draft_id: int, media_type: str, files) -> int:
+        """Файлы (kind, file_id) в черновик; сколько добавлено (0 — черновика нет)"""
+        with self._lock:
+            draft = self._drafts.get(draft_id)
+            if draft is None:
+                return 0
+            draft["media"].extend((media_type, kind, file_id) for kind, file_id in files)
+            draft["updated_ts"] = time.time()
+            self._changed()
+            return len(files)
+
+    def get(self, draft_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            draft = self._drafts.get(draft_id)
+            return dict(draft, media=list(draft["media"])) if draft else None
+
+    def discard(self, draft_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            draft = self._drafts.pop(draft_id, None)
+            if draft is not None:
+                if self._by_user.get(draft["user_id"]) == draft_id:
+                    del self._by_user[draft["user_id"]]
+                self._changed()
+            return draft
+
+    def expire(self, draft_ttl: float, state_ttl: float) -> Tuple[List[Dict[str, Any]], int]:
+        """Черновики без изменений дольше draft_ttl секунд — удаляются; ожидание файлов старше state_ttl — сбрасывается"""
+        now = time.time()
+        expired, idle = [], 0
+        with self._lock:
+            for draft_id, draft in list(self._drafts.items()):
+                if draft["updated_ts"] < now - draft_ttl:
+                    expired.append(self._drafts.pop(draft_id))
+                    self._by_user.pop(draft["user_id"], None)
+                elif draft["awaiting"] and draft["updated_ts"] < now - state_ttl:
+                    draft["awaiting"] = None
+                    idle += 1
+            if expired or idle:
+                self._changed()
+        return expired, idle
+
+    def pending(self) -> int:
+        return len(self._drafts)
+
+    def snapshot(self) -> bool:
+        """Атомарная запись снимка (tmp + rename), только если были изменения"""
+        with self._io_lock:
+            with self._lock:
+                if not self._dirty:
+                    return False
+                data = json.dumps({"next_id": self._next_id, "drafts": list(self._drafts.values())},
+                                  ensure_ascii=False)
+                self._dirty = False
+            tmp = self.path + ".tmp"
+            try:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write(data)
+                os.replace(tmp, self.path)
+            except OSError:
+                with self._lock:
+                    self._dirty = True
+                raise
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.snapshot()
+            except Exception as e:
+                logger.error("Ошибка снимка черновиков: %s", e)
+
+
+drafts = DraftStore(DRAFT_SNAPSHOT_PATH, DRAFT_SNAPSHOT_SECONDS)
+if DRAFT_STORE:
+    drafts.load()
+
+def app_ref(app_id: int) -> str:
+    """Как показывать анкету пользователю: у черновика ещё нет номера"""
+    return f"#{app_id}" if app_id > 0 else "(черновик)"
+
+# ---------- Основные функции модели ----------
+def _profile_unchanged(user: Dict[str, Any], username: Optional[str], first_name: Optional[str], last_name: Optional[str]) -> bool:
+    return (user['username'], user['first_name'], user['last_name']) == (username, first_name, last_name)
+
+def upsert_user(user_id: int, username: Optional[str], first_name: Optional[str], last_name: Optional[str] = "",
+                notify_new: bool = False) -> Tuple[Optional[Dict[str, Any]], bool]:
+    """
+    Создать пользователя или обновить поля одним upsert; (строка users, создан ли он сейчас).
+    notify_new — уведомление админам о новом пользователе в той же транзакции, что и вставка.
+    """
+    activity.touch(user_id)
+    cached = _user_cache.get(user_id)
+    if cached is not _MISS and _profile_unchanged(cached, username, first_name, last_name):
+        return dict(cached), False
+    # Вставка и обновление — два запроса под одной BEGIN IMMEDIATE: строку вернёт только тот,
+    # что сработал, так вставка отличается от обновления. Если профиль не изменился,
+    # UPDATE не находит строку и ничего не возвращает.
+    with db_transaction():
+        row = db_execute("""
             INSERT INTO users (user_id, username, first_name, last_name, status)
             VALUES (?, ?, ?, ?, 'pending')
-        """, (user_id, username, first_name, last_name))
-        # уведомляем админов о новом пользователе
-        notify_admins_new_user(user_id, username, first_name, last_name)
+            ON CONFLICT(user_id) DO NOTHING
+            RETURNING *
+        """, (user_id, username, first_name, last_name), fetchone=True)
+        is_new = row is not None
+        if is_new:
+            if notify_new:
+                notify_admins_new_user(user_id, username, first_name, last_name)
+        else:
+            row = db_execute("""
+                UPDATE users SET username = ?, first_name = ?, last_name = ?
+                WHERE user_id = ? AND (username IS NOT ? OR first_name IS NOT ? OR last_name IS NOT ?)
+                RETURNING *
+            """, (username, first_name, last_name, user_id, username, first_name, last_name), fetchone=True)
+    if not row:
+        return get_user(user_id), False
+    _invalidate(_user_cache, user_id)
+    return row, is_new
+
+def ensure_user(user_id: int, username: Optional[str], first_name: Optional[str], last_name: Optional[str] = "") -> Optional[Dict[str, Any]]:
+    """Создать пользователя или обновить поля (новый — с уведомлением админам); возвращает строку users"""
+    return upsert_user(user_id, username, first_name, last_name, notify_new=True)[0]
+
+def get_user(user_id: int) -> Optional[Dict[str, Any]]:
+    return _cached_row(_user_cache, user_id, "SELECT * FROM users WHERE user_id = ?", (user_id,))
+
+def set_user_status(user_id: int, status: str):
+    db_execute("UPDATE users SET status = ? WHERE user_id = ?", (status, user_id))
+    _invalidate(_user_cache, user_id)
+    activity.touch(user_id)
+
+def get_active_application_for_user(user_id: int) -> Optional[Dict[str, Any]]:
+    draft_id = drafts.for_user(user_id)
+    if draft_id is not None:
+        return drafts.application(draft_id)
+    return db_execute("""
+        SELECT * FROM applications WHERE user_id = ? AND status = 0 ORDER BY created_at DESC LIMIT 1
+    """, (user_id,), fetchone=True)
+
+def create_application(user_id: int, section: str) -> int:
+    """Новая анкета (в режиме DRAFT_STORE — черновик в памяти) или уже активная"""
+    if DRAFT_STORE:
+        active = get_active_application_for_user(user_id)
+        if active:
+            return active['id']
+        return drafts.create(user_id, section)
+    with db_transaction():
+        # запрещаем создавать новую pending, если уже есть одна
+        active = get_active_application_for_user(user_id)
+        if active:
+            return active['id']
+        app_id = db_execute("""
+            INSERT INTO applications (user_id, section, status) VALUES (?, ?, 0)
+        """, (user_id, section), return_id=True)
+        # create/update user_state
+        db_execute("""
+            INSERT OR REPLACE INTO user_state (user_id, current_app_id, awaiting_media_type, last_action, updated_at)
+            VALUES (?, ?, NULL, 'created_app', CURRENT_TIMESTAMP)
+        """, (user_id, app_id))
+        _invalidate(_app_cache, app_id)
+        _invalidate(_state_cache, user_id)
+    return app_id
+
+def open_application(user_id: int, section: str) -> int:
+    """Анкета и уведомление админам (outbox) — одной транзакцией; черновик в памяти транзакции не открывает"""
+    if DRAFT_STORE:
+        # для черновика notify ничего не пишет: админы узнают об анкете при отправке
+        app_id = create_application(user_id, section)
+        notify_admins_new_application(app_id)
+        return app_id
+    with db_transaction():
+        app_id = create_application(user_id, section)
+        notify_admins_new_application(app_id)
+    return app_id
+
+def add_media(application_id: int, media_type: str, kind: str, file_id: str):
+    if application_id < 0:
+        return drafts.add_media(application_id, media_type, [(kind, file_id)])
+    media_id = db_execute("""
+        INSERT INTO media (application_id, media_type, kind, file_id) VALUES (?, ?, ?, ?)
+    """, (application_id, media_type, kind, file_id), return_id=True)
+    # счётчики в applications обновил триггер
+    _invalidate(_app_cache, application_id)
+    return media_id
+
+def add_media_batch(application_id: int, media_type: str, files) -> Optional[int]:
+    """Несколько файлов (kind, file_id) одной транзакцией"""
+    if application_id < 0:
+        return drafts.add_media(application_id, media_type, files)
+    saved = db_executemany("""
+        INSERT INTO media (application_id, media_type, kind, file_id) VALUES (?, ?, ?, ?)
+    """, [(application_id, media_type, kind, file_id) for kind, file_id in files])
+    _invalidate(_app_cache, application_id)
+    return saved
+
+def get_media_counts(application_id: int) -> Dict[str, int]:
+    """Счётчики из строки анкеты (кэш), без GROUP BY по media"""
+    app = get_application(application_id)
+    if not app:
+        return {'normal': 0, 'intimate': 0}
+    return {'normal': app['normal_count'], 'intimate': app['intimate_count']}
+
+def get_application(application_id: int) -> Optional[Dict[str, Any]]:
+    if application_id < 0:
+        return drafts.application(application_id)
+    return _cached_row(_app_cache, application_id, "SELECT * FROM applications WHERE id = ?", (application_id,))
+
+def get_application_media(application_id: int) -> List[Dict[str, Any]]:
+    return db_execute("SELECT * FROM media WHERE application_id = ? ORDER BY id", (application_id,), fetchall=True) or []
+
+def get_user_applications(user_id: int, limit: int = 10) -> List[Dict[str, Any]]:
+    """Последние анкеты пользователя (/my)"""
+    return db_execute("""
+        SELECT id, section, status, created_at FROM applications WHERE user_id = ? ORDER BY created_at DESC LIMIT ?
+    """, (user_id, limit), fetchall=True) or []
+
+def set_application_status(application_id: int, new_status: int, moderator_id: Optional[int] = None):
+    """Решение по анкете и статус пользователя — атомарно, одним коммитом"""
+    now = datetime.now().isoformat(sep=' ')
+    with db_transaction():
+        db_execute("""
+            UPDATE applications SET status = ?, moderator_id = ?, moderated_at = ? WHERE id = ?
+        """, (new_status, moderator_id, now, application_id))
+        _invalidate(_app_cache, application_id)
+        # если approved -> переводим пользователя в approved
+        app = get_application(application_id)
+        if not app:
+            return
+        uid = app['user_id']
+        if new_status == 1:
+            set_user_status(uid, 'approved')
+        elif new_status == -1:
+            set_user_status(uid, 'banned')
+        elif new_status == 2:
+            # needs_fix -> оставляем пользователя pending
+            set_user_status(uid, 'pending')
+
+# Решение модератора -> (статус анкеты, статус пользователя) и уведомление пользователю
+MOD_DECISIONS = {"approve": (1, 'approved'), "reject": (-1, 'banned'), "fix": (2, 'pending')}
+MOD_USER_NOTICES = {
+    "approve": "🎉 Ваша анкета #{app_id} одобрена. Вам открыт доступ ко всем разделам.",
+    "reject": "❌ Ваша анкета #{app_id} отклонена. Вы заблокированы.",
+    "fix": "✏️ Анкета #{app_id} требует исправлений. Пожалуйста, добавьте/замените файлы и нажмите 'Готово'.",
+}
+# Максимум анкет за одно массовое действие (самые старые — первыми)
+BULK_MODERATION_MAX = int(os.getenv("BULK_MODERATION_MAX", "1000"))
+
+def _bulk_filter(decision: str, app_ids: Optional[List[int]] = None, section: Optional[str] = None,
+                 older_than_hours: int = 0, max_id: Optional[int] = None) -> Tuple[str, list]:
+    """WHERE для массовой модерации: только pending; одобрять — только полные анкеты"""
+    where = ["status = 0"]
+    params = []
+    if app_ids is not None:
+        where.append("id IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(app_ids))
+    if section:
+        where.append("section = ?")
+        params.append(section)
+    if older_than_hours:
+        where.append("created_at <= datetime('now', ?)")
+        params.append(f"-{int(older_than_hours)} hours")
+    if max_id is not None:
+        # фиксирует выборку на момент предпросмотра — новые анкеты не попадут
+        where.append("id <= ?")
+        params.append(max_id)
+    if decision == "approve":
+        where.append("normal_count >= 1 AND intimate_count >= 1")
+    return " AND ".join(where), params
+
+def count_bulk_targets(decision: str, **filters) -> int:
+    where, params = _bulk_filter(decision, **filters)
+    row = db_execute(f"SELECT COUNT(*) AS c FROM applications WHERE {where}", tuple(params), fetchone=True)
+    return row['c'] if row else 0
+
+def max_application_id() -> int:
+    row = db_execute("SELECT MAX(id) AS m FROM applications", (), fetchone=True)
+    return (row and row['m']) or 0
+
+def decide_application(app_id: int, decision: str, moderator_id: int):
+    """Решение модератора и уведомление пользователю (через outbox) — одной транзакцией"""
+    with db_transaction():
+        app = get_application(app_id)
+        if app and app['status'] == MOD_DECISIONS[decision][0]:
+            # повторное нажатие той же кнопки — решение уже принято, второе уведомление не нужно
+            return
+        set_application_status(app_id, MOD_DECISIONS[decision][0], moderator_id)
+        app = get_application(app_id)
+        if app:
+            # moderated_at в ключе: approve -> fix -> approve — три разных уведомления
+            outbox_put(app['user_id'], MOD_USER_NOTICES[decision].format(app_id=app_id),
+                       key=f"decision:{app_id}:{decision}:{app['moderated_at']}")
+
+def bulk_set_application_status(decision: str, moderator_id: int, limit: int = BULK_MODERATION_MAX,
+                                batch: Optional[str] = None, **filters) -> List[Dict[str, Any]]:
+    """
+    Массовое решение: анкеты, их пользователи и уведомления в outbox — одной транзакцией.
+    batch — метка строк outbox для отчёта о прогрессе. Возвращает [{id, user_id}] изменённых анкет.
+    """
+    app_status, user_status = MOD_DECISIONS[decision]
+    where, params = _bulk_filter(decision, **filters)
+    now = datetime.now().isoformat(sep=' ')
+    with db_transaction():
+        rows = db_execute(f"""
+            UPDATE applications SET status = ?, moderator_id = ?, moderated_at = ?
+            WHERE id IN (SELECT id FROM applications WHERE {where} ORDER BY created_at, id LIMIT ?)
+            RETURNING id, user_id
+        """, (app_status, moderator_id, now, *params, limit), fetchall=True) or []
+        user_ids = sorted({r['user_id'] for r in rows})
+        if user_ids:
+            db_execute("UPDATE users SET status = ? WHERE user_id IN (SELECT value FROM json_each(?))",
+                       (user_status, json.dumps(user_ids)))
+        notice = MOD_USER_NOTICES[decision]
+        outbox_put_many([(r['user_id'], notice.format(app_id=r['id']), f"decision:{r['id']}:{decision}:{now}")
+                         for r in rows], batch=batch)
+        for r in rows:
+            _invalidate(_app_cache, r['id'])
+        for uid in user_ids:
+            _invalidate(_user_cache, uid)
+    return rows
+
+def delete_application(application_id: int, user_id: int):
+    """Сброс анкеты: медиа, сама анкета и состояние пользователя — одной транзакцией"""
+    if application_id < 0:
+        # черновик не доходил до БД — удалять там нечего
+        drafts.discard(application_id)
+        return
+    with db_transaction():
+        db_execute("DELETE FROM media WHERE application_id = ?", (application_id,))
+        db_execute("DELETE FROM applications WHERE id = ?", (application_id,))
+        _invalidate(_app_cache, application_id)
+        clear_user_state(user_id)
+
+def get_user_state(user_id: int) -> Optional[Dict[str, Any]]:
+    if drafts.for_user(user_id) is not None:
+        return drafts.state(user_id)
+    return _cached_row(_state_cache, user_id, "SELECT * FROM user_state WHERE user_id = ?", (user_id,))
+
+def set_user_state(user_id: int, current_app_id: Optional[int], awaiting_media_type: Optional[str], last_action: str):
+    if current_app_id is not None and current_app_id < 0:
+        drafts.set_awaiting(current_app_id, awaiting_media_type, last_action)
+        return
+    db_execute("""
+        INSERT OR REPLACE INTO user_state (user_id, current_app_id, awaiting_media_type, last_action, updated_at)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+    """, (user_id, current_app_id, awaiting_media_type, last_action))
+    _invalidate(_state_cache, user_id)
+
+def clear_user_state(user_id: int):
+    draft_id = drafts.for_user(user_id)
+    if draft_id is not None:
+        drafts.set_awaiting(draft_id, None, "cleared")
+    db_execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+    _invalidate(_state_cache, user_id)
+
+def persist_draft(draft_id: int) -> Optional[int]:
+    """
+    Черновик -> applications и media одной транзакцией (счётчики файлов ведут триггеры).
+    Из памяти черновик уходит только после коммита; возвращает id анкеты.
+    """
+    draft = drafts.get(draft_id)
+    if draft is None:
+        return None
+    with db_transaction():
+        app_id = db_execute("""
+            INSERT INTO applications (user_id, section, status, created_at) VALUES (?, ?, 0, ?)
+        """, (draft['user_id'], draft['section'], _utc_timestamp(draft['created_ts'])), return_id=True)
+        if draft['media']:
+            db_executemany("""
+                INSERT INTO media (application_id, media_type, kind, file_id) VALUES (?, ?, ?, ?)
+            """, [(app_id, media_type, kind, file_id) for media_type, kind, file_id in draft['media']])
+        _invalidate(_app_cache, app_id)
+        on_commit(functools.partial(drafts.discard, draft_id))
+    return app_id
+
+def submit_application(user_id: int, app_id: int) -> Optional[int]:
+    """Отправка на модерацию: черновик в БД, уведомление админам, сброс состояния — одной транзакцией"""
+    with db_transaction():
+        if app_id < 0:
+            app_id = persist_draft(app_id)
+            if app_id is None:
+                return None
+        notify_admins_new_application(app_id, "submitted")
+        clear_user_state(user_id)
+    return app_id
+
+def get_pending_page(section: Optional[str] = None, cursor: Optional[Tuple[int, int]] = None,
+                     direction: str = "n", limit: int = PENDING_PAGE_SIZE):
+    """
+    Страница очереди модерации (новые сверху), keyset по (created_at, id).
+    cursor — (epoch, id) крайней анкеты соседней страницы; direction: n — старше курсора, p — новее.
+    Возвращает (rows, has_prev, has_next); цена запроса не зависит от глубины очереди.
+    """
+    where = ["a.status = 0"]
+    params = []
+    if section:
+        where.append("a.section = ?")
+        params.append(section)
+    if cursor:
+        op = "<" if direction == "n" else ">"
+        where.append(f"(a.created_at, a.id) {op} (datetime(?, 'unixepoch'), ?)")
+        params.extend(cursor)
+    order = "DESC" if direction == "n" else "ASC"
+    rows = db_execute(f"""
+        SELECT a.id, a.user_id, a.section, a.created_at, a.normal_count, a.intimate_count,
+               CAST(strftime('%s', a.created_at) AS INTEGER) AS created_epoch, u.username, u.first_name
+        FROM applications a LEFT JOIN users u ON a.user_id = u.user_id
+        WHERE {' AND '.join(where)} ORDER BY a.created_at {order}, a.id {order} LIMIT ?
+    """, tuple(params) + (limit + 1,), fetchall=True) or []
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "n":
+        return rows, cursor is not None, more
+    rows.reverse()
+    return rows, more, True
+
+# Сколько последних дней отдавать в разбивке статистики
+STATS_DAYS = int(os.getenv("STATS_DAYS", "14"))
+APP_STATUS_NAMES = {0: "pending", 1: "approved", -1: "rejected", 2: "needs_fix", -2: "expired"}
+
+def get_stats(days: int = STATS_DAYS) -> Dict[str, Any]:
+    """Статистика из предагрегированных таблиц (ведутся триггерами) — без сканов users/applications/media"""
+    counters = db_execute("SELECT metric, key, value FROM stats_counters", (), fetchall=True) or []
+    since = (datetime.utcnow() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    daily_rows = db_execute("SELECT day, metric, key, value FROM stats_daily WHERE day >= ? ORDER BY day",
+                            (since,), fetchall=True) or []
+    users, apps_by_status, apps_by_section, media = {}, {}, {}, {}
+    for r in counters:
+        if r['metric'] == 'users':
+            users[r['key']] = r['value']
+        elif r['metric'] == 'apps':
+            status, section = r['key'].split(":", 1)
+            name = APP_STATUS_NAMES.get(int(status), status)
+            apps_by_status[name] = apps_by_status.get(name, 0) + r['value']
+            by_section = apps_by_section.setdefault(section, {})
+            by_section[name] = by_section.get(name, 0) + r['value']
+        elif r['metric'] == 'media':
+            media[r['key']] = r['value']
+    daily = {}
+    for r in daily_rows:
+        day = daily.setdefault(r['day'], {"users_new": 0, "apps_new": {}, "media_new": {}, "decisions": {}})
+        if r['metric'] == 'users_new':
+            day['users_new'] += r['value']
+        elif r['metric'] == 'decisions':
+            moderator, status = r['key'].split(":", 1)
+            per_moderator = day['decisions'].setdefault(moderator, {})
+            per_moderator[APP_STATUS_NAMES.get(int(status), status)] = r['value']
+        else:
+            day[r['metric']][r['key']] = r['value']
+    return {
+        "users": users,
+        "users_total": sum(users.values()),
+        "applications": apps_by_status,
+        "applications_by_section": apps_by_section,
+        "media": media,
+        "daily": daily,
+    }
+
+def stats_text(stats: Dict[str, Any]) -> str:
+    """Сводка для кнопки «Статистика»: итоги и последние дни"""
+    users = stats['users']
+    apps = stats['applications']
+    text = (
+        f"📊 Статистика\n\n"
+        f"Пользователи: {stats['users_total']} (approved {users.get('approved', 0)}, "
+        f"pending {users.get('pending', 0)}, banned {users.get('banned', 0)})\n"
+        f"Анкеты: pending {apps.get('pending', 0)}, approved {apps.get('approved', 0)}, "
+        f"rejected {apps.get('rejected', 0)}, на правках {apps.get('needs_fix', 0)}, "
+        f"закрыто без файлов {apps.get('expired', 0)}\n"
+        f"Медиа: обычных {stats['media'].get('normal', 0)}, интимных {stats['media'].get('intimate', 0)}\n"
+    )
+    for section, by_status in sorted(stats['applications_by_section'].items()):
+        text += f"• {section}: ожидают {by_status.get('pending', 0)}, одобрено {by_status.get('approved', 0)}\n"
+    if stats['daily']:
+        text += "\nПо дням (новые польз. / анкеты / решения):\n"
+        for day, d in sorted(stats['daily'].items(), reverse=True)[:7]:
+            decisions = sum(sum(v.values()) for v in d['decisions'].values())
+            text += f"{day}: {d['users_new']} / {sum(d['apps_new'].values())} / {decisions}\n"
+    return text
+
+def new_user_notice(user_id: int, username: Optional[str], first_name: Optional[str], last_name: Optional[str]) -> str:
+    return (
+        f"🆕 Новый пользователь: `{user_id}`\n"
+        f"Имя: {first_name or '-'} {last_name or '-'}\n"
+        f"Ник: @{username or '-'}\n"
+        f"Статус: pending\n"
+        f"Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+    )
+
+def notify_admins_new_user(user_id: int, username: Optional[str], first_name: Optional[str], last_name: Optional[str]):
+    text = new_user_notice(user_id, username, first_name, last_name)
+    # только пишем в outbox: хендлер пользователя не ждёт рассылки админам
+    for aid in ADMIN_IDS:
+        outbox_put(aid, text, key=f"new_user:{user_id}:{aid}")
+
+def new_application_notice(app_id: int) -> Optional[Tuple[str, str]]:
+    """Текст и кнопки модерации для уведомления админов о новой анкете"""
+    app = get_application(app_id)
+    if not app:
+        return None
+    uid = app['user_id']
+    user = get_user(uid)
+    text = (
+        f"📨 Новая анкета #{app_id}\n"
+        f"Пользователь: `{uid}` ({user['first_name'] or '-'}) @{user['username'] or '-'}\n"
+        f"Раздел: {app['section']}\n"
+        f"Время: {app['created_at']}\n"
+    )
+    return text, kb_moderation(app_id)
+
+def notify_admins_new_application(app_id: int, event: str = "created"):
+    """Уведомление админам через outbox; event различает создание и отправку на модерацию"""
+    if app_id < 0:
+        # черновик в памяти: админы узнают об анкете при отправке
+        return
+    notice = new_application_notice(app_id)
+    if not notice:
+        return
+    text, kb = notice
+    for aid in ADMIN_IDS:
+        outbox_put(aid, text, reply_markup=kb, key=f"app_{event}:{app_id}:{aid}")
+
+# ---------- Обслуживание БД (архив, очистка, VACUUM/ANALYZE) ----------
+# Решённые анкеты (одобрена/отклонена/закрыта сборщиком) старше N дней вместе с медиа уезжают в файл архива
+ARCHIVE_DB_PATH = os.getenv("ARCHIVE_DB_PATH", os.path.splitext(DB_PATH)[0] + "_archive.db")
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+# Анкет за одну транзакцию: блокировку записи держим недолго, между пачками проходят хендлеры
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "500"))
+# Тихое окно (локальное время): обслуживание раз в сутки, начиная с MAINTENANCE_HOUR
+MAINTENANCE_HOUR = int(os.getenv("MAINTENANCE_HOUR", "4"))
+MAINTENANCE_WINDOW_HOURS = int(os.getenv("MAINTENANCE_WINDOW_HOURS", "2"))
+MAINTENANCE_CHECK_SECONDS = float(os.getenv("MAINTENANCE_CHECK_SECONDS", "600"))
+# Страниц, возвращаемых ОС за один incremental_vacuum, и лимит строк выборки для ANALYZE
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "2000"))
+ANALYZE_LIMIT = int(os.getenv("ANALYZE_LIMIT", "1000"))
+
+# Колонки копируются явно: схема архива не зависит от порядка ALTER TABLE в основной БД
+_ARCHIVE_APP_COLUMNS = ("id, user_id, section, status, moderator_id, moderated_at, created_at, "
+                        "normal_count, intimate_count")
+_ARCHIVE_MEDIA_COLUMNS = "id, application_id, media_type, kind, file_id, created_at"
+_ARCHIVE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS archive.applications (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        section TEXT NOT NULL,
+        status INTEGER,
+        moderator_id INTEGER,
+        moderated_at TIMESTAMP,
+        created_at TIMESTAMP,
+        normal_count INTEGER NOT NULL DEFAULT 0,
+        intimate_count INTEGER NOT NULL DEFAULT 0,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS archive.media (
+        id INTEGER PRIMARY KEY,
+        application_id INTEGER NOT NULL,
+        media_type TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        created_at TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_app_user ON applications(user_id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_media_app ON media(application_id)",
+]
+
+def _archive_batch(conn: sqlite3.Connection, cutoff_utc: str, cutoff_local: str) -> List[int]:
+    """
+    Одна пачка: копия в архив (своя транзакция), затем удаление из основной БД.
+    В WAL транзакция на две БД не атомарна целиком — поэтому два шага по порядку:
+    упали между ними — следующий запуск скопирует повторно (INSERT OR IGNORE) и удалит.
+    """
+    ids = [r[0] for r in conn.execute("""
+        SELECT id FROM applications
+        WHERE status IN (1, -1, -2) AND created_at < ? AND moderated_at < ?
+        ORDER BY id LIMIT ?
+    """, (cutoff_utc, cutoff_local, ARCHIVE_BATCH))]
+    if not ids:
+        return ids
+    id_list = json.dumps(ids)
+    # пишется только файл архива — блокировка основной БД не нужна
+    conn.execute("BEGIN")
+    try:
+        conn.execute(f"""
+            INSERT OR IGNORE INTO archive.applications ({_ARCHIVE_APP_COLUMNS})
+            SELECT {_ARCHIVE_APP_COLUMNS} FROM main.applications WHERE id IN (SELECT value FROM json_each(?))
+        """, (id_list,))
+        conn.execute(f"""
+            INSERT OR IGNORE INTO archive.media ({_ARCHIVE_MEDIA_COLUMNS})
+            SELECT {_ARCHIVE_MEDIA_COLUMNS} FROM main.media WHERE application_id IN (SELECT value FROM json_each(?))
+        """, (id_list,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    with _write_lock():
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # триггеры статистики вычтут удалённое — архив не меняет итоги, возвращаем обратно
+            conn.execute("""
+                INSERT INTO stats_counters (metric, key, value)
+                SELECT 'apps', status || ':' || section, COUNT(*) FROM main.applications
+                WHERE id IN (SELECT value FROM json_each(?1)) GROUP BY status, section
+                ON CONFLICT (metric, key) DO UPDATE SET value = value + excluded.value
+            """, (id_list,))
+            conn.execute("""
+                INSERT INTO stats_counters (metric, key, value)
+                SELECT 'media', media_type, COUNT(*) FROM main.media
+                WHERE application_id IN (SELECT value FROM json_each(?1)) GROUP BY media_type
+                ON CONFLICT (metric, key) DO UPDATE SET value = value + excluded.value
+            """, (id_list,))
+            # сначала анкеты: триггер счётчиков медиа дальше не находит строку и ничего не пишет
+            conn.execute("DELETE FROM main.applications WHERE id IN (SELECT value FROM json_each(?))", (id_list,))
+            conn.execute("DELETE FROM main.media WHERE application_id IN (SELECT value FROM json_each(?))", (id_list,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    for app_id in ids:
+        _invalidate(_app_cache, app_id)
+    return ids
+
+def archive_resolved_applications(older_than_days: int = ARCHIVE_AFTER_DAYS) -> int:
+    """Перенести решённые анкеты старше older_than_days в ARCHIVE_DB_PATH; сколько перенесено"""
+    # created_at — UTC (CURRENT_TIMESTAMP), moderated_at — локальное время (datetime.now())
+    cutoff_utc = (datetime.utcnow() - timedelta(days=older_than_days)).strftime("%Y-%m-%d %H:%M:%S")
+    cutoff_local = (datetime.now() - timedelta(days=older_than_days)).isoformat(sep=' ')
+    moved = 0
+    conn = _pool.acquire()
+    try:
+        conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_PATH,))
+        try:
+            for sql in _ARCHIVE_SCHEMA:
+                conn.execute(sql)
+            while True:
+                ids = _archive_batch(conn, cutoff_utc, cutoff_local)
+                moved += len(ids)
+                if len(ids) < ARCHIVE_BATCH:
+                    break
+                # пауза между пачками — очередь записей хендлеров не ждёт весь архив
+                time.sleep(0.05)
+        finally:
+            conn.execute("DETACH DATABASE archive")
+    finally:
+        _pool.release(conn)
+    return moved
+
+def vacuum_and_analyze() -> Dict[str, Any]:
+    """
+    Вернуть ОС свободные страницы (incremental_vacuum) и обновить статистику планировщика.
+    Первый запуск на старой БД переводит её в auto_vacuum=INCREMENTAL полным VACUUM.
+    """
+    conn = _pool.acquire()
+    try:
+        with _write_lock():
+            free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                logger.info("Обслуживание: включаю auto_vacuum=INCREMENTAL (полный VACUUM, один раз)")
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
+            else:
+                # pragma освобождает по странице на шаг — дочитываем до конца
+                conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+            free_after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            conn.execute(f"PRAGMA analysis_limit = {ANALYZE_LIMIT}")
+            conn.execute("ANALYZE")
+    finally:
+        _pool.release(conn)
+    return {"pages_freed": free_before - free_after, "free_pages": free_after}
+
+def run_maintenance() -> Dict[str, Any]:
+    """Весь цикл обслуживания; отчёт — в лог и в /admin-stats"""
+    started = time.monotonic()
+    report = {"archived": archive_resolved_applications()}
+    report.update(vacuum_and_analyze())
+    report["seconds"] = round(time.monotonic() - started, 2)
+    report["finished_at"] = datetime.now().isoformat(sep=' ', timespec="seconds")
+    logger.info("Обслуживание БД: %s", report)
+    return report
+
+
+class MaintenanceScheduler:
+    """Раз в сутки в тихом окне запускает run_maintenance в фоновом потоке"""
+
+    def __init__(self, hour: int, window_hours: int, check_every: float):
+        self.hour = hour
+        self.window_hours = window_hours
+        self.check_every = check_every
+        self.last_report = None
+        self._last_day = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="db-maintenance", daemon=True)
+            self._thread.start()
+
+    def in_window(self, now: datetime) -> bool:
+        return (now.hour - self.hour) % 24 < self.window_hours
+
+    def _run(self):
+        while True:
+            now = datetime.now()
+            if self.in_window(now) and self._last_day != now.date():
+                self._last_day = now.date()
+                try:
+                    self.last_report = run_maintenance()
+                except Exception as e:
+                    logger.error("Ошибка обслуживания БД: %s", e)
+            time.sleep(self.check_every)
+
+
+maintenance = MaintenanceScheduler(MAINTENANCE_HOUR, MAINTENANCE_WINDOW_HOURS, MAINTENANCE_CHECK_SECONDS)
+
+# ---------- Сборщик брошенных черновиков и состояний ----------
+# user_state без изменений дольше N часов удаляется (пользователь бросил загрузку);
+# осиротевший user_state (анкета удалена, в архиве или уже не в pending, пользователя нет) — на ближайшем проходе
+STATE_TTL_HOURS = int(os.getenv("STATE_TTL_HOURS", "12"))
+# Анкета в pending без единого файла, с которой N часов ничего не делали (создание или последнее
+# действие в user_state), закрывается (status -2); черновик DraftStore без изменений N часов удаляется из памяти
+DRAFT_TTL_HOURS = int(os.getenv("DRAFT_TTL_HOURS", "48"))
+# Сообщить пользователю о закрытии черновика (через outbox)
+DRAFT_EXPIRE_NOTIFY = os.getenv("DRAFT_EXPIRE_NOTIFY", "1") == "1"
+SWEEP_INTERVAL_SECONDS = float(os.getenv("SWEEP_INTERVAL_SECONDS", "300"))
+# Строк за одну транзакцию: _db_lock держится миллисекунды, между пачками проходят хендлеры
+SWEEP_BATCH = int(os.getenv("SWEEP_BATCH", "200"))
+SWEEP_PAUSE_SECONDS = 0.05
+DRAFT_EXPIRED_NOTICE = ("⌛ Анкета {app} закрыта: за {hours} ч. её не отправили на модерацию. "
+                        "Когда будете готовы — создайте новую через /start.")
+EXPIRED_TOTAL = metrics.counter("bot_expired_total", "Удалено/закрыто сборщиком", ("kind",))
+
+def expire_user_states(ttl_hours: int = STATE_TTL_HOURS, limit: int = SWEEP_BATCH) -> int:
+    """Одна пачка устаревших и осиротевших user_state; сколько удалено"""
+    rows = db_execute("""
+        DELETE FROM user_state WHERE user_id IN (
+            SELECT s.user_id FROM user_state s
+            WHERE s.updated_at < datetime('now', ?)
+               OR (s.current_app_id IS NOT NULL AND NOT EXISTS (
+                       SELECT 1 FROM applications a WHERE a.id = s.current_app_id AND a.status = 0))
+               OR NOT EXISTS (SELECT 1 FROM users u WHERE u.user_id = s.user_id)
+            LIMIT ?
+        )
+        RETURNING user_id
+    """, (f"-{int(ttl_hours)} hours", limit), fetchall=True) or []
+    for r in rows:
+        _invalidate(_state_cache, r['user_id'])
+    return len(rows)
+
+def expire_drafts(ttl_hours: int = DRAFT_TTL_HOURS, limit: int = SWEEP_BATCH,
+                  notify: bool = DRAFT_EXPIRE_NOTIFY) -> List[Dict[str, Any]]:
+    """
+    Одна пачка брошенных черновиков: status -2, их user_state и уведомления — одной транзакцией.
+    Черновик — pending без единого файла; срок считается от последней активности: создания анкеты
+    или обновления user_state, которое указывает на неё (пользователь, нажавший кнопку загрузки
+    перед самым сроком, анкету не теряет).
+    """
+    now = datetime.now().isoformat(sep=' ')
+    cutoff = f"-{int(ttl_hours)} hours"
+    with db_transaction():
+        rows = db_execute("""
+            UPDATE applications SET status = -2, moderated_at = ?1
+            WHERE id IN (
+                SELECT a.id FROM applications a
+                LEFT JOIN user_state s ON s.user_id = a.user_id AND s.current_app_id = a.id
+                WHERE a.status = 0 AND a.created_at < datetime('now', ?2)
+                  AND a.normal_count = 0 AND a.intimate_count = 0
+                  AND (s.updated_at IS NULL OR s.updated_at < datetime('now', ?2))
+                ORDER BY a.created_at LIMIT ?3
+            )
+            RETURNING id, user_id
+        """, (now, cutoff, limit), fetchall=True) or []
+        if rows:
+            db_execute("""
+                DELETE FROM user_state
+                WHERE user_id IN (SELECT value FROM json_each(?)) AND current_app_id IN (SELECT value FROM json_each(?))
+            """, (json.dumps([r['user_id'] for r in rows]), json.dumps([r['id'] for r in rows])))
+            if notify:
+                outbox_put_many([(r['user_id'], DRAFT_EXPIRED_NOTICE.format(app=app_ref(r['id']), hours=ttl_hours),
+                                  f"draft_expired:{r['id']}") for r in rows])
+        for r in rows:
+            _invalidate(_app_cache, r['id'])
+            _invalidate(_state_cache, r['user_id'])
+    return rows
+
+def expire_memory_drafts(ttl_hours: int = DRAFT_TTL_HOURS, state_ttl_hours: int = STATE_TTL_HOURS,
+                         notify: bool = DRAFT_EXPIRE_NOTIFY) -> Tuple[int, int]:
+    """Черновики DraftStore: без изменений дольше ttl — удаляются (с уведомлением), ожидание файлов старше state_ttl — сбрасывается"""
+    expired, idle = drafts.expire(ttl_hours * 3600, state_ttl_hours * 3600)
+    if expired and notify:
+        # у черновика нет постоянного id — ключ из пользователя и времени создания
+        outbox_put_many([(d['user_id'], DRAFT_EXPIRED_NOTICE.format(app=app_ref(d['id']), hours=ttl_hours),
+                          f"draft_expired:{d['user_id']}:{int(d['created_ts'])}") for d in expired])
+    return len(expired), idle
+
+def sweep_expired(batch: int = SWEEP_BATCH) -> Dict[str, int]:
+    """Весь проход сборщика: пачками, каждая — своей короткой транзакцией"""
+    report = {"drafts": 0, "states": 0}
+    report["drafts"], report["states"] = expire_memory_drafts()
+    # сначала черновики — их user_state уходят вместе с ними
+    for kind, step in (("drafts", lambda: len(expire_drafts(limit=batch))),
+                       ("states", lambda: expire_user_states(limit=batch))):
+        while True:
+            done = step()
+            report[kind] += done
+            if done < batch:
+                break
+            time.sleep(SWEEP_PAUSE_SECONDS)
+        if report[kind]:
+            EXPIRED_TOTAL.inc(kind, amount=report[kind])
+    return report
+
+
+class ExpirySweeper:
+    """Фоновый поток: раз в interval секунд — sweep_expired"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="expiry-sweeper", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                report = sweep_expired()
+                if any(report.values()):
+                    logger.info("Сборщик: закрыто черновиков %s, удалено состояний %s",
+                                report["drafts"], report["states"])
+            except Exception as e:
+                logger.error("Ошибка сборщика просроченных данных: %s", e)
+            time.sleep(self.interval)
+
+
+sweeper = ExpirySweeper(SWEEP_INTERVAL_SECONDS)
+
+# ---------- Очередь исходящих сообщений (лимиты Telegram) ----------
+# ~30 сообщений/с на бота и ~1/с в один чат (с небольшим всплеском)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_QUEUE_WORKERS = int(os.getenv("SEND_QUEUE_WORKERS", "4"))
+# Сколько раз повторяем вызов при 429/сбоях сети
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+# Сколько по-чатовых счётчиков держим, прежде чем выбросить простаивающие
+SEND_CHAT_BUCKETS_MAX = 10000
+
+
+class TokenBucket:
+    """Ведро жетонов: rate жетонов в секунду, не больше capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Взять жетон: 0 — взяли, иначе сколько секунд ждать до следующего"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def idle(self) -> bool:
+        with self._lock:
+            return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+def retry_delay(e: Exception, attempt: int) -> Optional[float]:
+    """Через сколько секунд повторить вызов Bot API, или None — ошибка окончательная"""
+    # error_code есть у ApiTelegramException и sync-, и asyncio-клиента telebot
+    error_code = getattr(e, "error_code", None)
+    if error_code is not None:
+        if error_code == 429:
+            params = (getattr(e, "result_json", None) or {}).get("parameters") or {}
+            return float(params.get("retry_after", 1))
+        if error_code >= 500:
+            return float(2 ** attempt)
+        return None
+    if isinstance(e, (RequestsConnectionError, RequestsTimeout)):
+        return float(2 ** attempt)
+    return None
+
+def call_with_retry(fn, *args, **kwargs):
+    """Вызов Bot API с учётом retry_after и повторами при временных сбоях"""
+    attempt = 0
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            delay = retry_delay(e, attempt)
+            if delay is None or attempt >= SEND_MAX_RETRIES:
+                raise
+            attempt += 1
+            logger.debug("Повтор %s через %.1f с: %s", getattr(fn, "__name__", fn), delay, e)
+            time.sleep(delay)
+
+
+class SendQueue:
+    """
+    Исходящие вызовы Bot API: хендлеры только ставят задачу в очередь,
+    пул воркеров отправляет с глобальным и по-чатовым лимитами,
+    учитывает retry_after и повторяет временные ошибки.
+    Порядок внутри одного чата не гарантируется.
+    """
+
+    def __init__(self, workers: int, global_rate: float, chat_rate: float, chat_burst: float):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}  # chat_id -> TokenBucket
+        self._chats_lock = threading.Lock()
+        self._heap = []  # (ready_at, seq, job)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._inflight = 0
+        # счётчики пишут рабочие потоки — только под self._cond
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def submit(self, chat_id: int, fn, *args, on_done=None, on_error=None, **kwargs):
+        job = {"chat_id": chat_id, "fn": fn, "args": args, "kwargs": kwargs,
+               "attempt": 0, "on_done": on_done, "on_error": on_error}
+        with self._cond:
+            if not self._threads:
+                self._start()
+            self._push(job, time.monotonic())
+
+    def send_message(self, chat_id: int, text: str, **kwargs):
+        self.submit(chat_id, bot.send_message, chat_id, text, **kwargs)
+
+    def acquire(self, chat_id: int):
+        """Дождаться жетонов для отправки в chat_id (для вызовов мимо очереди)"""
+        while True:
+            wait = self._chat_bucket(chat_id).reserve()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        while True:
+            wait = self._global.reserve()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+
+    def depth(self) -> int:
+        with self._cond:
+            return len(self._heap) + self._inflight
+
+    def join(self, timeout: float) -> bool:
+        """Подождать, пока очередь опустеет (при завершении процесса)"""
+        deadline = time.monotonic() + timeout
+        while self.depth():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            counts = {"sent": self.sent, "retried": self.retried, "failed": self.failed}
+        return {"queued": self.depth(), **counts, "chat_buckets": len(self._chats)}
+
+    def _start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"send-queue-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def _push(self, job, ready_at: float):
+        # вызывается под self._cond
+        heapq.heappush(self._heap, (ready_at, next(self._seq), job))
+        self._cond.notify()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        with self._chats_lock:
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                if len(self._chats) >= SEND_CHAT_BUCKETS_MAX:
+                    self._chats = {k: b for k, b in self._chats.items() if not b.idle()}
+                bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            return bucket
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    _, _, job = heapq.heappop(self._heap)
+                    self._inflight += 1
+                    return job
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            try:
+                self._process(job)
+            except Exception as e:
+                # упавший on_done/on_error не должен убивать воркер
+                logger.error("Ошибка в задаче очереди отправки: %s", e)
+            finally:
+                with self._cond:
+                    self._inflight -= 1
+
+    def _process(self, job):
+        wait = self._chat_bucket(job["chat_id"]).reserve()
+        if wait > 0:
+            # чат исчерпал лимит — вернём задачу в очередь, воркер не простаивает
+            with self._cond:
+                self._push(job, time.monotonic() + wait)
+            return
+        while True:
+            wait = self._global.reserve()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        try:
+            result = job["fn"](*job["args"], **job["kwargs"])
+        except Exception as e:
+            delay = retry_delay(e, job["attempt"])
+            if delay is not None and job["attempt"] < SEND_MAX_RETRIES:
+                job["attempt"] += 1
+                with self._cond:
+                    self.retried += 1
+                    self._push(job, time.monotonic() + delay)
+                return
+            with self._cond:
+                self.failed += 1
+            logger.warning("Не удалось отправить в чат %s: %s", job["chat_id"], e)
+            if job["on_error"]:
+                job["on_error"](e)
+            return
+        with self._cond:
+            self.sent += 1
+        if job["on_done"]:
+            job["on_done"](result)
+
+
+outbound = SendQueue(SEND_QUEUE_WORKERS, SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST)
+
+# ---------- Outbox (гарантированная доставка уведомлений) ----------
+# Уведомления пишутся в таблицу outbox той же транзакцией, что и смена состояния;
+# фоновый поток забирает их пачками, отправляет через outbound и отмечает результат.
+# Доставка «хотя бы раз»: после падения процесса неподтверждённые строки уйдут повторно.
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "50"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+# После стольких попыток (каждая — с повторами внутри outbound) строка помечается недоставленной
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "600"))
+# Доставленные строки храним N дней — столько же работает защита по idem_key
+OUTBOX_KEEP_DAYS = int(os.getenv("OUTBOX_KEEP_DAYS", "7"))
+
+def _markup_json(reply_markup) -> Optional[str]:
+    if reply_markup is None or isinstance(reply_markup, str):
+        return reply_markup
+    return reply_markup.to_json()
+
+def outbox_put(chat_id: int, text: str, reply_markup=None, key: Optional[str] = None,
+               batch: Optional[str] = None) -> bool:
+    """
+    Поставить уведомление в outbox — в текущей транзакции, если она открыта.
+    key — ключ идемпотентности: повтор с тем же key ничего не добавит. True — строка добавлена.
+    """
+    added = db_execute("""
+        INSERT INTO outbox (idem_key, chat_id, text, reply_markup, batch) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (idem_key) DO NOTHING
+    """, (key, chat_id, text, _markup_json(reply_markup), batch))
+    if added:
+        # разбудить отправку, когда строка станет видна (после коммита)
+        on_commit(outbox.wake)
+    return bool(added)
+
+def outbox_put_many(items, batch: Optional[str] = None) -> Optional[int]:
+    """Пачка уведомлений (chat_id, text, key) одним executemany"""
+    count = db_executemany("""
+        INSERT INTO outbox (idem_key, chat_id, text, batch) VALUES (?, ?, ?, ?)
+        ON CONFLICT (idem_key) DO NOTHING
+    """, [(key, chat_id, text, batch) for chat_id, text, key in items])
+    on_commit(outbox.wake)
+    return count
+
+
+class OutboxDrainer:
+    """
+    Фоновая доставка outbox: забирает созревшие строки пачками (не больше batch в работе),
+    отправляет через SendQueue, результаты пишет в БД пачкой.
+    Временные ошибки — повтор с экспоненциальной задержкой, окончательные (403/400) — сразу -1.
+    """
+
+    def __init__(self, batch: int, poll: float, max_attempts: int):
+        self.batch = batch
+        self.poll = poll
+        self.max_attempts = max_attempts
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._results = []  # (status, next_attempt_at, last_error, id)
+        self._inflight = 0
+        self._listeners = {}  # batch -> объект с done()/error()
+        self._pruned_at = 0.0
+        # счётчики результатов — только под self._lock (их пишут потоки SendQueue)
+        self.delivered = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self):
+        """Запустить поток; строки, взятые в работу упавшим процессом, вернуть в очередь"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="outbox-drainer", daemon=True)
+        requeued = db_execute("UPDATE outbox SET status = 0 WHERE status = 1")
+        if requeued:
+            logger.info("Outbox: %s неподтверждённых уведомлений будут отправлены повторно", requeued)
+        self._thread.start()
+
+    def wake(self):
+        if self._thread is None:
+            self.start()
+        self._wake.set()
+
+    def watch(self, batch: str, listener):
+        """Сообщать listener.done()/error() об окончательном результате строк пачки batch"""
+        with self._lock:
+            self._listeners[batch] = listener
+
+    def unwatch(self, batch: str):
+        with self._lock:
+            self._listeners.pop(batch, None)
+
+    def flush(self) -> int:
+        """Записать накопленные результаты отправки (и при завершении процесса)"""
+        with self._lock:
+            results, self._results = self._results, []
+        if not results:
+            return 0
+        db_executemany("""
+            UPDATE outbox SET status = ?1, next_attempt_at = ?2, last_error = ?3,
+                sent_at = CASE WHEN ?1 = 2 THEN CURRENT_TIMESTAMP END
+            WHERE id = ?4
+        """, results)
+        return len(results)
+
+    def pending(self) -> int:
+        row = db_execute("SELECT COUNT(*) AS c FROM outbox WHERE status IN (0, 1)", (), fetchone=True)
+        return row['c'] if row else 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = {"delivered": self.delivered, "retried": self.retried, "failed": self.failed}
+        return {"pending": self.pending(), **counts}
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll)
+            self._wake.clear()
+            try:
+                self.flush()
+                self._claim()
+                self._prune()
+            except Exception as e:
+                logger.error("Ошибка отправки outbox: %s", e)
+
+    def _claim(self):
+        with self._lock:
+            free = self.batch - self._inflight
+        if free <= 0:
+            return
+        rows = db_execute("""
+            UPDATE outbox SET status = 1, attempts = attempts + 1
+            WHERE id IN (SELECT id FROM outbox WHERE status = 0 AND next_attempt_at <= ?
+                         ORDER BY next_attempt_at, id LIMIT ?)
+            RETURNING id, chat_id, text, reply_markup, batch, attempts
+        """, (time.time(), free), fetchall=True) or []
+        if not rows:
+            return
+        with self._lock:
+            self._inflight += len(rows)
+        for row in rows:
+            outbound.submit(row['chat_id'], bot.send_message, row['chat_id'], row['text'],
+                            reply_markup=row['reply_markup'],
+                            on_done=functools.partial(self._done, row),
+                            on_error=functools.partial(self._error, row))
+        if len(rows) == free:
+            # забрали полную пачку — возможно, есть ещё
+            self._wake.set()
+
+    def _done(self, row, _result):
+        self._finish(row, (2, 0, None, row['id']), ok=True)
+
+    def _error(self, row, e: Exception):
+        permanent = retry_delay(e, 0) is None
+        if permanent or row['attempts'] >= self.max_attempts:
+            self._finish(row, (-1, 0, str(e)[:200], row['id']), ok=False)
+            return
+        delay = min(OUTBOX_BACKOFF_MAX, 5.0 * 2 ** row['attempts'])
+        self._finish(row, (0, time.time() + delay, str(e)[:200], row['id']), ok=None)
+
+    def _finish(self, row, result, ok: Optional[bool]):
+        # ok=None — строка вернётся в очередь, результат ещё не окончательный
+        with self._lock:
+            self._results.append(result)
+            self._inflight -= 1
+            if ok is True:
+                self.delivered += 1
+            elif ok is False:
+                self.failed += 1
+            else:
+                self.retried += 1
+            listener = self._listeners.get(row['batch']) if row['batch'] else None
+        if listener is not None and ok is not None:
+            if ok:
+                listener.done()
+            else:
+                listener.error()
+        self._wake.set()
+
+    def _prune(self):
+        now = time.monotonic()
+        if now - self._pruned_at < 3600:
+            return
+        self._pruned_at = now
+        db_execute("DELETE FROM outbox WHERE status IN (2, -1) AND created_at < datetime('now', ?)",
+                   (f"-{OUTBOX_KEEP_DAYS} days",))
+
+
+outbox = OutboxDrainer(OUTBOX_BATCH, OUTBOX_POLL_SECONDS, OUTBOX_MAX_ATTEMPTS)
+
+# ---------- Отправка медиа админам (sendMediaGroup) ----------
+# Сколько чатов обслуживаем параллельно
+MEDIA_SEND_WORKERS = int(os.getenv("MEDIA_SEND_WORKERS", "4"))
+# Telegram принимает в одном альбоме от 2 до 10 файлов
+MEDIA_GROUP_LIMIT = 10
+
+_media_executor = ThreadPoolExecutor(max_workers=MEDIA_SEND_WORKERS, thread_name_prefix="media-send")
+
+def build_media_albums(medias: List[Dict[str, Any]]) -> Tuple[List[list], List[Tuple[str, str]]]:
+    """
+    Фото и видео — альбомами до 10 файлов, отдельно обычные и интимные;
+    подпись у первого файла группы. Группа делится на альбомы поровну, чтобы ни в одном
+    не остался один файл (11 -> 6 + 5); группа из одного файла — одиночная отправка.
+    GIF в альбом не входят — (file_id, подпись).
+    """
+    albums_out = []
+    animations = []
+    for media_type, title in (("normal", "Обычные"), ("intimate", "Интимные")):
+        group = [m for m in medias if m['media_type'] == media_type and m['kind'] in ("photo", "video")]
+        parts = -(-len(group) // MEDIA_GROUP_LIMIT)
+        start = 0
+        for n in range(parts):
+            size = len(group) // parts + (1 if n < len(group) % parts else 0)
+            chunk = []
+            for m in group[start:start + size]:
+                caption = f"{title}: {len(group)}" if start == 0 and not chunk else None
+                input_cls = InputMediaPhoto if m['kind'] == "photo" else InputMediaVideo
+                chunk.append(input_cls(m['file_id'], caption=caption))
+            albums_out.append(chunk)
+            start += size
+        animations += [(m['file_id'], f"GIF — {title.lower()}")
+                       for m in medias if m['media_type'] == media_type and m['kind'] == "animation"]
+    return albums_out, animations
+
+def media_chunk_call(api, chat_id: int, chunk: list):
+    """(метод, args, kwargs) для части альбома: sendMediaGroup берёт только 2–10 файлов, один — sendPhoto/sendVideo"""
+    if len(chunk) > 1:
+        return api.send_media_group, (chat_id, chunk), {}
+    item = chunk[0]
+    method = api.send_photo if item.type == "photo" else api.send_video
+    return method, (chat_id, item.media), {"caption": item.caption}
+
+def _send_media_to_chat(chat_id: int, albums_out: List[list], animations: List[Tuple[str, str]]):
+    # внутри одного чата — по порядку; параллельность только между чатами
+    for chunk in albums_out:
+        try:
+            outbound.acquire(chat_id)
+            method, args, kwargs = media_chunk_call(bot, chat_id, chunk)
+            call_with_retry(method, *args, **kwargs)
+        except Exception as e:
+            logger.warning("Не удалось отправить альбом в чат %s: %s", chat_id, e)
+    for file_id, caption in animations:
+        try:
+            outbound.acquire(chat_id)
+            call_with_retry(bot.send_animation, chat_id, file_id, caption=caption)
+        except Exception as e:
+            logger.warning("Не удалось отправить GIF в чат %s: %s", chat_id, e)
+
+def send_application_media(chat_ids, application_id: int) -> list:
+    """Разослать медиа анкеты в чаты (админам) в фоне; возвращает futures"""
+    medias = get_application_media(application_id)
+    if not medias:
+        return []
+    albums_out, animations = build_media_albums(medias)
+    return [_media_executor.submit(_send_media_to_chat, chat_id, albums_out, animations) for chat_id in chat_ids]
+
+# ---------- Альбомы (media_group_id) ----------
+# Сколько ждать следующий файл альбома, прежде чем сохранить его целиком (секунды)
+ALBUM_WINDOW_SECONDS = float(os.getenv("ALBUM_WINDOW_SECONDS", "1.0"))
+
+
+class AlbumBuffer:
+    """
+    Копит сообщения одного альбома и отдаёт их пачкой, когда поток файлов затих:
+    on_album(key, items, context), context — тот, что передан с первым файлом группы.
+    """
+
+    def __init__(self, window: float, on_album):
+        self.window = window
+        self.on_album = on_album
+        self._groups = {}  # key -> {"items": [...], "context": ..., "last": monotonic}
+        self._lock = threading.Lock()
+
+    def add(self, key, item, context=None):
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = {"items": [], "context": context, "last": 0.0}
+                self._schedule(key, self.window)
+            group["items"].append(item)
+            group["last"] = time.monotonic()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._groups)
+
+    def _schedule(self, key, delay: float):
+        timer = threading.Timer(delay, self._fire, args=(key,))
+        timer.daemon = True
+        timer.start()
+
+    def _fire(self, key):
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                return
+            # за время ожидания пришёл ещё файл — ждём тишины дальше
+            quiet = time.monotonic() - group["last"]
+            if quiet < self.window:
+                self._schedule(key, self.window - quiet)
+                return
+            del self._groups[key]
+        try:
+            self.on_album(key, group["items"], group["context"])
+        except Exception as e:
+            logger.error("Ошибка при сохранении альбома %s: %s", key, e)
+
+# ---------- Тексты ----------
+# Постоянные тексты — одни строки на все вызовы (и для main_async.py)
+TEXT_BANNED = "🚫 Вы заблокированы и не можете использовать бота. Для вопросов обратитесь к администратору."
+TEXT_START_APPROVED = (
+    "✅ Доступ открыт. Вы можете работать во всех разделах.\n\n"
+    "Выберите действие:\n"
+    "- Отправить контент прямо в чат\n"
+    "- /status — проверить статус\n"
+    "- /my — мои анкеты"
+)
+TEXT_START_PENDING = (
+    "📝 Вы в режиме ожидания (pending).\n\n"
+    "1) Нажмите «Создать анкету» — выберите раздел и загрузите фото.\n"
+    "2) Анкета будет скрыта от остальных и отправлена админам.\n"
+    "3) Админ принимает единое решение: одобрить / отклонить / запросить правки.\n\n"
+    "⚠️ Пока анкета не одобрена — разделы скрыты, писать в общие разделы нельзя."
+)
+TEXT_CHOOSE_SECTION = "Выберите раздел для анкеты (можно выбрать только один):"
+# шаблон: .format(app=app_ref(app_id), section=...)
+TEXT_APP_CREATED = (
+    "📝 Анкета {app} создана. Раздел: *{section}*.\n\n"
+    "Теперь нужно загрузить медиа:\n"
+    "• Обычные фото — 1 или более\n"
+    "• Интимные фото — 1 или более\n\n"
+    "Порядок любой. Нажимайте кнопки ниже, чтобы добавить соответствующий тип и отправить файлы.\n"
+    "Когда всё готово — нажмите *Готово (отправить на модерацию)*."
+)
 
-def get_user(user_id: int) -> Optional[Dict[str, Any]]:
-    return db_execute("SELECT * FROM users WHERE user_id = ?", (user_id,), fetchone=True)
+# ---------- Клавиатуры ----------
+# Статичные клавиатуры сериализуются в JSON один раз при импорте: telebot отправляет
+# строку reply_markup как есть, без сборки объектов и to_json() на каждое сообщение.
+# Клавиатуры с id анкеты — строковый шаблон + небольшой LRU на недавние id.
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", "256"))
+_KB_ID = "__ID__"
 
-def set_user_status(user_id: int, status: str):
-    db_execute("UPDATE users SET status = ?, last_activity = CURRENT_TIMESTAMP WHERE user_id = ?", (status, user_id))
+def _kb_json(*rows) -> str:
+    """rows: [(текст, callback_data), ...] на каждый ряд кнопок -> JSON inline-клавиатуры"""
+    keyboard = [[{"text": text, "callback_data": data} for text, data in row] for row in rows]
+    return json.dumps({"inline_keyboard": keyboard}, ensure_ascii=False, separators=(",", ":"))
 
-def get_active_application_for_user(user_id: int) -> Optional[Dict[str, Any]]:
-    return db_execute("""
-        SELECT * FROM applications WHERE user_id = ? AND status = 0 ORDER BY created_at DESC LIMIT 1
-    """, (user_id,), fetchone=True)
+KB_START_PENDING = _kb_json(
+    [("📝 Создать анкету", "create_app")],
+    [("ℹ️ Статус", "show_status")],
+)
+KB_SECTIONS = _kb_json(*([(section.capitalize(), f"sec_{section}")] for section in SECTIONS))
+KB_ADMIN_MAIN = _kb_json(
+    [("⏳ Ожидают", "admin_pending"), ("📊 Статистика", "admin_stats")],
+    [("👥 Пользователи", "admin_users")],
+)
+_KB_MEDIA_ACTIONS = _kb_json(
+    [("➕ Добавить обычное", f"add_normal_{_KB_ID}"), ("➕ Добавить интимное", f"add_intimate_{_KB_ID}")],
+    [("✅ Готово (отправить на модерацию)", f"submit_app_{_KB_ID}"), ("🔄 Сбросить анкету", f"reset_app_{_KB_ID}")],
+)
+_KB_MODERATION = _kb_json(
+    [("✅ Одобрить", f"mod_app_appr_{_KB_ID}"), ("❌ Отклонить", f"mod_app_rej_{_KB_ID}")],
+    [("✏️ Запросить правки", f"mod_app_fix_{_KB_ID}"), ("👁️ Просмотреть", f"mod_app_view_{_KB_ID}")],
+)
 
-def create_application(user_id: int, section: str) -> int:
-    # запрещаем создавать новую pending, если уже есть одна
-    active = get_active_application_for_user(user_id)
-    if active:
-        return active['id']
-    app_id = db_execute("""
-        INSERT INTO applications (user_id, section, status) VALUES (?, ?, 0)
-    """, (user_id, section), return_id=True)
-    # create/update user_state
-    db_execute("""
-        INSERT OR REPLACE INTO user_state (user_id, current_app_id, awaiting_media_type, last_action, updated_at)
-        VALUES (?, ?, NULL, 'created_app', CURRENT_TIMESTAMP)
-    """, (user_id, app_id))
-    return app_id
+def kb_start_pending() -> str:
+    return KB_START_PENDING
 
-def add_media(application_id: int, media_type: str, kind: str, file_id: str):
-    return db_execute("""
-        INSERT INTO media (application_id, media_type, kind, file_id) VALUES (?, ?, ?, ?)
-    """, (application_id, media_type, kind, file_id), return_id=True)
+def section_kb() -> str:
+    return KB_SECTIONS
 
-def get_media_counts(application_id: int) -> Dict[str, int]:
-    rows = db_execute("""
-        SELECT media_type, COUNT(*) as cnt FROM media WHERE application_id = ? GROUP BY media_type
-    """, (application_id,), fetchall=True)
-    counts = {'normal': 0, 'intimate': 0}
-    for r in rows:
-        counts[r['media_type']] = r['cnt']
-    return counts
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def kb_media_actions(application_id: int) -> str:
+    return _KB_MEDIA_ACTIONS.replace(_KB_ID, str(int(application_id)))
 
-def get_application(application_id: int) -> Optional[Dict[str, Any]]:
-    return db_execute("SELECT * FROM applications WHERE id = ?", (application_id,), fetchone=True)
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def kb_moderation(application_id: int) -> str:
+    return _KB_MODERATION.replace(_KB_ID, str(int(application_id)))
 
-def set_application_status(application_id: int, new_status: int, moderator_id: Optional[int] = None):
-    now = datetime.now().isoformat(sep=' ')
-    db_execute("""
-        UPDATE applications SET status = ?, moderator_id = ?, moderated_at = ? WHERE id = ?
-    """, (new_status, moderator_id, now, application_id))
-    # если approved -> переводим пользователя в approved
-    app = get_application(application_id)
-    if not app:
-        return
-    uid = app['user_id']
-    if new_status == 1:
-        set_user_status(uid, 'approved')
-    elif new_status == -1:
-        set_user_status(uid, 'banned')
-    elif new_status == 2:
-        # needs_fix -> оставляем пользователя pending
-        set_user_status(uid, 'pending')
+def kb_admin_main() -> str:
+    return KB_ADMIN_MAIN
 
-def get_user_state(user_id: int) -> Optional[Dict[str, Any]]:
-    return db_execute("SELECT * FROM user_state WHERE user_id = ?", (user_id,), fetchone=True)
+# Очередь модерации: admin_pending[_{раздел|all}[_{n|p}_{epoch}_{id}]] — курсор целиком в callback_data
+def pending_cb(section: Optional[str], direction: Optional[str] = None, row: Optional[Dict[str, Any]] = None) -> str:
+    data = f"admin_pending_{section or 'all'}"
+    if direction:
+        data += f"_{direction}_{row['created_epoch']}_{row['id']}"
+    return data
 
-def set_user_state(user_id: int, current_app_id: Optional[int], awaiting_media_type: Optional[str], last_action: str):
-    db_execute("""
-        INSERT OR REPLACE INTO user_state (user_id, current_app_id, awaiting_media_type, last_action, updated_at)
-        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-    """, (user_id, current_app_id, awaiting_media_type, last_action))
+def parse_pending_cb(data: str) -> Tuple[Optional[str], Optional[Tuple[int, int]], str]:
+    """(раздел, курсор, направление); ValueError на мусорных данных"""
+    parts = data.split("_")
+    if parts[:2] != ["admin", "pending"] or len(parts) not in (2, 3, 6):
+        raise ValueError(data)
+    section = parts[2] if len(parts) > 2 and parts[2] != "all" else None
+    if section is not None and section not in SECTIONS:
+        raise ValueError(data)
+    if len(parts) < 6:
+        return section, None, "n"
+    if parts[3] not in ("n", "p"):
+        raise ValueError(data)
+    return section, (int(parts[4]), int(parts[5])), parts[3]
 
-def clear_user_state(user_id: int):
-    db_execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+def pending_page_view(rows, section: Optional[str], has_prev: bool, has_next: bool) -> Tuple[str, InlineKeyboardMarkup]:
+    """Текст и клавиатура страницы очереди: просмотр анкет, навигация, фильтр по разделу"""
+    text = f"⏳ Ожидающие анкеты ({section}):\n\n" if section else "⏳ Ожидающие анкеты:\n\n"
+    if not rows:
+        text += "Нет ожидающих анкет."
+    for p in rows:
+        text += f"#{p['id']} — {p['user_id']} ({p['username'] or '-'}) — {p['section']} — 📷 {p['normal_count']}/{p['intimate_count']} — {p['created_at'][:16]}\n"
+    kb = InlineKeyboardMarkup(row_width=5)
+    kb.add(*(InlineKeyboardButton(f"👁 #{p['id']}", callback_data=f"mod_app_view_{p['id']}") for p in rows))
+    nav = []
+    if has_prev and rows:
+        nav.append(InlineKeyboardButton("⬅️ Новее", callback_data=pending_cb(section, "p", rows[0])))
+    if has_next and rows:
+        nav.append(InlineKeyboardButton("Старше ➡️", callback_data=pending_cb(section, "n", rows[-1])))
+    if nav:
+        kb.row(*nav)
+    filters = [(None, "Все")] + [(s, s.capitalize()) for s in SECTIONS]
+    kb.row(*(InlineKeyboardButton(("• " if value == section else "") + label, callback_data=pending_cb(value))
+             for value, label in filters))
+    return text, kb
 
-def check_rate_limit(user_id: int) -> Tuple[bool, int]:
-    """Последняя заявка (любая) — не раньше, чем RATE_LIMIT_MINUTES"""
-    last = db_execute("""
-        SELECT created_at FROM applications WHERE user_id = ? ORDER BY created_at DESC LIMIT 1
-    """, (user_id,), fetchone=True)
-    if not last:
-        return True, 0
-    last_time = datetime.fromisoformat(last['created_at'])
-    diff = datetime.now() - last_time
-    minutes_passed = diff.total_seconds() / 60.0
-    if minutes_passed < RATE_LIMIT_MINUTES:
-        return False, int(RATE_LIMIT_MINUTES - minutes_passed) + 1
-    return True, 0
+# Массовая модерация: /bulk <approve|reject|fix> <раздел|all> [часов] или /bulk <решение> <id,id,...>
+BULK_USAGE = (
+    "Массовая модерация (только ожидающие анкеты):\n"
+    "/bulk approve пары 24 — одобрить полные анкеты раздела старше 24 ч\n"
+    "/bulk reject all 72 — отклонить все старше 72 ч\n"
+    "/bulk fix 12,15,20 — запросить правки по номерам"
+)
+BULK_LABELS = {"approve": "✅ Одобрение", "reject": "❌ Отклонение", "fix": "✏️ Запрос правок"}
 
-def notify_admins_new_user(user_id: int, username: Optional[str], first_name: Optional[str], last_name: Optional[str]):
-    text = (
-        f"🆕 Новый пользователь: `{user_id}`\n"
-        f"Имя: {first_name or '-'} {last_name or '-'}\n"
-        f"Ник: @{username or '-'}\n"
-        f"Статус: pending\n"
-        f"Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-    )
-    for aid in ADMIN_IDS:
-        try:
-            bot.send_message(aid, text)
-        except Exception as e:
-            logger.debug("Не удалось уведомить админа %s: %s", aid, e)
+def parse_bulk_args(text: str) -> Dict[str, Any]:
+    """Аргументы /bulk -> decision + фильтры для bulk_set_application_status; ValueError на ошибках"""
+    parts = text.split()[1:]
+    if not 2 <= len(parts) <= 3 or parts[0] not in MOD_DECISIONS:
+        raise ValueError(text)
+    params = {"decision": parts[0]}
+    target = parts[1]
+    if target.replace(",", "").isdigit():
+        if len(parts) != 2:
+            raise ValueError(text)
+        params["app_ids"] = [int(x) for x in target.split(",") if x]
+        return params
+    if target != "all" and target not in SECTIONS:
+        raise ValueError(text)
+    params["section"] = None if target == "all" else target
+    params["older_than_hours"] = int(parts[2]) if len(parts) == 3 else 0
+    if params["older_than_hours"] < 0:
+        raise ValueError(text)
+    return params
 
-def notify_admins_new_application(app_id: int):
-    app = get_application(app_id)
-    if not app:
-        return
-    uid = app['user_id']
-    user = get_user(uid)
-    text = (
-        f"📨 Новая анкета #{app_id}\n"
-        f"Пользователь: `{uid}` ({user['first_name'] or '-'}) @{user['username'] or '-'}\n"
-        f"Раздел: {app['section']}\n"
-        f"Время: {app['created_at']}\n"
-    )
-    kb = InlineKeyboardMarkup(row_width=2)
-    kb.add(
-        InlineKeyboardButton("✅ Одобрить", callback_data=f"mod_app_appr_{app_id}"),
-        InlineKeyboardButton("❌ Отклонить", callback_data=f"mod_app_rej_{app_id}"),
-    )
-    kb.add(
-        InlineKeyboardButton("✏️ Запросить правки", callback_data=f"mod_app_fix_{app_id}"),
-        InlineKeyboardButton("👁️ Просмотреть", callback_data=f"mod_app_view_{app_id}")
-    )
-    for aid in ADMIN_IDS:
-        try:
-            bot.send_message(aid, text, reply_markup=kb)
-        except Exception as e:
-            logger.debug("Не удалось отправить заявку админу %s: %s", aid, e)
+def bulk_cb(params: Dict[str, Any]) -> str:
+    return f"bulk_ok_{params['decision']}_{params['section'] or 'all'}_{params['older_than_hours']}_{params['max_id']}"
 
-# ---------- Клавиатуры ----------
-def kb_start_pending():
-    kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton("📝 Создать анкету", callback_data="create_app"))
-    kb.add(InlineKeyboardButton("ℹ️ Статус", callback_data="show_status"))
-    return kb
+def parse_bulk_cb(data: str) -> Dict[str, Any]:
+    parts = data.split("_")
+    if len(parts) != 6 or parts[:2] != ["bulk", "ok"] or parts[2] not in MOD_DECISIONS:
+        raise ValueError(data)
+    if parts[3] != "all" and parts[3] not in SECTIONS:
+        raise ValueError(data)
+    return {"decision": parts[2], "section": None if parts[3] == "all" else parts[3],
+            "older_than_hours": int(parts[4]), "max_id": int(parts[5])}
 
-def section_kb():
-    kb = InlineKeyboardMarkup(row_width=1)
-    kb.add(
-        InlineKeyboardButton("Пары", callback_data="sec_пары"),
-        InlineKeyboardButton("Будуар", callback_data="sec_будуар"),
-        InlineKeyboardButton("Гараж", callback_data="sec_гараж")
-    )
-    return kb
+def bulk_description(params: Dict[str, Any]) -> str:
+    label = BULK_LABELS[params["decision"]]
+    if params.get("app_ids") is not None:
+        return f"{label}: анкеты {', '.join(f'#{i}' for i in params['app_ids'])}"
+    text = f"{label}: раздел {params['section'] or 'все'}"
+    if params["older_than_hours"]:
+        text += f", старше {params['older_than_hours']} ч"
+    return text
 
-def kb_media_actions(application_id: int):
-    kb = InlineKeyboardMarkup(row_width=2)
-    kb.add(
-        InlineKeyboardButton("➕ Добавить обычное", callback_data=f"add_normal_{application_id}"),
-        InlineKeyboardButton("➕ Добавить интимное", callback_data=f"add_intimate_{application_id}")
-    )
-    kb.add(
-        InlineKeyboardButton("✅ Готово (отправить на модерацию)", callback_data=f"submit_app_{application_id}"),
-        InlineKeyboardButton("🔄 Сбросить анкету", callback_data=f"reset_app_{application_id}")
-    )
-    return kb
+def bulk_progress_text(header: str, total: int, sent: int, failed: int) -> str:
+    text = f"{header}\nИзменено анкет: {total}\nУведомлено: {sent}/{total}"
+    if failed:
+        text += f", не доставлено: {failed}"
+    if sent + failed >= total:
+        text += "\n\nГотово."
+    return text
 
-def kb_admin_main():
+def kb_bulk_confirm(params: Dict[str, Any]):
     kb = InlineKeyboardMarkup(row_width=2)
     kb.add(
-        InlineKeyboardButton("⏳ Ожидают", callback_data="admin_pending"),
-        InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
+        InlineKeyboardButton("✅ Выполнить", callback_data=bulk_cb(params)),
+        InlineKeyboardButton("✖️ Отмена", callback_data="bulk_cancel"),
     )
-    kb.add(InlineKeyboardButton("👥 Пользователи", callback_data="admin_users"))
     return kb
 
+# ---------- Роутер callback-кнопок ----------
+def cb_id(value: str) -> int:
+    """Аргумент callback_data: положительный id"""
+    if not value.isdigit():
+        raise ValueError(value)
+    return int(value)
+
+def cb_app_id(value: str) -> int:
+    """Аргумент callback_data: id анкеты или отрицательный id черновика (DraftStore)"""
+    return -cb_id(value[1:]) if value.startswith("-") else cb_id(value)
+
+def cb_section(value: str) -> str:
+    if value not in SECTIONS:
+        raise ValueError(value)
+    return value
+
+
+class CallbackRoute:
+    __slots__ = ("prefix", "handler", "converters", "parse", "admin", "fixed")
+
+    def __init__(self, prefix: str, handler, converters, parse, admin: bool, fixed: Dict[str, Any]):
+        self.prefix = prefix
+        self.handler = handler
+        self.converters = converters
+        self.parse = parse
+        self.admin = admin
+        self.fixed = fixed
+
+
+class CallbackRouter:
+    """
+    callback_data -> (маршрут, аргументы). Формат: {префикс}[_{арг}_{арг}...].
+    Префикс ищется в словаре (по границам «_», от длинного к короткому), аргументы
+    разбираются и проверяются один раз конвертерами маршрута; результат кэшируется.
+    """
+
+    def __init__(self, cache_size: int = 4096):
+        self._routes = {}
+        self.resolve = functools.lru_cache(maxsize=cache_size)(self._resolve)
+
+    def route(self, prefix: str, *converters, parse=None, admin: bool = False, **fixed):
+        """
+        Регистрация хендлера fn(call, *args, **fixed). converters — по одному на аргумент;
+        parse(data) -> tuple — для форматов с переменным числом аргументов.
+        """
+        def decorator(fn):
+            if prefix in self._routes:
+                raise ValueError(f"Префикс {prefix} уже зарегистрирован")
+            self._routes[prefix] = CallbackRoute(prefix, fn, converters, parse, admin, fixed)
+            self.resolve.cache_clear()
+            return fn
+        return decorator
+
+    def routes(self) -> List[CallbackRoute]:
+        return list(self._routes.values())
+
+    def _resolve(self, data: str):
+        """(маршрут, args) | (маршрут, None) — аргументы не прошли проверку | (None, None)"""
+        end = len(data)
+        while end > 0:
+            route = self._routes.get(data[:end])
+            if route is not None:
+                break
+            end = data.rfind("_", 0, end)
+        else:
+            return None, None
+        try:
+            if route.parse is not None:
+                return route, tuple(route.parse(data))
+            parts = data[end + 1:].split("_") if end < len(data) else []
+            if len(parts) != len(route.converters):
+                return route, None
+            return route, tuple(convert(part) for convert, part in zip(route.converters, parts))
+        except (ValueError, TypeError):
+            return route, None
+
+
+router = CallbackRouter()
+
 # ---------- Хендлеры ----------
 
 @bot.message_handler(commands=["start", "help"])
@@ -335,34 +2619,19 @@ def cmd_start(message):
     username = message.from_user.username
     first_name = message.from_user.first_name or ""
     last_name = message.from_user.last_name or ""
-    ensure_user(uid, username, first_name, last_name)
-    user = get_user(uid)
+    user = ensure_user(uid, username, first_name, last_name)
     # Забанен
     if user and user['status'] == 'banned':
-        bot.send_message(uid, "🚫 Вы заблокированы и не можете использовать бота. Для вопросов обратитесь к администратору.")
+        bot.send_message(uid, TEXT_BANNED)
         return
     # Approved -> показать разделы и инструкции
     if user and user['status'] == 'approved':
-        text = (
-            "✅ Доступ открыт. Вы можете работать во всех разделах.\n\n"
-            "Выберите действие:\n"
-            "- Отправить контент прямо в чат\n"
-            "- /status — проверить статус\n"
-            "- /my — мои анкеты"
-        )
-        bot.send_message(uid, text)  # можно добавить keyboard если нужно
+        bot.send_message(uid, TEXT_START_APPROVED)  # можно добавить keyboard если нужно
         return
     # pending
-    text = (
-        "📝 Вы в режиме ожидания (pending).\n\n"
-        "1) Нажмите «Создать анкету» — выберите раздел и загрузите фото.\n"
-        "2) Анкета будет скрыта от остальных и отправлена админам.\n"
-        "3) Админ принимает единое решение: одобрить / отклонить / запросить правки.\n\n"
-        "⚠️ Пока анкета не одобрена — разделы скрыты, писать в общие разделы нельзя."
-    )
-    bot.send_message(uid, text, reply_markup=kb_start_pending())
+    bot.send_message(uid, TEXT_START_PENDING, reply_markup=kb_start_pending())
 
-@bot.callback_query_handler(func=lambda call: call.data == "show_status")
+@router.route("show_status")
 def cb_show_status(call):
     uid = call.from_user.id
     user = get_user(uid)
@@ -370,13 +2639,13 @@ def cb_show_status(call):
         bot.answer_callback_query(call.id, "Не найден пользователь", show_alert=True)
         return
     app = get_active_application_for_user(uid)
-    app_text = f"Активная анкета: #{app['id']} / раздел: {app['section']}" if app else "Активная анкета: нет"
+    app_text = f"Активная анкета: {app_ref(app['id'])} / раздел: {app['section']}" if app else "Активная анкета: нет"
     bot.send_message(uid,
                      f"👤 ID: `{uid}`\nСтатус: {user['status']}\n{app_text}"
                      )
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda call: call.data == "create_app")
+@router.route("create_app")
 def cb_create_app(call):
     uid = call.from_user.id
     user = get_user(uid)
@@ -390,11 +2659,11 @@ def cb_create_app(call):
         bot.answer_callback_query(call.id, "Вы заблокированы.", show_alert=True)
         return
     # показать клавиатуру разделов
-    bot.send_message(uid, "Выберите раздел для анкеты (можно выбрать только один):", reply_markup=section_kb())
+    bot.send_message(uid, TEXT_CHOOSE_SECTION, reply_markup=section_kb())
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("sec_"))
-def cb_section_select(call):
+@router.route("sec", cb_section)
+def cb_section_select(call, section: str):
     uid = call.from_user.id
     user = get_user(uid)
     if not user:
@@ -403,39 +2672,20 @@ def cb_section_select(call):
     if user['status'] != 'pending':
         bot.answer_callback_query(call.id, "Нельзя создавать анкету в текущем статусе.", show_alert=True)
         return
-    section = call.data.split("_", 1)[1]
-    # rate limit (между созданием анкет)
-    can_create, wait = check_rate_limit(uid)
-    if not can_create:
-        bot.answer_callback_query(call.id, f"Нельзя создавать новую анкету. Подождите {wait} мин.", show_alert=True)
+    # лимит — только если будет создана новая анкета (активная просто показывается снова)
+    refusal = None if get_active_application_for_user(uid) else create_app_refusal(uid)
+    if refusal:
+        bot.answer_callback_query(call.id, refusal, show_alert=True)
         return
-    app_id = create_application(uid, section)
+    app_id = open_application(uid, section)
     # send instructions and media keyboard
-    text = (
-        f"📝 Анкета #{app_id} создана. Раздел: *{section}*.\n\n"
-        "Теперь нужно загрузить медиа:\n"
-        "• Обычные фото — 1 или более\n"
-        "• Интимные фото — 1 или более\n\n"
-        "Порядок любой. Нажимайте кнопки ниже, чтобы добавить соответствующий тип и отправить файлы.\n"
-        "Когда всё готово — нажмите *Готово (отправить на модерацию)*."
-    )
-    bot.send_message(uid, text, reply_markup=kb_media_actions(app_id))
-    notify_admins_new_application(app_id)
+    bot.send_message(uid, TEXT_APP_CREATED.format(app=app_ref(app_id), section=section), reply_markup=kb_media_actions(app_id))
     bot.answer_callback_query(call.id, "Анкета создана. Проверьте инструкции в личных сообщениях.")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith(("add_normal_", "add_intimate_")))
-def cb_add_media_start(call):
+@router.route("add_normal", cb_app_id, media_type="normal")
+@router.route("add_intimate", cb_app_id, media_type="intimate")
+def cb_add_media_start(call, app_id: int, media_type: str):
     uid = call.from_user.id
-    parts = call.data.split("_")
-    kind = parts[0]  # add
-    media_tag = parts[1] if len(parts) > 1 else None
-    # call.data formats: add_normal_{appid} or add_intimate_{appid}
-    if call.data.startswith("add_normal_"):
-        app_id = int(call.data.split("_", 2)[2])
-        media_type = "normal"
-    else:
-        app_id = int(call.data.split("_", 2)[2])
-        media_type = "intimate"
     # verify app exists and belongs to user and is pending
     app = get_application(app_id)
     if not app or app['user_id'] != uid or app['status'] != 0:
@@ -446,51 +2696,86 @@ def cb_add_media_start(call):
     bot.send_message(uid, f"Отправьте файл(ы) для типа *{media_type}*. Поддерживаются: фото, видео, GIF. Можно отправлять несколько сообщений по одному файлу.")
     bot.answer_callback_query(call.id, f"Отправьте файлы для {media_type}")
 
+def _extract_media(message) -> Optional[Tuple[str, str]]:
+    """(kind, file_id) из сообщения с фото/видео/GIF"""
+    if message.content_type == 'photo':
+        return 'photo', message.photo[-1].file_id
+    if message.content_type == 'video':
+        return 'video', message.video.file_id
+    if message.content_type == 'animation':
+        return 'animation', message.animation.file_id
+    return None
+
 @bot.message_handler(content_types=["photo", "video", "animation"])
 def media_receive(message):
+    media = _extract_media(message)
+    if media is None:
+        bot.reply_to(message, "Неподдерживаемый тип.")
+        return
+    kind, file_id = media
     uid = message.from_user.id
+    if message.media_group_id:
+        # альбом приходит отдельными апдейтами — копим и сохраняем одной пачкой;
+        # анкету и тип берём в момент прихода первого файла: пока альбом копится,
+        # пользователь может успеть нажать кнопку другого типа
+        albums.add((uid, message.media_group_id), (message, kind, file_id), media_target(uid))
+        return
+    save_received_media(uid, [(message, kind, file_id)], media_target(uid))
+
+def media_target(uid: int) -> Optional[Tuple[int, str]]:
+    """(анкета, тип файлов), которые сейчас ждёт пользователь, или None"""
+    state = get_user_state(uid)
+    if not state or not state.get('current_app_id') or not state.get('awaiting_media_type'):
+        return None
+    return state['current_app_id'], state['awaiting_media_type']
+
+def save_received_media(uid: int, items, target: Optional[Tuple[int, str]]):
+    """
+    Проверки и сохранение файлов (один или целый альбом): items = [(message, kind, file_id)],
+    target — (анкета, тип) на момент прихода файлов (media_target).
+    """
+    first = items[0][0]
     user = get_user(uid)
     if not user:
-        bot.reply_to(message, "Нужен /start сначала.")
+        bot.reply_to(first, "Нужен /start сначала.")
         return
     if user['status'] == 'banned':
-        bot.reply_to(message, "🚫 Вы заблокированы.")
+        bot.reply_to(first, "🚫 Вы заблокированы.")
         return
-    state = get_user_state(uid)
-    if not state or not state.get('current_app_id') or not state.get('awaiting_media_type'):
-        bot.reply_to(message, "ℹ️ Сначала нажмите кнопку 'Добавить обычное' или 'Добавить интимное' в меню анкеты.")
+    if target is None:
+        bot.reply_to(first, "ℹ️ Сначала нажмите кнопку 'Добавить обычное' или 'Добавить интимное' в меню анкеты.")
         return
-    app_id = state['current_app_id']
+    app_id, media_type = target  # media_type: normal | intimate
     app = get_application(app_id)
     if not app or app['user_id'] != uid or app['status'] != 0:
-        bot.reply_to(message, "Анкета не найдена или уже отправлена.")
+        bot.reply_to(first, "Анкета не найдена или уже отправлена.")
         return
-    media_type = state['awaiting_media_type']  # normal | intimate
-    # determine file_id and kind
-    if message.content_type == 'photo':
-        file_id = message.photo[-1].file_id
-        kind = 'photo'
-    elif message.content_type == 'video':
-        file_id = message.video.file_id
-        kind = 'video'
-    elif message.content_type == 'animation':
-        file_id = message.animation.file_id
-        kind = 'animation'
+    if len(items) == 1:
+        saved = add_media(app_id, media_type, items[0][1], items[0][2])
     else:
-        bot.reply_to(message, "Неподдерживаемый тип.")
+        saved = add_media_batch(app_id, media_type, [(kind, file_id) for _, kind, file_id in items])
+    if not saved:
+        bot.reply_to(first, "Ошибка при сохранении файла.")
         return
-    mid = add_media(app_id, media_type, kind, file_id)
-    if not mid:
-        bot.reply_to(message, "Ошибка при сохранении файла.")
-        return
-    bot.reply_to(message, f"Файл сохранён (тип: {media_type}). Чтобы добавить другой тип — нажмите соответствующую кнопку. Готово — нажмите «Готово (отправить на модерацию)» в меню анкеты.")
-    # обновим user_state.updated_at
-    set_user_state(uid, app_id, media_type, f"added_media_{media_type}")
+    if len(items) == 1:
+        bot.reply_to(first, f"Файл сохранён (тип: {media_type}). Чтобы добавить другой тип — нажмите соответствующую кнопку. Готово — нажмите «Готово (отправить на модерацию)» в меню анкеты.")
+    else:
+        bot.reply_to(first, f"Альбом сохранён: {len(items)} файл(ов) (тип: {media_type}). Чтобы добавить другой тип — нажмите соответствующую кнопку. Готово — нажмите «Готово (отправить на модерацию)» в меню анкеты.")
+    # обновим user_state.updated_at — если пользователь тем временем не выбрал другой тип
+    if media_target(uid) == target:
+        set_user_state(uid, app_id, media_type, f"added_media_{media_type}")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("submit_app_"))
-def cb_submit_app(call):
+def _save_album(key, items, target):
+    uid = key[0]
+    items.sort(key=lambda item: item[0].message_id)
+    # сохранение — в очереди пользователя, по порядку с его апдейтами, а не в потоке таймера
+    dispatcher.call(uid, save_received_media, uid, items, target)
+
+albums = AlbumBuffer(ALBUM_WINDOW_SECONDS, _save_album)
+
+@router.route("submit_app", cb_app_id)
+def cb_submit_app(call, app_id: int):
     uid = call.from_user.id
-    app_id = int(call.data.split("_", 2)[2])
     app = get_application(app_id)
     if not app or app['user_id'] != uid:
         bot.answer_callback_query(call.id, "Анкета не найдена.", show_alert=True)
@@ -502,136 +2787,205 @@ def cb_submit_app(call):
     if counts.get('normal', 0) < 1 or counts.get('intimate', 0) < 1:
         bot.answer_callback_query(call.id, "Нужно минимум 1 обычное и 1 интимное фото.", show_alert=True)
         return
-    # Помечаем как pending (она уже pending), уведомляем админов (если не отправляли)
-    notify_admins_new_application(app_id)
-    # очистим состояние
-    clear_user_state(uid)
+    # черновик уходит в БД, админы получают уведомление, состояние очищается — одной транзакцией
+    app_id = submit_application(uid, app_id)
+    if app_id is None:
+        bot.answer_callback_query(call.id, "Анкета не найдена.", show_alert=True)
+        return
     bot.send_message(uid, f"✅ Анкета #{app_id} отправлена на модерацию. Ожидайте решения администратора.")
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("reset_app_"))
-def cb_reset_app(call):
+@router.route("reset_app", cb_app_id)
+def cb_reset_app(call, app_id: int):
     uid = call.from_user.id
-    app_id = int(call.data.split("_", 2)[2])
     app = get_application(app_id)
     if not app or app['user_id'] != uid:
         bot.answer_callback_query(call.id, "Анкета не найдена.", show_alert=True)
         return
     # удаляем медиа и саму анкету (пользователь может создать новую)
-    db_execute("DELETE FROM media WHERE application_id = ?", (app_id,))
-    db_execute("DELETE FROM applications WHERE id = ?", (app_id,))
-    clear_user_state(uid)
+    delete_application(app_id, uid)
     bot.send_message(uid, "🔄 Ваша анкета сброшена. Можете создать новую анкету.")
     bot.answer_callback_query(call.id)
 
 # ---------- Модерация (админ) ----------
-@bot.callback_query_handler(func=lambda call: call.data.startswith("mod_app_"))
-def cb_mod_action(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "Нет прав.", show_alert=True)
-        return
-    parts = call.data.split("_", 2)
-    if len(parts) < 3:
-        bot.answer_callback_query(call.id, "Некорректно.", show_alert=True)
-        return
-    action = parts[1]
-    rest = parts[2]
-    # форматы: mod_app_appr_{id}, mod_app_rej_{id}, mod_app_fix_{id}, mod_app_view_{id}
-    if action == "appr":
-        app_id = int(rest)
-        process_mod_decision(call, app_id, "approve")
-    elif action == "rej":
-        app_id = int(rest)
-        process_mod_decision(call, app_id, "reject")
-    elif action == "fix":
-        app_id = int(rest)
-        process_mod_decision(call, app_id, "fix")
-    elif action == "view":
-        app_id = int(rest)
-        admin_view_application(call, app_id)
-    else:
-        bot.answer_callback_query(call.id, "Неизвестная операция.", show_alert=True)
+@router.route("mod_app_appr", cb_id, admin=True, decision="approve")
+@router.route("mod_app_rej", cb_id, admin=True, decision="reject")
+@router.route("mod_app_fix", cb_id, admin=True, decision="fix")
+def cb_mod_action(call, app_id: int, decision: str):
+    process_mod_decision(call, app_id, decision)
+
+@router.route("mod_app_view", cb_id, admin=True)
+def cb_mod_view(call, app_id: int):
+    admin_view_application(call, app_id)
 
 def process_mod_decision(call, app_id: int, decision: str):
     app = get_application(app_id)
     if not app:
         bot.answer_callback_query(call.id, "Анкета не найдена.", show_alert=True)
         return
-    uid = app['user_id']
     # ensure there are both types
     counts = get_media_counts(app_id)
     if decision == "approve":
         if counts.get('normal', 0) < 1 or counts.get('intimate', 0) < 1:
             bot.answer_callback_query(call.id, "Анкета неполная (требуется обычное + интимное).", show_alert=True)
             return
-        set_application_status(app_id, 1, call.from_user.id)
-        # notify user
-        try:
-            bot.send_message(uid,
-                             f"🎉 Ваша анкета #{app_id} одобрена. Вам открыт доступ ко всем разделам.")
-        except Exception as e:
-            logger.debug("Не удалось уведомить пользователя %s: %s", uid, e)
+        # статус и уведомление пользователю (outbox) — одной транзакцией
+        decide_application(app_id, decision, call.from_user.id)
         bot.answer_callback_query(call.id, "Анкета одобрена.")
         # обновить сообщение модератора
-        try:
-            bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id,
-                                  text=f"✅ Анкета #{app_id} одобрена администратором {call.from_user.first_name}")
-        except Exception:
-            pass
+        _edit_mod_message(call, f"✅ Анкета #{app_id} одобрена администратором {call.from_user.first_name}")
     elif decision == "reject":
-        # полный бан пользователя
-        set_application_status(app_id, -1, call.from_user.id)
-        set_user_status(uid, 'banned')
-        try:
-            bot.send_message(uid, f"❌ Ваша анкета #{app_id} отклонена. Вы заблокированы.")
-        except Exception:
-            pass
+        # полный бан пользователя (статус меняется в той же транзакции)
+        decide_application(app_id, decision, call.from_user.id)
         bot.answer_callback_query(call.id, "Анкета отклонена и пользователь заблокирован.")
-        try:
-            bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id,
-                                  text=f"❌ Анкета #{app_id} отклонена. Пользователь заблокирован.")
-        except Exception:
-            pass
+        _edit_mod_message(call, f"❌ Анкета #{app_id} отклонена. Пользователь заблокирован.")
     elif decision == "fix":
-        set_application_status(app_id, 2, call.from_user.id)  # needs_fix
-        set_user_status(uid, 'pending')
-        try:
-            bot.send_message(uid, f"✏️ Анкета #{app_id} требует исправлений. Пожалуйста, добавьте/замените файлы и нажмите 'Готово'.")
-        except Exception:
-            pass
+        decide_application(app_id, decision, call.from_user.id)  # needs_fix, пользователь -> pending
         bot.answer_callback_query(call.id, "Запрошены правки.")
-        try:
-            bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id,
-                                  text=f"✏️ Анкета #{app_id} помечена как needs_fix.")
-        except Exception:
-            pass
+        _edit_mod_message(call, f"✏️ Анкета #{app_id} помечена как needs_fix.")
+
+def _edit_mod_message(call, text: str):
+    # сообщение модератора — косметика: решение и уведомление уже в БД
+    try:
+        bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text=text)
+    except Exception as e:
+        logger.debug("Не удалось обновить сообщение модератора: %s", e)
 
 def admin_view_application(call, app_id: int):
     app = get_application(app_id)
     if not app:
         bot.answer_callback_query(call.id, "Анкета не найдена.", show_alert=True)
         return
-    medias = db_execute("SELECT * FROM media WHERE application_id = ?", (app_id,), fetchall=True)
     text = f"📋 Анкета #{app_id}\nПользователь: `{app['user_id']}`\nРаздел: {app['section']}\nСтатус: {app['status']}\n\nМедиа:\n"
     counts = get_media_counts(app_id)
     text += f"Обычных: {counts.get('normal',0)}, Интимных: {counts.get('intimate',0)}\n"
     try:
         bot.send_message(call.from_user.id, text)
-        # отправляем медиа (если есть)
-        for m in medias:
-            try:
-                if m['kind'] == 'photo':
-                    bot.send_photo(call.from_user.id, m['file_id'])
-                elif m['kind'] == 'video':
-                    bot.send_video(call.from_user.id, m['file_id'])
-                elif m['kind'] == 'animation':
-                    bot.send_animation(call.from_user.id, m['file_id'])
-            except Exception as e:
-                logger.debug("Не удалось отправить медиа админу: %s", e)
+        # медиа (если есть) — альбомами, в фоне, чтобы не держать хендлер
+        send_application_media([call.from_user.id], app_id)
     except Exception as e:
         logger.error("Ошибка при отправке заявки админу: %s", e)
     bot.answer_callback_query(call.id, "Отправлено в личку.")
 
+class BulkProgress:
+    """
+    Прогресс уведомлений массового решения — правками одного сообщения у админа.
+    Подписывается на пачку outbox до коммита, поэтому итоги могут прийти раньше begin().
+    """
+
+    # не чаще раза в N секунд (лимит на чат), последнее обновление — всегда
+    EDIT_EVERY = 3.0
+
+    def __init__(self, chat_id: int, header: str, batch: str):
+        self.chat_id = chat_id
+        self.header = header
+        self.batch = batch
+        self.message_id = None
+        self.total = None
+        self.sent = 0
+        self.failed = 0
+        self._last_edit = time.monotonic()
+        self._lock = threading.Lock()
+
+    def begin(self, message_id: int, total: int):
+        with self._lock:
+            self.message_id = message_id
+            self.total = total
+        # всё могло успеть доставиться, пока отправлялось сообщение о прогрессе
+        self._report()
+
+    def done(self, _result=None):
+        self._step(ok=True)
+
+    def error(self, _error=None):
+        self._step(ok=False)
+
+    def _step(self, ok: bool):
+        with self._lock:
+            if ok:
+                self.sent += 1
+            else:
+                self.failed += 1
+        self._report()
+
+    def _report(self):
+        with self._lock:
+            if self.message_id is None:
+                return
+            finished = self.sent + self.failed >= self.total
+            now = time.monotonic()
+            if not finished and now - self._last_edit < self.EDIT_EVERY:
+                return
+            self._last_edit = now
+            text = bulk_progress_text(self.header, self.total, self.sent, self.failed)
+        if finished:
+            outbox.unwatch(self.batch)
+        edit = functools.partial(bot.edit_message_text, text, chat_id=self.chat_id, message_id=self.message_id)
+        outbound.submit(self.chat_id, edit)
+
+def run_bulk_moderation(chat_id: int, moderator_id: int, params: Dict[str, Any]):
+    """Одна транзакция на анкеты и уведомления (outbox), прогресс доставки — правками сообщения"""
+    decision = params["decision"]
+    filters = {k: v for k, v in params.items() if k != "decision"}
+    header = bulk_description(params)
+    batch = f"bulk:{moderator_id}:{time.time_ns()}"
+    progress = BulkProgress(chat_id, header, batch)
+    outbox.watch(batch, progress)
+    rows = bulk_set_application_status(decision, moderator_id, batch=batch, **filters)
+    if not rows:
+        outbox.unwatch(batch)
+        bot.send_message(chat_id, "Ни одна анкета не подошла под условия.")
+        return
+    msg = bot.send_message(chat_id, bulk_progress_text(header, len(rows), 0, 0))
+    progress.begin(msg.message_id, len(rows))
+
+@bot.message_handler(commands=["bulk"])
+def cmd_bulk(message):
+    if message.from_user.id not in ADMIN_IDS:
+        bot.reply_to(message, "Доступ запрещён.")
+        return
+    try:
+        params = parse_bulk_args(message.text)
+    except ValueError:
+        bot.reply_to(message, BULK_USAGE)
+        return
+    if params.get("app_ids") is not None:
+        # номера перечислены явно — без подтверждения
+        run_bulk_moderation(message.chat.id, message.from_user.id, params)
+        return
+    params["max_id"] = max_application_id()
+    count = count_bulk_targets(**params)
+    if not count:
+        bot.reply_to(message, "Ни одна анкета не подошла под условия.")
+        return
+    text = f"{bulk_description(params)}\nПод условия подходит анкет: {count}."
+    if count > BULK_MODERATION_MAX:
+        text += f"\nЗа раз будет обработано {BULK_MODERATION_MAX} самых старых."
+    bot.reply_to(message, text + "\n\nВыполнить?", reply_markup=kb_bulk_confirm(params))
+
+@router.route("bulk_cancel", admin=True)
+def cb_bulk_cancel(call):
+    bot.answer_callback_query(call.id, "Отменено.")
+    try:
+        bot.edit_message_text("Массовое действие отменено.", chat_id=call.message.chat.id, message_id=call.message.message_id)
+    except Exception:
+        pass
+
+@router.route("bulk_ok", parse=lambda data: (parse_bulk_cb(data),), admin=True)
+def cb_bulk(call, params: Dict[str, Any]):
+    # убрать кнопки, чтобы не выполнить дважды
+    try:
+        bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=None)
+    except Exception:
+        pass
+    bot.answer_callback_query(call.id, "Выполняется…")
+    run_bulk_moderation(call.message.chat.id, call.from_user.id, params)
+
+@router.route("admin_stats", admin=True)
+def cb_admin_stats(call):
+    bot.send_message(call.from_user.id, stats_text(get_stats()))
+    bot.answer_callback_query(call.id)
+
 # ---------- Доп. команды /admin, /status, /my, /reset ----------
 @bot.message_handler(commands=["admin"])
 def cmd_admin(message):
@@ -642,24 +2996,18 @@ def cmd_admin(message):
     # show simple admin keyboard
     bot.reply_to(message, "Админ-панель:", reply_markup=kb_admin_main())
 
-@bot.callback_query_handler(func=lambda call: call.data == "admin_pending")
-def cb_admin_pending(call):
-    if call.from_user.id not in ADMIN_IDS:
-        bot.answer_callback_query(call.id, "Нет прав", show_alert=True)
-        return
-    pending = db_execute("""
-        SELECT a.id, a.user_id, a.section, a.created_at, u.username, u.first_name
-        FROM applications a LEFT JOIN users u ON a.user_id = u.user_id
-        WHERE a.status = 0 ORDER BY a.created_at DESC LIMIT 20
-    """, (), fetchall=True)
-    if not pending:
-        bot.send_message(call.from_user.id, "Нет ожидающих анкет.")
-        bot.answer_callback_query(call.id)
-        return
-    text = "⏳ Ожидающие анкеты:\n\n"
-    for p in pending:
-        text += f"#{p['id']} — {p['user_id']} ({p['username'] or '-'}) — {p['section']} — {p['created_at'][:16]}\n"
-    bot.send_message(call.from_user.id, text)
+@router.route("admin_pending", parse=parse_pending_cb, admin=True)
+def cb_admin_pending(call, section: Optional[str], cursor: Optional[Tuple[int, int]], direction: str):
+    rows, has_prev, has_next = get_pending_page(section, cursor, direction)
+    text, kb = pending_page_view(rows, section, has_prev, has_next)
+    if call.data == "admin_pending":
+        # из админ-меню — новое сообщение, дальше листаем его же
+        bot.send_message(call.from_user.id, text, reply_markup=kb)
+    else:
+        try:
+            bot.edit_message_text(text, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=kb)
+        except Exception:
+            pass
     bot.answer_callback_query(call.id)
 
 @bot.message_handler(commands=["status"])
@@ -673,7 +3021,7 @@ def cmd_status(message):
     text = f"Статус: {user['status']}\n"
     if app:
         counts = get_media_counts(app['id'])
-        text += f"Активная анкета #{app['id']}, раздел {app['section']}\nОбычных: {counts.get('normal',0)}, Интимных: {counts.get('intimate',0)}"
+        text += f"Активная анкета {app_ref(app['id'])}, раздел {app['section']}\nОбычных: {counts.get('normal',0)}, Интимных: {counts.get('intimate',0)}"
         bot.reply_to(message, text, reply_markup=kb_media_actions(app['id']))
     else:
         bot.reply_to(message, text)
@@ -681,16 +3029,13 @@ def cmd_status(message):
 @bot.message_handler(commands=["my"])
 def cmd_my(message):
     uid = message.from_user.id
-    rows = db_execute("""
-        SELECT id, section, status, created_at FROM applications WHERE user_id = ? ORDER BY created_at DESC LIMIT 10
-    """, (uid,), fetchall=True)
+    rows = get_user_applications(uid)
     if not rows:
         bot.reply_to(message, "У вас нет анкет.")
         return
     text = "Ваши анкеты:\n\n"
-    status_map = {0: "pending", 1: "approved", -1: "rejected", 2: "needs_fix"}
     for r in rows:
-        text += f"#{r['id']} — {r['section']} — {status_map.get(r['status'], r['status'])} — {r['created_at'][:16]}\n"
+        text += f"#{r['id']} — {r['section']} — {APP_STATUS_NAMES.get(r['status'], r['status'])} — {r['created_at'][:16]}\n"
     bot.reply_to(message, text)
 
 @bot.message_handler(commands=["reset"])
@@ -701,11 +3046,313 @@ def cmd_reset(message):
     if not app:
         bot.reply_to(message, "Активной анкеты нет.")
         return
-    db_execute("DELETE FROM media WHERE application_id = ?", (app['id'],))
-    db_execute("DELETE FROM applications WHERE id = ?", (app['id'],))
-    clear_user_state(uid)
+    delete_application(app['id'], uid)
     bot.reply_to(message, "Анкета сброшена. Можете создать новую.")
 
+@bot.callback_query_handler(func=lambda call: True)
+def on_callback(call):
+    """Все callback-кнопки — через router: разбор и проверка data в одном месте"""
+    route, args = router.resolve(call.data or "")
+    if route is None:
+        bot.answer_callback_query(call.id, "Неизвестная операция.", show_alert=True)
+        return
+    if route.admin and call.from_user.id not in ADMIN_IDS:
+        bot.answer_callback_query(call.id, "Нет прав.", show_alert=True)
+        return
+    if args is None:
+        bot.answer_callback_query(call.id, "Некорректно.", show_alert=True)
+        return
+    route.handler(call, *args, **route.fixed)
+
+# ---------- Лимиты действий пользователей (до хендлеров и SQLite) ----------
+# Лимит: "N/секунд" — не больше N действий за окно (ведро на N жетонов, пополняется равномерно).
+# create_app проверяется в хендлере выбора раздела и только когда анкета действительно создаётся;
+# остальные — в диспетчере, до хендлеров.
+RATE_LIMITS = {
+    "create_app": os.getenv("RATE_LIMIT_CREATE_APP", f"1/{RATE_LIMIT_MINUTES * 60}"),
+    "media": os.getenv("RATE_LIMIT_MEDIA", "60/60"),
+    "callback": os.getenv("RATE_LIMIT_CALLBACK", "30/30"),
+    "message": os.getenv("RATE_LIMIT_MESSAGE", "20/30"),
+}
+# Сколько вёдер держим, прежде чем выбросить простаивающие (полные)
+RATE_LIMIT_MAX_ENTRIES = int(os.getenv("RATE_LIMIT_MAX_ENTRIES", "50000"))
+# Пользователю пишем один раз за серию отказов; {wait} — минуты до следующей попытки
+RATE_LIMIT_NOTICES = {
+    "create_app": "Нельзя создавать новую анкету. Подождите {wait} мин.",
+    "media": "Слишком много файлов подряд. Подождите {wait} мин. и отправьте оставшиеся.",
+    "callback": "Слишком часто. Подождите немного.",
+    "message": "Слишком много сообщений. Подождите немного.",
+}
+RATE_LIMITED = metrics.counter("bot_rate_limited_total", "Апдейты, отброшенные лимитом действий", ("action",))
+
+def _parse_limit(spec: str) -> Tuple[float, float]:
+    """'N/секунд' -> (жетонов в секунду, ёмкость ведра)"""
+    count, seconds = spec.split("/")
+    return float(count) / float(seconds), float(count)
+
+def update_action(update) -> Optional[str]:
+    """К какому лимиту относится апдейт (по содержимому, без обращения к БД)"""
+    if update.callback_query is not None:
+        return "callback"
+    message = update.message
+    if message is not None:
+        return "media" if (message.photo or message.video or message.animation) else "message"
+    return None
+
+
+class ActionRateLimiter:
+    """
+    Ведра жетонов по (действие, пользователь). В словаре — список [жетоны, время, предупреждён]:
+    без объекта и блокировки на каждое ведро, одна общая блокировка на микросекунды.
+    """
+
+    def __init__(self, limits: Dict[str, str], max_entries: int):
+        self.limits = {action: _parse_limit(spec) for action, spec in limits.items()}
+        self.max_entries = max_entries
+        self._buckets = {}  # (action, user_id) -> [tokens, updated, warned]
+        self._lock = threading.Lock()
+
+    def check(self, action: str, user_id: int) -> Tuple[bool, float, bool]:
+        """(пропустить?, секунд до следующего жетона, предупредить ли пользователя)"""
+        limit = self.limits.get(action)
+        if limit is None:
+            return True, 0.0, False
+        rate, capacity = limit
+        now = time.monotonic()
+        key = (action, user_id)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_entries:
+                    self._evict(now)
+                bucket = self._buckets[key] = [capacity, now, False]
+            else:
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                bucket[2] = False
+                return True, 0.0, False
+            warn = not bucket[2]
+            bucket[2] = True
+            return False, (1 - bucket[0]) / rate, warn
+
+    def size(self) -> int:
+        return len(self._buckets)
+
+    def _evict(self, now: float):
+        # вызывается под self._lock: полное ведро ничем не отличается от нового
+        limits = self.limits
+        self._buckets = {
+            key: b for key, b in self._buckets.items()
+            if b[0] + (now - b[1]) * limits[key[0]][0] < limits[key[0]][1]
+        }
+
+
+rate_limiter = ActionRateLimiter(RATE_LIMITS, RATE_LIMIT_MAX_ENTRIES)
+
+def rate_limit_update(update, user_id: Optional[int]) -> Optional[Tuple[str, Optional[str]]]:
+    """
+    None — апдейт пропускаем; иначе (действие, текст отказа или None, если уже предупреждали).
+    Админы не ограничиваются.
+    """
+    if user_id is None or user_id in ADMIN_IDS:
+        return None
+    action = update_action(update)
+    if action is None:
+        return None
+    allowed, wait, warn = rate_limiter.check(action, user_id)
+    if allowed:
+        return None
+    RATE_LIMITED.inc(action)
+    text = RATE_LIMIT_NOTICES[action].format(wait=int(wait // 60) + 1) if warn else None
+    return action, text
+
+def create_app_refusal(user_id: int) -> Optional[str]:
+    """
+    Лимит create_app: жетон тратится только на создание новой анкеты (после проверок статуса
+    и активной анкеты в хендлере). Текст отказа или None.
+    """
+    if user_id in ADMIN_IDS:
+        return None
+    allowed, wait, _ = rate_limiter.check("create_app", user_id)
+    if allowed:
+        return None
+    RATE_LIMITED.inc("create_app")
+    return RATE_LIMIT_NOTICES["create_app"].format(wait=int(wait // 60) + 1)
+
+def _reject_update(update, user_id: int, text: Optional[str]):
+    # ответ — через очередь отправки: поток приёма апдейтов не ждёт Telegram
+    if text is None:
+        return
+    if update.callback_query is not None:
+        outbound.submit(user_id, bot.answer_callback_query, update.callback_query.id, text, show_alert=True)
+    else:
+        outbound.send_message(user_id, text)
+
+# ---------- Диспетчер апдейтов ----------
+def _update_user_id(update) -> Optional[int]:
+    for obj in (update.message, update.callback_query, update.edited_message):
+        if obj is not None and obj.from_user is not None:
+            return obj.from_user.id
+    return None
+
+
+class HandlerStats:
+    """Счётчики по хендлерам: вызовы, ошибки, суммарное/максимальное время"""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, elapsed: float, error: bool):
+        with self._lock:
+            item = self._data.get(name)
+            if item is None:
+                item = self._data[name] = {"calls": 0, "errors": 0, "total": 0.0, "max": 0.0}
+            item["calls"] += 1
+            item["errors"] += int(error)
+            item["total"] += elapsed
+            item["max"] = max(item["max"], elapsed)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                name: {
+                    "calls": item["calls"],
+                    "errors": item["errors"],
+                    "avg_ms": round(item["total"] / item["calls"] * 1000, 2),
+                    "max_ms": round(item["max"] * 1000, 2),
+                }
+                for name, item in self._data.items()
+            }
+
+
+handler_stats = HandlerStats()
+
+def _timed_handler(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        error = False
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            error = True
+            HANDLER_ERRORS.inc(fn.__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            handler_stats.record(fn.__name__, elapsed, error)
+            HANDLER_LATENCY.observe(elapsed, fn.__name__)
+    return wrapper
+
+def instrument_handlers():
+    """Обернуть все зарегистрированные хендлеры замером времени (callback — по маршрутам router)"""
+    for handler in bot.message_handlers:
+        if not hasattr(handler['function'], "__wrapped__"):
+            handler['function'] = _timed_handler(handler['function'])
+    wrapped = {}
+    for route in router.routes():
+        if not hasattr(route.handler, "__wrapped__"):
+            if route.handler not in wrapped:
+                wrapped[route.handler] = _timed_handler(route.handler)
+            route.handler = wrapped[route.handler]
+
+
+class UpdateDispatcher:
+    """
+    Раздаёт апдейты по пулу воркеров. Апдейты одного пользователя всегда
+    попадают в одну и ту же очередь (шард по user_id), поэтому обрабатываются
+    строго по порядку — на этом держится поток cb_add_media_start -> media_receive.
+    """
+
+    def __init__(self, telegram_bot, workers: int):
+        self.bot = telegram_bot
+        # исходный обработчик TeleBot: в воркере запускает подходящие хендлеры
+        self._process = telegram_bot.process_new_updates
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self.processed = 0
+
+    def submit(self, updates):
+        if not updates:
+            return
+        self._ensure_started()
+        now = time.monotonic()
+        for update in updates:
+            # polling берёт offset из last_update_id — сдвигаем сразу, не дожидаясь воркера
+            if update.update_id > self.bot.last_update_id:
+                self.bot.last_update_id = update.update_id
+            uid = _update_user_id(update)
+            rejected = rate_limit_update(update, uid)
+            if rejected is not None:
+                _reject_update(update, uid, rejected[1])
+                continue
+            shard = (uid if uid is not None else update.update_id) % len(self._queues)
+            self._queues[shard].put((now, update))
+
+    def call(self, user_id: int, fn, *args):
+        """Выполнить fn(*args) в очереди пользователя — строго по порядку с его апдейтами"""
+        self._ensure_started()
+        self._queues[user_id % len(self._queues)].put((time.monotonic(), functools.partial(fn, *args)))
+
+    def join(self):
+        """Дождаться обработки всего, что уже поставлено в очереди"""
+        for q in self._queues:
+            q.join()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            processed = self.processed
+            wait_avg = self._wait_total / processed if processed else 0.0
+            wait_max = self._wait_max
+        return {
+            "workers": len(self._queues),
+            "queue_depth": [q.qsize() for q in self._queues],
+            "processed": processed,
+            "queue_wait_avg_ms": round(wait_avg * 1000, 2),
+            "queue_wait_max_ms": round(wait_max * 1000, 2),
+            "handlers": handler_stats.snapshot(),
+        }
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i, q in enumerate(self._queues):
+                t = threading.Thread(target=self._run, args=(q,), name=f"updates-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def _run(self, q: queue.Queue):
+        while True:
+            enqueued, update = q.get()
+            waited = time.monotonic() - enqueued
+            try:
+                if callable(update):
+                    # задача из call()
+                    update()
+                else:
+                    self._process([update])
+            except Exception as e:
+                logger.error("Ошибка обработки апдейта %s: %s", getattr(update, "update_id", update), e)
+            finally:
+                with self._lock:
+                    self.processed += 1
+                    self._wait_total += waited
+                    self._wait_max = max(self._wait_max, waited)
+                q.task_done()
+
+
+instrument_handlers()
+dispatcher = UpdateDispatcher(bot, UPDATE_WORKERS)
+# polling отдаёт апдейты диспетчеру вместо обработки в своём потоке
+bot.process_new_updates = dispatcher.submit
+
 # ---------- Flask health-check ----------
 app = Flask(__name__)
 
@@ -718,35 +3365,173 @@ def admin_stats():
     key = request.args.get("key")
     if not key or key != ADMIN_API_KEY:
         return {"error": "Unauthorized"}, 401
-    total_users = db_execute("SELECT COUNT(*) as c FROM users", (), fetchone=True)['c']
-    pending_apps = db_execute("SELECT COUNT(*) as c FROM applications WHERE status = 0", (), fetchone=True)['c']
-    approved = db_execute("SELECT COUNT(*) as c FROM applications WHERE status = 1", (), fetchone=True)['c']
+    try:
+        days = min(max(int(request.args.get("days", STATS_DAYS)), 1), 366)
+    except ValueError:
+        return {"error": "Bad days"}, 400
+    stats = get_stats(days)
     return {
-        "total_users": total_users,
-        "pending_apps": pending_apps,
-        "approved": approved,
+        "total_users": stats["users_total"],
+        "pending_apps": stats["applications"].get("pending", 0),
+        "approved": stats["applications"].get("approved", 0),
+        "stats": stats,
+        "cache": cache_stats(),
+        "send_queue": outbound.stats(),
+        "outbox": outbox.stats(),
+        "maintenance": maintenance.last_report,
+        "dispatcher": dispatcher.stats(),
         "timestamp": datetime.now().isoformat()
     }, 200
 
+metrics.gauge("bot_send_queue_depth", "Задачи в очереди исходящих (включая выполняемые)", outbound.depth)
+metrics.gauge("bot_outbox_pending", "Недоставленные уведомления в outbox (ждут и в работе)", outbox.pending)
+metrics.gauge("bot_rate_limit_buckets", "Вёдер в лимитере действий", rate_limiter.size)
+metrics.gauge("bot_update_queue_depth", "Апдейты в очереди шарда диспетчера",
+              lambda: {str(i): q.qsize() for i, q in enumerate(dispatcher._queues)}, ("shard",))
+metrics.gauge("bot_drafts_in_memory", "Черновики анкет в DraftStore", drafts.pending)
+metrics.gauge("bot_album_groups_pending", "Альбомы, ожидающие окончания загрузки", albums.pending)
+metrics.gauge("bot_cache_entries", "Записей в кэше",
+              lambda: {name: st["size"] for name, st in cache_stats().items()}, ("cache",))
+metrics.gauge("bot_db_pool_connections", "Открытых соединений пула SQLite", lambda: _pool._created)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Метрики для Prometheus (scrape с params: key=ADMIN_API_KEY)"""
+    key = request.args.get("key")
+    if not key or key != ADMIN_API_KEY:
+        return {"error": "Unauthorized"}, 401
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route(WEBHOOK_PATH, methods=["POST"])
+def telegram_webhook():
+    """
+    Приём апдейтов от Telegram. Локально можно прогнать записанный апдейт:
+    curl -X POST -H 'X-Telegram-Bot-Api-Secret-Token: ...' -d @update.json localhost:10000/telegram-webhook
+    (тело — один апдейт или JSON-массив апдейтов)
+    """
+    if BOT_MODE != "webhook":
+        return {"error": "Not found"}, 404
+    if not WEBHOOK_SECRET:
+        # без секрета любой, кто узнал URL, подделает апдейт от имени админа
+        return {"error": "Forbidden"}, 403
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return {"error": "Unauthorized"}, 401
+    payload = request.get_json(silent=True)
+    if payload is None:
+        return {"error": "Bad request"}, 400
+    try:
+        items = payload if isinstance(payload, list) else [payload]
+        updates = [telebot.types.Update.de_json(item) for item in items]
+    except Exception as e:
+        logger.warning("Некорректный апдейт в webhook: %s", e)
+        return {"error": "Bad request"}, 400
+    # только ставим в очередь — отвечаем Telegram сразу
+    dispatcher.submit(updates)
+    return "OK", 200
+
+def require_webhook_secret():
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_SECRET: без него маршрут "
+                           f"{WEBHOOK_PATH} принимает поддельные апдейты")
+
+def setup_webhook():
+    require_webhook_secret()
+    url = WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH
+    bot.remove_webhook()
+    bot.set_webhook(url=url, secret_token=WEBHOOK_SECRET, allowed_updates=ALLOWED_UPDATES)
+    logger.info("Webhook установлен: %s", url)
+
 def run_flask():
     port = int(os.getenv("PORT", "10000"))
     app.run(host="0.0.0.0", port=port, debug=False, use_reloader=False)
 
 # ---------- Сигналы и запуск ----------
+_instance_lock = None
+
+def acquire_instance_lock():
+    """
+    Один процесс бота на файл БД: порядок апдейтов пользователя, кэши (LRU с TTL),
+    лимитер и outbox живут в памяти процесса. Второй процесс (например, второй
+    воркер gunicorn) получает RuntimeError.
+    """
+    global _instance_lock
+    if _instance_lock is not None:
+        return
+    import fcntl
+    lock_file = open(DB_PATH + ".lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        raise RuntimeError(f"Бот с базой {DB_PATH} уже запущен другим процессом "
+                           "(под gunicorn нужен ровно один воркер: -w 1)")
+    _instance_lock = lock_file
+
+def start_background():
+    """Фоновые службы: досылка outbox с прошлого запуска, обслуживание БД, сборщик"""
+    outbox.start()
+    maintenance.start()
+    sweeper.start()
+
+def shutdown():
+    activity.flush()
+    # даём очереди дослать уведомления и записываем, что доставлено; остальное уйдёт после перезапуска
+    outbound.join(timeout=5)
+    outbox.flush()
+    drafts.snapshot()
+    close_db()
+
 def signal_handler(signum, frame):
     logger.info("Получен сигнал %s. Завершение.", signum)
+    shutdown()
     sys.exit(0)
 
+def create_app():
+    """
+    WSGI-приложение для gunicorn в webhook-режиме: gunicorn -w 1 'main:create_app()'.
+    Запускает фоновые службы в процессе воркера; буферы сбрасываются при его штатном выходе.
+    """
+    if BOT_MODE != "webhook":
+        raise RuntimeError("create_app() — только для BOT_MODE=webhook")
+    require_webhook_secret()
+    if _instance_lock is None:
+        acquire_instance_lock()
+        start_background()
+        # SIGTERM воркера обрабатывает gunicorn — сбрасываем буферы на выходе из процесса
+        atexit.register(shutdown)
+    return app
+
 if __name__ == "__main__":
+    if sys.argv[1:] == ["set-webhook"]:
+        setup_webhook()
+        sys.exit(0)
+    if sys.argv[1:] == ["maintenance"]:
+        # разовый запуск (cron / вручную): python3 main.py maintenance
+        print(json.dumps(run_maintenance(), ensure_ascii=False))
+        close_db()
+        sys.exit(0)
+    if BOT_MODE == "webhook":
+        require_webhook_secret()
+    acquire_instance_lock()
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
+    start_background()
+    if BOT_MODE == "webhook":
+        if WEBHOOK_URL:
+            setup_webhook()
+        logger.info("Запуск бота (webhook)...")
+        run_flask()
+        sys.exit(0)
     # Запуск Flask
     flask_thread = threading.Thread(target=run_flask, daemon=True)
     flask_thread.start()
     # polling
     logger.info("Запуск бота...")
     try:
-        bot.infinity_polling(timeout=60, long_polling_timeout=30, allowed_updates=['message', 'callback_query'])
+        # вебхук и polling не работают одновременно
+        bot.remove_webhook()
+        bot.infinity_polling(timeout=60, long_polling_timeout=30, allowed_updates=ALLOWED_UPDATES)
     except Exception as e:
         logger.error("Критическая ошибка polling: %s", e)
         # уведомление админам
@@ -756,4 +3541,3 @@ if __name__ == "__main__":
             except Exception:
                 pass
         sys.exit(1)
-
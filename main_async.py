@@ -0,0 +1,705 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Асинхронный рантайм бота на AsyncTeleBot (опционально, вместо main.py)
+- Те же хендлеры и тексты, что в main.py; модель данных, кэши, настройки и клавиатуры — оттуда же
+- Апдейты и исходящие вызовы Bot API — корутины: тысячи апдейтов/отправок в полёте без потока на запрос
+- SQLite — через AsyncDB: один поток-писатель с очередью (записи не толкаются за _db_lock) + пул читателей
+- Апдейты одного пользователя обрабатываются строго по порядку, разных — параллельно
+- Уведомления пишутся в outbox из main.py, доставляет их тот же фоновый main.outbox
+- Только polling; webhook и /admin-stats — в синхронном рантайме (main.py)
+
+Запуск: python3 main_async.py   (нужен aiohttp: pip install aiohttp)
+"""
+import os
+import sys
+import asyncio
+import functools
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any
+
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+import main
+from main import logger, ADMIN_IDS
+
+# ---------- НАСТРОЙКИ ----------
+# Потоков для чтения из SQLite (запись всегда идёт одним потоком)
+ASYNC_DB_READERS = int(os.getenv("ASYNC_DB_READERS", "4"))
+# Сколько вызовов Bot API одновременно в полёте
+ASYNC_SEND_CONCURRENCY = int(os.getenv("ASYNC_SEND_CONCURRENCY", "64"))
+
+abot = AsyncTeleBot(main.BOT_TOKEN, parse_mode="Markdown")
+
+
+# ---------- БАЗА ДАННЫХ (async) ----------
+class AsyncDB:
+    """Синхронная модель из main.py в async: записи — в одном потоке-писателе, чтения — в пуле"""
+
+    def __init__(self, readers: int):
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+
+    async def read(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, functools.partial(fn, *args, **kwargs))
+
+    async def write(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, functools.partial(fn, *args, **kwargs))
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+
+
+db = AsyncDB(ASYNC_DB_READERS)
+
+
+# ---------- Исходящие вызовы (лимиты Telegram) ----------
+def _retry_delay(e: Exception, attempt: int) -> Optional[float]:
+    # сетевые сбои aiohttp telebot отдаёт как RequestTimeout
+    if isinstance(e, asyncio_helper.RequestTimeout):
+        return float(2 ** attempt)
+    return main.retry_delay(e, attempt)
+
+
+class AsyncSender:
+    """Вызовы Bot API с теми же лимитами, что SendQueue в main.py, но без потоков"""
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self._sem = None
+        self._global = main.TokenBucket(main.SEND_GLOBAL_RATE, main.SEND_GLOBAL_RATE)
+        self._chats = {}  # chat_id -> TokenBucket
+        self._background = set()
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def _chat_bucket(self, chat_id: int) -> main.TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= main.SEND_CHAT_BUCKETS_MAX:
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle()}
+            bucket = self._chats[chat_id] = main.TokenBucket(main.SEND_CHAT_RATE, main.SEND_CHAT_BURST)
+        return bucket
+
+    async def _acquire(self, chat_id: int):
+        for bucket in (self._chat_bucket(chat_id), self._global):
+            while True:
+                wait = bucket.reserve()
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+    async def call(self, chat_id: int, fn, *args, **kwargs):
+        """Вызов с лимитами, retry_after и повторами временных ошибок"""
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.concurrency)
+        attempt = 0
+        while True:
+            async with self._sem:
+                await self._acquire(chat_id)
+                try:
+                    result = await fn(*args, **kwargs)
+                    self.sent += 1
+                    return result
+                except Exception as e:
+                    delay = _retry_delay(e, attempt)
+                    if delay is None or attempt >= main.SEND_MAX_RETRIES:
+                        self.failed += 1
+                        raise
+            attempt += 1
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+    def send_message(self, chat_id: int, text: str, **kwargs):
+        """Отправить в фоне (хендлер не ждёт)"""
+        self.submit(chat_id, abot.send_message, chat_id, text, **kwargs)
+
+    def submit(self, chat_id: int, fn, *args, **kwargs):
+        """Любой вызов Bot API в фоне"""
+        self.spawn(self._call_quietly(chat_id, fn, *args, **kwargs))
+
+    def spawn(self, coro) -> asyncio.Task:
+        """Фоновая задача: ссылка хранится до завершения (иначе её может собрать GC), drain() её дождётся"""
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    async def _call_quietly(self, chat_id: int, fn, *args, **kwargs):
+        try:
+            await self.call(chat_id, fn, *args, **kwargs)
+        except Exception as e:
+            logger.warning("Не удалось отправить в чат %s: %s", chat_id, e)
+
+    async def drain(self):
+        while self._background:
+            await asyncio.gather(*list(self._background), return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"in_flight": len(self._background), "sent": self.sent, "retried": self.retried,
+                "failed": self.failed, "chat_buckets": len(self._chats)}
+
+
+sender = AsyncSender(ASYNC_SEND_CONCURRENCY)
+
+async def _send_media_to_chat(chat_id: int, albums_out, animations):
+    # внутри одного чата — по порядку; параллельность только между чатами
+    for chunk in albums_out:
+        try:
+            method, args, kwargs = main.media_chunk_call(abot, chat_id, chunk)
+            await sender.call(chat_id, method, *args, **kwargs)
+        except Exception as e:
+            logger.warning("Не удалось отправить альбом в чат %s: %s", chat_id, e)
+    for file_id, caption in animations:
+        try:
+            await sender.call(chat_id, abot.send_animation, chat_id, file_id, caption=caption)
+        except Exception as e:
+            logger.warning("Не удалось отправить GIF в чат %s: %s", chat_id, e)
+
+async def send_application_media(chat_ids, application_id: int):
+    medias = await db.read(main.get_application_media, application_id)
+    if not medias:
+        return
+    albums_out, animations = main.build_media_albums(medias)
+    await asyncio.gather(*(_send_media_to_chat(chat_id, albums_out, animations) for chat_id in chat_ids))
+
+
+# ---------- Альбомы (media_group_id) ----------
+class AsyncAlbumBuffer:
+    """Как AlbumBuffer из main.py, но на таймерах event loop"""
+
+    def __init__(self, window: float, on_album):
+        self.window = window
+        self.on_album = on_album
+        self._groups = {}  # key -> {"items": [...], "context": ..., "last": loop.time()}
+
+    def add(self, key, item, context=None):
+        loop = asyncio.get_running_loop()
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = {"items": [], "context": context, "last": 0.0}
+            loop.call_later(self.window, self._fire, key)
+        group["items"].append(item)
+        group["last"] = loop.time()
+
+    def pending(self) -> int:
+        return len(self._groups)
+
+    def _fire(self, key):
+        loop = asyncio.get_running_loop()
+        group = self._groups.get(key)
+        if group is None:
+            return
+        quiet = loop.time() - group["last"]
+        if quiet < self.window:
+            loop.call_later(self.window - quiet, self._fire, key)
+            return
+        del self._groups[key]
+        try:
+            self.on_album(key, group["items"], group["context"])
+        except Exception as e:
+            logger.error("Ошибка при сохранении альбома %s: %s", key, e)
+
+
+# ---------- Хендлеры ----------
+# callback_data разбирает тот же CallbackRouter, что и в main.py (свой реестр корутин)
+router = main.CallbackRouter()
+cb_id, cb_app_id, cb_section = main.cb_id, main.cb_app_id, main.cb_section
+
+@abot.message_handler(commands=["start", "help"])
+async def cmd_start(message):
+    uid = message.from_user.id
+    username = message.from_user.username
+    first_name = message.from_user.first_name or ""
+    last_name = message.from_user.last_name or ""
+    # пользователь и уведомление админам о новом — одной транзакцией
+    user = await db.write(main.ensure_user, uid, username, first_name, last_name)
+    # Забанен
+    if user and user['status'] == 'banned':
+        await abot.send_message(uid, main.TEXT_BANNED)
+        return
+    # Approved -> показать разделы и инструкции
+    if user and user['status'] == 'approved':
+        await abot.send_message(uid, main.TEXT_START_APPROVED)
+        return
+    # pending
+    await abot.send_message(uid, main.TEXT_START_PENDING, reply_markup=main.kb_start_pending())
+
+@router.route("show_status")
+async def cb_show_status(call):
+    uid = call.from_user.id
+    user = await db.read(main.get_user, uid)
+    if not user:
+        await abot.answer_callback_query(call.id, "Не найден пользователь", show_alert=True)
+        return
+    app = await db.read(main.get_active_application_for_user, uid)
+    app_text = f"Активная анкета: {main.app_ref(app['id'])} / раздел: {app['section']}" if app else "Активная анкета: нет"
+    await abot.send_message(uid, f"👤 ID: `{uid}`\nСтатус: {user['status']}\n{app_text}")
+    await abot.answer_callback_query(call.id)
+
+@router.route("create_app")
+async def cb_create_app(call):
+    uid = call.from_user.id
+    user = await db.read(main.get_user, uid)
+    if not user:
+        await abot.answer_callback_query(call.id, "Нужен /start сначала", show_alert=True)
+        return
+    if user['status'] == 'approved':
+        await abot.answer_callback_query(call.id, "У вас уже открыт доступ (approved).", show_alert=True)
+        return
+    if user['status'] == 'banned':
+        await abot.answer_callback_query(call.id, "Вы заблокированы.", show_alert=True)
+        return
+    # показать клавиатуру разделов
+    await abot.send_message(uid, main.TEXT_CHOOSE_SECTION, reply_markup=main.section_kb())
+    await abot.answer_callback_query(call.id)
+
+@router.route("sec", cb_section)
+async def cb_section_select(call, section: str):
+    uid = call.from_user.id
+    user = await db.read(main.get_user, uid)
+    if not user:
+        await abot.answer_callback_query(call.id, "Нужен /start сначала", show_alert=True)
+        return
+    if user['status'] != 'pending':
+        await abot.answer_callback_query(call.id, "Нельзя создавать анкету в текущем статусе.", show_alert=True)
+        return
+    # лимит — только если будет создана новая анкета (активная просто показывается снова)
+    active = await db.read(main.get_active_application_for_user, uid)
+    refusal = None if active else main.create_app_refusal(uid)
+    if refusal:
+        await abot.answer_callback_query(call.id, refusal, show_alert=True)
+        return
+    app_id = await db.write(main.open_application, uid, section)
+    await abot.send_message(uid, main.TEXT_APP_CREATED.format(app=main.app_ref(app_id), section=section), reply_markup=main.kb_media_actions(app_id))
+    await abot.answer_callback_query(call.id, "Анкета создана. Проверьте инструкции в личных сообщениях.")
+
+@router.route("add_normal", cb_app_id, media_type="normal")
+@router.route("add_intimate", cb_app_id, media_type="intimate")
+async def cb_add_media_start(call, app_id: int, media_type: str):
+    uid = call.from_user.id
+    app = await db.read(main.get_application, app_id)
+    if not app or app['user_id'] != uid or app['status'] != 0:
+        await abot.answer_callback_query(call.id, "Анкета не найдена или недоступна.", show_alert=True)
+        return
+    await db.write(main.set_user_state, uid, app_id, media_type, f"awaiting_{media_type}")
+    await abot.send_message(uid, f"Отправьте файл(ы) для типа *{media_type}*. Поддерживаются: фото, видео, GIF. Можно отправлять несколько сообщений по одному файлу.")
+    await abot.answer_callback_query(call.id, f"Отправьте файлы для {media_type}")
+
+@abot.message_handler(content_types=["photo", "video", "animation"])
+async def media_receive(message):
+    media = main._extract_media(message)
+    if media is None:
+        await abot.reply_to(message, "Неподдерживаемый тип.")
+        return
+    kind, file_id = media
+    uid = message.from_user.id
+    # анкета и тип — на момент прихода файла (для альбома — первого), как в main.py
+    target = await db.read(main.media_target, uid)
+    if message.media_group_id:
+        # альбом приходит отдельными апдейтами — копим и сохраняем одной пачкой
+        albums.add((uid, message.media_group_id), (message, kind, file_id), target)
+        return
+    await save_received_media(uid, [(message, kind, file_id)], target)
+
+async def save_received_media(uid: int, items, target):
+    first = items[0][0]
+    user = await db.read(main.get_user, uid)
+    if not user:
+        await abot.reply_to(first, "Нужен /start сначала.")
+        return
+    if user['status'] == 'banned':
+        await abot.reply_to(first, "🚫 Вы заблокированы.")
+        return
+    if target is None:
+        await abot.reply_to(first, "ℹ️ Сначала нажмите кнопку 'Добавить обычное' или 'Добавить интимное' в меню анкеты.")
+        return
+    app_id, media_type = target  # media_type: normal | intimate
+    app = await db.read(main.get_application, app_id)
+    if not app or app['user_id'] != uid or app['status'] != 0:
+        await abot.reply_to(first, "Анкета не найдена или уже отправлена.")
+        return
+    if len(items) == 1:
+        saved = await db.write(main.add_media, app_id, media_type, items[0][1], items[0][2])
+    else:
+        saved = await db.write(main.add_media_batch, app_id, media_type, [(kind, file_id) for _, kind, file_id in items])
+    if not saved:
+        await abot.reply_to(first, "Ошибка при сохранении файла.")
+        return
+    if len(items) == 1:
+        await abot.reply_to(first, f"Файл сохранён (тип: {media_type}). Чтобы добавить другой тип — нажмите соответствующую кнопку. Готово — нажмите «Готово (отправить на модерацию)» в меню анкеты.")
+    else:
+        await abot.reply_to(first, f"Альбом сохранён: {len(items)} файл(ов) (тип: {media_type}). Чтобы добавить другой тип — нажмите соответствующую кнопку. Готово — нажмите «Готово (отправить на модерацию)» в меню анкеты.")
+    # обновим user_state.updated_at — если пользователь тем временем не выбрал другой тип
+    if await db.read(main.media_target, uid) == target:
+        await db.write(main.set_user_state, uid, app_id, media_type, f"added_media_{media_type}")
+
+def _save_album(key, items, target):
+    items.sort(key=lambda item: item[0].message_id)
+    # сохранение — в цепочке пользователя, по порядку с его апдейтами
+    dispatcher.call(key[0], save_received_media, key[0], items, target)
+
+albums = AsyncAlbumBuffer(main.ALBUM_WINDOW_SECONDS, _save_album)
+
+@router.route("submit_app", cb_app_id)
+async def cb_submit_app(call, app_id: int):
+    uid = call.from_user.id
+    app = await db.read(main.get_application, app_id)
+    if not app or app['user_id'] != uid:
+        await abot.answer_callback_query(call.id, "Анкета не найдена.", show_alert=True)
+        return
+    if app['status'] != 0:
+        await abot.answer_callback_query(call.id, "Анкета уже обработана.", show_alert=True)
+        return
+    counts = await db.read(main.get_media_counts, app_id)
+    if counts.get('normal', 0) < 1 or counts.get('intimate', 0) < 1:
+        await abot.answer_callback_query(call.id, "Нужно минимум 1 обычное и 1 интимное фото.", show_alert=True)
+        return
+    app_id = await db.write(main.submit_application, uid, app_id)
+    if app_id is None:
+        await abot.answer_callback_query(call.id, "Анкета не найдена.", show_alert=True)
+        return
+    await abot.send_message(uid, f"✅ Анкета #{app_id} отправлена на модерацию. Ожидайте решения администратора.")
+    await abot.answer_callback_query(call.id)
+
+@router.route("reset_app", cb_app_id)
+async def cb_reset_app(call, app_id: int):
+    uid = call.from_user.id
+    app = await db.read(main.get_application, app_id)
+    if not app or app['user_id'] != uid:
+        await abot.answer_callback_query(call.id, "Анкета не найдена.", show_alert=True)
+        return
+    await db.write(main.delete_application, app_id, uid)
+    await abot.send_message(uid, "🔄 Ваша анкета сброшена. Можете создать новую анкету.")
+    await abot.answer_callback_query(call.id)
+
+# ---------- Модерация (админ) ----------
+@router.route("mod_app_appr", cb_id, admin=True, decision="approve")
+@router.route("mod_app_rej", cb_id, admin=True, decision="reject")
+@router.route("mod_app_fix", cb_id, admin=True, decision="fix")
+async def cb_mod_action(call, app_id: int, decision: str):
+    await process_mod_decision(call, app_id, decision)
+
+@router.route("mod_app_view", cb_id, admin=True)
+async def cb_mod_view(call, app_id: int):
+    await admin_view_application(call, app_id)
+
+async def _edit_moderator_message(call, text: str):
+    # сообщение модератора — косметика: решение и уведомление уже в БД
+    try:
+        await abot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text=text)
+    except Exception as e:
+        logger.debug("Не удалось обновить сообщение модератора: %s", e)
+
+async def process_mod_decision(call, app_id: int, decision: str):
+    app = await db.read(main.get_application, app_id)
+    if not app:
+        await abot.answer_callback_query(call.id, "Анкета не найдена.", show_alert=True)
+        return
+    if decision == "approve":
+        counts = await db.read(main.get_media_counts, app_id)
+        if counts.get('normal', 0) < 1 or counts.get('intimate', 0) < 1:
+            await abot.answer_callback_query(call.id, "Анкета неполная (требуется обычное + интимное).", show_alert=True)
+            return
+        await db.write(main.decide_application, app_id, decision, call.from_user.id)
+        await abot.answer_callback_query(call.id, "Анкета одобрена.")
+        await _edit_moderator_message(call, f"✅ Анкета #{app_id} одобрена администратором {call.from_user.first_name}")
+    elif decision == "reject":
+        await db.write(main.decide_application, app_id, decision, call.from_user.id)
+        await abot.answer_callback_query(call.id, "Анкета отклонена и пользователь заблокирован.")
+        await _edit_moderator_message(call, f"❌ Анкета #{app_id} отклонена. Пользователь заблокирован.")
+    elif decision == "fix":
+        await db.write(main.decide_application, app_id, decision, call.from_user.id)
+        await abot.answer_callback_query(call.id, "Запрошены правки.")
+        await _edit_moderator_message(call, f"✏️ Анкета #{app_id} помечена как needs_fix.")
+
+async def admin_view_application(call, app_id: int):
+    app = await db.read(main.get_application, app_id)
+    if not app:
+        await abot.answer_callback_query(call.id, "Анкета не найдена.", show_alert=True)
+        return
+    counts = await db.read(main.get_media_counts, app_id)
+    text = f"📋 Анкета #{app_id}\nПользователь: `{app['user_id']}`\nРаздел: {app['section']}\nСтатус: {app['status']}\n\nМедиа:\n"
+    text += f"Обычных: {counts.get('normal',0)}, Интимных: {counts.get('intimate',0)}\n"
+    try:
+        await abot.send_message(call.from_user.id, text)
+        sender.spawn(send_application_media([call.from_user.id], app_id))
+    except Exception as e:
+        logger.error("Ошибка при отправке заявки админу: %s", e)
+    await abot.answer_callback_query(call.id, "Отправлено в личку.")
+
+async def run_bulk_moderation(chat_id: int, moderator_id: int, params: Dict[str, Any]):
+    """Как run_bulk_moderation в main.py: одна транзакция с уведомлениями в outbox, отчёт о доставке"""
+    decision = params["decision"]
+    filters = {k: v for k, v in params.items() if k != "decision"}
+    header = main.bulk_description(params)
+    batch = f"bulk:{moderator_id}:{time.time_ns()}"
+    # прогресс приходит из потока outbox — правки сообщения идут через main.outbound
+    progress = main.BulkProgress(chat_id, header, batch)
+    main.outbox.watch(batch, progress)
+    rows = await db.write(main.bulk_set_application_status, decision, moderator_id, batch=batch, **filters)
+    if not rows:
+        main.outbox.unwatch(batch)
+        await abot.send_message(chat_id, "Ни одна анкета не подошла под условия.")
+        return
+    msg = await abot.send_message(chat_id, main.bulk_progress_text(header, len(rows), 0, 0))
+    progress.begin(msg.message_id, len(rows))
+
+def _start_bulk(chat_id: int, moderator_id: int, params: Dict[str, Any]):
+    # транзакция на тысячу анкет — не держим очередь апдейтов админа
+    sender.spawn(run_bulk_moderation(chat_id, moderator_id, params))
+
+@abot.message_handler(commands=["bulk"])
+async def cmd_bulk(message):
+    if message.from_user.id not in ADMIN_IDS:
+        await abot.reply_to(message, "Доступ запрещён.")
+        return
+    try:
+        params = main.parse_bulk_args(message.text)
+    except ValueError:
+        await abot.reply_to(message, main.BULK_USAGE)
+        return
+    if params.get("app_ids") is not None:
+        _start_bulk(message.chat.id, message.from_user.id, params)
+        return
+    params["max_id"] = await db.read(main.max_application_id)
+    count = await db.read(main.count_bulk_targets, **params)
+    if not count:
+        await abot.reply_to(message, "Ни одна анкета не подошла под условия.")
+        return
+    text = f"{main.bulk_description(params)}\nПод условия подходит анкет: {count}."
+    if count > main.BULK_MODERATION_MAX:
+        text += f"\nЗа раз будет обработано {main.BULK_MODERATION_MAX} самых старых."
+    await abot.reply_to(message, text + "\n\nВыполнить?", reply_markup=main.kb_bulk_confirm(params))
+
+@router.route("bulk_cancel", admin=True)
+async def cb_bulk_cancel(call):
+    await abot.answer_callback_query(call.id, "Отменено.")
+    await _edit_moderator_message(call, "Массовое действие отменено.")
+
+@router.route("bulk_ok", parse=lambda data: (main.parse_bulk_cb(data),), admin=True)
+async def cb_bulk(call, params: Dict[str, Any]):
+    try:
+        await abot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=None)
+    except Exception:
+        pass
+    await abot.answer_callback_query(call.id, "Выполняется…")
+    _start_bulk(call.message.chat.id, call.from_user.id, params)
+
+# ---------- Доп. команды /admin, /status, /my, /reset ----------
+@abot.message_handler(commands=["admin"])
+async def cmd_admin(message):
+    if message.from_user.id not in ADMIN_IDS:
+        await abot.reply_to(message, "Доступ запрещён.")
+        return
+    await abot.reply_to(message, "Админ-панель:", reply_markup=main.kb_admin_main())
+
+@router.route("admin_pending", parse=main.parse_pending_cb, admin=True)
+async def cb_admin_pending(call, section, cursor, direction: str):
+    rows, has_prev, has_next = await db.read(main.get_pending_page, section, cursor, direction)
+    text, kb = main.pending_page_view(rows, section, has_prev, has_next)
+    if call.data == "admin_pending":
+        await abot.send_message(call.from_user.id, text, reply_markup=kb)
+    else:
+        try:
+            await abot.edit_message_text(text, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=kb)
+        except Exception:
+            pass
+    await abot.answer_callback_query(call.id)
+
+@router.route("admin_stats", admin=True)
+async def cb_admin_stats(call):
+    stats = await db.read(main.get_stats)
+    await abot.send_message(call.from_user.id, main.stats_text(stats))
+    await abot.answer_callback_query(call.id)
+
+@abot.message_handler(commands=["status"])
+async def cmd_status(message):
+    uid = message.from_user.id
+    user = await db.read(main.get_user, uid)
+    if not user:
+        await abot.reply_to(message, "Нужен /start")
+        return
+    app = await db.read(main.get_active_application_for_user, uid)
+    text = f"Статус: {user['status']}\n"
+    if app:
+        counts = await db.read(main.get_media_counts, app['id'])
+        text += f"Активная анкета {main.app_ref(app['id'])}, раздел {app['section']}\nОбычных: {counts.get('normal',0)}, Интимных: {counts.get('intimate',0)}"
+        await abot.reply_to(message, text, reply_markup=main.kb_media_actions(app['id']))
+    else:
+        await abot.reply_to(message, text)
+
+@abot.message_handler(commands=["my"])
+async def cmd_my(message):
+    rows = await db.read(main.get_user_applications, message.from_user.id)
+    if not rows:
+        await abot.reply_to(message, "У вас нет анкет.")
+        return
+    text = "Ваши анкеты:\n\n"
+    for r in rows:
+        text += f"#{r['id']} — {r['section']} — {main.APP_STATUS_NAMES.get(r['status'], r['status'])} — {r['created_at'][:16]}\n"
+    await abot.reply_to(message, text)
+
+@abot.message_handler(commands=["reset"])
+async def cmd_reset(message):
+    uid = message.from_user.id
+    app = await db.read(main.get_active_application_for_user, uid)
+    if not app:
+        await abot.reply_to(message, "Активной анкеты нет.")
+        return
+    await db.write(main.delete_application, app['id'], uid)
+    await abot.reply_to(message, "Анкета сброшена. Можете создать новую.")
+
+
+@abot.callback_query_handler(func=lambda call: True)
+async def on_callback(call):
+    route, args = router.resolve(call.data or "")
+    if route is None:
+        await abot.answer_callback_query(call.id, "Неизвестная операция.", show_alert=True)
+        return
+    if route.admin and call.from_user.id not in ADMIN_IDS:
+        await abot.answer_callback_query(call.id, "Нет прав.", show_alert=True)
+        return
+    if args is None:
+        await abot.answer_callback_query(call.id, "Некорректно.", show_alert=True)
+        return
+    await route.handler(call, *args, **route.fixed)
+
+# ---------- Диспетчер апдейтов ----------
+def _timed_handler(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        error = False
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            error = True
+            main.HANDLER_ERRORS.inc(fn.__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            main.handler_stats.record(fn.__name__, elapsed, error)
+            main.HANDLER_LATENCY.observe(elapsed, fn.__name__)
+    return wrapper
+
+def instrument_handlers():
+    for handler in abot.message_handlers:
+        if not hasattr(handler['function'], "__wrapped__"):
+            handler['function'] = _timed_handler(handler['function'])
+    wrapped = {}
+    for route in router.routes():
+        if not hasattr(route.handler, "__wrapped__"):
+            if route.handler not in wrapped:
+                wrapped[route.handler] = _timed_handler(route.handler)
+            route.handler = wrapped[route.handler]
+
+
+def _reject_update(update, user_id: int, text: Optional[str]):
+    if text is None:
+        return
+    if update.callback_query is not None:
+        sender.submit(user_id, abot.answer_callback_query, update.callback_query.id, text, show_alert=True)
+    else:
+        sender.send_message(user_id, text)
+
+
+class OrderedUpdates:
+    """
+    Апдейты одного пользователя — строго друг за другом (цепочка задач),
+    разных пользователей — параллельно. Аналог UpdateDispatcher из main.py.
+    """
+
+    def __init__(self, telegram_bot: AsyncTeleBot):
+        self._process = telegram_bot.process_new_updates
+        self._tails = {}  # user_id -> последняя задача пользователя
+        self._tasks = set()
+        self.processed = 0
+
+    async def submit(self, updates):
+        for update in updates:
+            uid = main._update_user_id(update)
+            # тот же лимитер, что в main.py: отказ — до задачи и до SQLite
+            rejected = main.rate_limit_update(update, uid)
+            if rejected is not None:
+                _reject_update(update, uid, rejected[1])
+                continue
+            self._chain(uid if uid is not None else ("update", update.update_id), update)
+
+    def call(self, user_id: int, fn, *args):
+        """Корутина fn(*args) в цепочке пользователя — строго по порядку с его апдейтами"""
+        self._chain(user_id, functools.partial(fn, *args))
+
+    def _chain(self, key, job):
+        task = asyncio.create_task(self._run(key, self._tails.get(key), job))
+        self._tails[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def join(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"in_flight": len(self._tasks), "users": len(self._tails), "processed": self.processed,
+                "handlers": main.handler_stats.snapshot()}
+
+    async def _run(self, key, previous, job):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        try:
+            # апдейт или задача из call()
+            await (job() if callable(job) else self._process([job]))
+        except Exception as e:
+            logger.error("Ошибка обработки апдейта %s: %s", getattr(job, "update_id", job), e)
+        finally:
+            self.processed += 1
+            if self._tails.get(key) is asyncio.current_task():
+                del self._tails[key]
+
+
+instrument_handlers()
+dispatcher = OrderedUpdates(abot)
+# polling отдаёт апдейты диспетчеру (порядок по пользователю) вместо общей обработки
+abot.process_new_updates = dispatcher.submit
+
+async def run():
+    logger.info("Запуск бота (async)...")
+    main.acquire_instance_lock()
+    main.start_background()
+    loop = asyncio.get_running_loop()
+    try:
+        await abot.delete_webhook()
+        polling = asyncio.create_task(
+            abot.infinity_polling(timeout=60, request_timeout=90, allowed_updates=main.ALLOWED_UPDATES))
+        # без своих обработчиков SIGTERM убивает процесс мимо finally — теряются last_activity,
+        # взятые в работу строки outbox (после перезапуска уйдут повторно) и снимок черновиков
+        def stop(signum):
+            logger.info("Получен сигнал %s. Завершение.", signum)
+            polling.cancel()
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop, signum)
+        try:
+            await polling
+        except asyncio.CancelledError:
+            pass
+    finally:
+        await dispatcher.join()
+        await sender.drain()
+        await abot.close_session()
+        db.close()
+        main.shutdown()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        sys.exit(0)